@@ -6,6 +6,7 @@ from __future__ import print_function
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 class SupConLoss(nn.Module):
@@ -96,3 +97,121 @@ class SupConLoss(nn.Module):
         loss = loss.view(anchor_count, batch_size).mean()
 
         return loss
+
+
+class SupConMemoryBankLoss(nn.Module):
+    """SupConLoss against the current batch plus a FIFO memory bank of past features
+    (as in MoCo, https://arxiv.org/abs/1911.05722), for many negatives without larger batches.
+    Bank entries are positives of an anchor when their `ids` (e.g. caption ids) are equal.
+    The anchors are processed in chunks of `chunk_size`, so no (2B x (2B + bank)) mask,
+    logits_mask or exp_logits tensors are allocated at once."""
+    def __init__(self, feat_dim=128, bank_size=4096, temperature=0.07,
+                 base_temperature=0.07, chunk_size=1024):
+        super(SupConMemoryBankLoss, self).__init__()
+        self.temperature = temperature
+        self.base_temperature = base_temperature
+        self.bank_size = bank_size
+        self.chunk_size = chunk_size
+        self.register_buffer('bank', torch.zeros(bank_size, feat_dim))
+        self.register_buffer('bank_ids', torch.full((bank_size,), -1, dtype=torch.long))
+        self.register_buffer('ptr', torch.zeros(1, dtype=torch.long))
+        self.register_buffer('filled', torch.zeros(1, dtype=torch.long))
+
+    def forward(self, features, labels=None, mask=None, ids=None):
+        """Compute loss for model, same arguments as SupConLoss plus
+
+        Args:
+            ids: ids of shape [bsz] stored with the features in the bank, features of the
+                bank with the same id are positives. Defaults to `labels`; without both,
+                the bank only contributes negatives.
+        Returns:
+            A loss scalar.
+        """
+        device = features.device
+
+        if len(features.shape) < 3:
+            raise ValueError('`features` needs to be [bsz, n_views, ...],'
+                             'at least 3 dimensions are required')
+        if len(features.shape) > 3:
+            features = features.view(features.shape[0], features.shape[1], -1)
+
+        batch_size, n_views = features.shape[0], features.shape[1]
+        if labels is not None and mask is not None:
+            raise ValueError('Cannot define both `labels` and `mask`')
+        elif labels is None and mask is None:
+            mask = torch.eye(batch_size, dtype=torch.float32, device=device)
+        elif labels is not None:
+            labels = labels.contiguous().view(-1, 1)
+            if labels.shape[0] != batch_size:
+                raise ValueError('Num of labels does not match num of features')
+            mask = torch.eq(labels, labels.T).float().to(device)
+        else:
+            mask = mask.float().to(device)
+        if ids is None and labels is not None:
+            ids = labels.view(-1)
+
+        # anchors/contrast as in contrast_mode 'all': view-major concatenation of the views
+        contrast_feature = torch.cat(torch.unbind(features, dim=1), dim=0)     # (n_views*bsz, dim)
+        n = contrast_feature.shape[0]
+        sample = torch.arange(n, device=device) % batch_size
+
+        filled = int(self.filled)
+        bank = self.bank[:filled].detach()
+        # snapshot of the ids: enqueue overwrites the bank before the backward pass recomputes the chunks
+        bank_ids = self.bank_ids[:filled].clone()
+        contrast = torch.cat([contrast_feature, bank], dim=0)                  # (n + filled, dim)
+
+        losses = []
+        for start in range(0, n, self.chunk_size):
+            rows = torch.arange(start, min(start + self.chunk_size, n), device=device)
+            if torch.is_grad_enabled() and contrast_feature.requires_grad:
+                # only the chunk inputs are kept for backward, the logits are recomputed
+                losses.append(checkpoint(self.chunk_loss, rows, contrast_feature, contrast, mask, sample, ids, bank_ids, use_reentrant=False))
+            else:
+                losses.append(self.chunk_loss(rows, contrast_feature, contrast, mask, sample, ids, bank_ids))
+
+        loss = torch.cat(losses).mean()
+
+        if ids is None:
+            ids = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+        self.enqueue(contrast_feature.detach(), ids.to(device).repeat(n_views))
+
+        return loss
+
+    def chunk_loss(self, rows, contrast_feature, contrast, mask, sample, ids, bank_ids):
+        device = contrast_feature.device
+        filled = len(bank_ids)
+        logits = torch.matmul(contrast_feature[rows], contrast.T) / self.temperature
+
+        # positives: batch part from the (bsz x bsz) mask, bank part from the ids
+        pos = mask[sample[rows]][:, sample]                                 # (chunk, n)
+        if ids is not None and filled > 0: # -1 ids (enqueued without ids) are never positives
+            pos_bank = torch.eq(ids.to(device)[sample[rows]].view(-1, 1), bank_ids.view(1, -1)) & (bank_ids >= 0).view(1, -1)
+            pos_bank = pos_bank.float()
+        else:
+            pos_bank = torch.zeros(len(rows), filled, device=device)
+        pos = torch.cat([pos, pos_bank], dim=1)
+
+        # mask-out self-contrast cases
+        self_mask = torch.zeros_like(pos, dtype=torch.bool)
+        self_mask[torch.arange(len(rows), device=device), rows] = True
+        pos = pos.masked_fill(self_mask, 0)
+        logits = logits.masked_fill(self_mask, float('-inf'))
+
+        # compute mean of log-likelihood over positive
+        log_prob = logits - torch.logsumexp(logits, dim=1, keepdim=True)
+        log_prob = log_prob.masked_fill(self_mask, 0)
+        mean_log_prob_pos = (pos * log_prob).sum(1) / pos.sum(1).clamp(min=1e-12)
+        return - (self.temperature / self.base_temperature) * mean_log_prob_pos
+
+    @torch.no_grad()
+    def enqueue(self, features, ids):
+        # FIFO: overwrite the oldest entries of the bank
+        n = min(features.shape[0], self.bank_size)
+        features, ids = features[-n:], ids[-n:]
+        ptr = int(self.ptr)
+        idx = (torch.arange(n, device=features.device) + ptr) % self.bank_size
+        self.bank[idx] = features.to(self.bank.dtype)
+        self.bank_ids[idx] = ids
+        self.ptr[0] = (ptr + n) % self.bank_size
+        self.filled[0] = min(int(self.filled) + n, self.bank_size)
@@ -16,11 +16,15 @@ from transformers import BertTokenizer, BertModel, AutoTokenizer, AutoModel, log
 from sentence_transformers import SentenceTransformer, util
 from googletrans import Translator
 import os
+import json
 from PIL import Image
 from roco_utils import encode_text
+from models.SupConLoss.loss import SupConMemoryBankLoss
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.checkpoint import get_device_states, set_device_states
 
 from bert_score import BERTScorer
+from bert_score.utils import sent_encode, padding
 
 
 class TwoCropTransform:
@@ -83,13 +87,30 @@ class SupConEncoder(nn.Module):
 def get_supcon_model(args):
     return SupConEncoder(name=args.cnn_encoder)
 
+def load_caption_embeddings(path):
+    # store written by preprocess/caption_embeddings.py: (n_columns * n_rows, dim) fp16 matrix and its row ids
+    emb = np.load(path, mmap_mode='r')
+    with open(os.path.splitext(path)[0] + '.json') as f:
+        meta = json.load(f)
+    return emb, meta
+
 class SimilarityCalculator(nn.Module):
 
     def __init__(self, args, device):
         super().__init__()
         self.similarity = args.similarity
         print('Similarity', self.similarity)
-        if args.similarity == 'cosine':
+        self.caption_embeddings = None
+        if getattr(args, 'caption_embeddings', None):
+            # precomputed embeddings, the batch gives row indices of the store instead of captions
+            print('Using caption embeddings from', args.caption_embeddings)
+            self.caption_embeddings, meta = load_caption_embeddings(args.caption_embeddings)
+            assert meta['similarity'] == args.similarity, 'caption embeddings were computed for ' + meta['similarity']
+            self.device = device
+        elif args.similarity == 'jaccard':
+            self.vocab = {}             # word -> word id
+            self.caption_words = {}     # caption -> ids of its unique words
+        elif args.similarity == 'cosine':
             logging.set_verbosity_error()
             self.tokenizer = AutoTokenizer.from_pretrained(args.clinicalbert, model_max_length=args.max_token_length)
             self.model = AutoModel.from_pretrained(args.clinicalbert)
@@ -108,15 +129,44 @@ class SimilarityCalculator(nn.Module):
                 self.scorer = BERTScorer(lang="en",model_type='allenai/scibert_scivocab_uncased')
 
     def jaccard(self,caption,aug,bsz):
+        # vectorized version of jaccard_similarity for every (caption, aug) pair:
+        # binary word matrices of both lists, intersections with one sparse matmul and
+        # unions from the word counts, |A u B| = |A| + |B| - |A n B|
+        words1 = [self.get_caption_words(c) for c in caption]
+        words2 = [self.get_caption_words(c) for c in aug]
+        n1, n2 = len(words1), len(words2)
+
+        rows = torch.tensor([r for r, w in enumerate(words1 + words2) for _ in w], dtype=torch.long)
+        ids = torch.tensor([i for w in words1 + words2 for i in w], dtype=torch.long)
+        _, cols = torch.unique(ids, return_inverse=True) # batch local word ids
+        n_words = int(cols.max()) + 1 if len(cols) > 0 else 1
+        in1 = rows < n1
+
+        # float64 so that the ratios round exactly like the python floats of jaccard_similarity
+        m1 = torch.sparse_coo_tensor(torch.stack([rows[in1], cols[in1]]), torch.ones(int(in1.sum()), dtype=torch.float64), (n1, n_words))
+        m2 = torch.zeros(n2, n_words, dtype=torch.float64)
+        m2[rows[~in1] - n1, cols[~in1]] = 1.0
+
+        intersection = torch.sparse.mm(m1, m2.t())                              # (n1 x n2)
+        len1 = torch.tensor([len(w) for w in words1], dtype=torch.float64)
+        len2 = m2.sum(1)
+        union = len1[:, None] + len2[None, :] - intersection
+        sim = torch.where(union > 0, intersection / union.clamp(min=1), torch.zeros_like(union))
+
         mask = torch.zeros(bsz, bsz, dtype=torch.float)
-        for c1 in range(len(caption)):
-            for c2 in range(len(aug)):
-                if c1 != c2:
-                    mask[c1,c2] = self.jaccard_similarity(caption[c1],aug[c2])
-                else:
-                    mask[c1,c2] = 1.0
+        mask[:n1, :n2] = sim.float()
+        diag = torch.arange(min(n1, n2))
+        mask[diag, diag] = 1.0
         return mask
 
+    def get_caption_words(self, doc):
+        # cached ids of the unique words of a caption (same tokenization as jaccard_similarity)
+        words = self.caption_words.get(doc)
+        if words is None:
+            words = [self.vocab.setdefault(w, len(self.vocab)) for w in set(doc.lower().split())]
+            self.caption_words[doc] = words
+        return words
+
     def jaccard_similarity(self,doc1, doc2): 
         
         # List the unique words in a document
@@ -167,22 +217,60 @@ class SimilarityCalculator(nn.Module):
             #assert da shape com bsz
             return util.cos_sim(emb1, emb2).fill_diagonal_(1)
 
-    def bert_score(self,caption,aug,bsz):
+    def bert_score(self,caption,aug,bsz, chunk=16):
+        # BERTScore F1 of every (caption, aug) pair with each caption embedded once,
+        # same greedy matching as BERTScorer.score([caption], [aug]) (caption = candidate, aug = reference)
+        emb1, mask1, w1 = self.bert_score_embedd(caption)
+        emb2, mask2, w2 = self.bert_score_embedd(aug)
+        F1 = []
+        for s in range(0, emb1.shape[0], chunk): #chunks of captions bound the (chunk x n2 x len1 x len2) similarity tensor
+            sim = torch.einsum('iad,jbd->ijab', emb1[s:s+chunk], emb2)
+            sim = sim * (mask1[s:s+chunk, None, :, None] * mask2[None, :, None, :])
+            P = (sim.max(dim=3)[0] * w1[s:s+chunk, None, :]).sum(-1)
+            R = (sim.max(dim=2)[0] * w2[None, :, :]).sum(-1)
+            F1.append(2 * P * R / (P + R))
+        F1 = torch.cat(F1, dim=0).cpu()
+        F1 = F1.masked_fill(torch.isnan(F1), 0.)
+        if self.scorer.rescale_with_baseline:
+            F1 = (F1 - self.scorer.baseline_vals[2]) / (1 - self.scorer.baseline_vals[2])
+
+        n1, n2 = F1.shape
         mask = torch.zeros(bsz, bsz, dtype=torch.float)
-        for c1 in range(len(caption)):
-            for c2 in range(len(aug)):
-                if c1 != c2:
-                    mask[c1,c2] = self.calc_bert_score(caption[c1],aug[c2])
-                else:
-                    mask[c1,c2] = 1.0
+        mask[:n1, :n2] = F1.float()
+        diag = torch.arange(min(n1, n2))
+        mask[diag, diag] = 1.0
         return mask
 
+    def bert_score_embedd(self, docs):
+        # normalized token embeddings of the BERTScorer model, padding mask and the
+        # (idf=False) token weights, uniform over the tokens without [CLS] and [SEP]
+        tokenizer, model = self.scorer._tokenizer, self.scorer._model
+        ids, lens, mask = padding([sent_encode(tokenizer, d) for d in docs], tokenizer.pad_token_id, dtype=torch.long)
+        ids, mask = ids.to(self.scorer.device), mask.to(self.scorer.device)
+        model.eval()
+        with torch.no_grad():
+            emb = model(ids, attention_mask=mask)[0]
+        emb = emb / torch.norm(emb, dim=-1).unsqueeze(-1)
+        weights = mask.float()
+        weights[:, 0] = 0.
+        weights[torch.arange(len(docs)), lens.to(weights.device) - 1] = 0.
+        weights = weights / weights.sum(dim=1, keepdim=True)
+        return emb, mask.float(), weights
+
     def calc_bert_score(self,doc1, doc2):
         _,_, F1 = self.scorer.score([doc1], [doc2]) #P, R, F1
         return F1.item()
 
+    def stored_sim(self,idx1,idx2,bsz):
+        # gather the normalized embeddings of both views and one matmul gives the cosine similarities
+        emb1 = torch.from_numpy(self.caption_embeddings[np.asarray(idx1)].astype(np.float32)).to(self.device)
+        emb2 = torch.from_numpy(self.caption_embeddings[np.asarray(idx2)].astype(np.float32)).to(self.device)
+        return torch.mm(emb1, emb2.transpose(0, 1)).fill_diagonal_(1)
+
     def forward(self,doc1,doc2,bsz):
-        if self.similarity == 'cosine':
+        if self.caption_embeddings is not None:
+            return self.stored_sim(doc1,doc2,bsz)
+        elif self.similarity == 'cosine':
             return self.bert_embedd(doc1,doc2,bsz)
         elif self.similarity == 'jaccard':
             return self.jaccard(doc1,doc2,bsz)
@@ -211,7 +299,13 @@ class ROCO_SupCon(Dataset):
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
 
         self.clinicalbert = None
-        
+
+        self.emb_rows = None
+        if getattr(args, 'caption_embeddings', None):
+            _, meta = load_caption_embeddings(args.caption_embeddings)
+            row = {id: r for r, id in enumerate(meta['ids'])}
+            self.emb_rows = np.array([row[str(id)] for id in self.df[:, 0]])
+            self.emb_n_rows = len(meta['ids'])
         
     def __len__(self):
         return len(self.df)
@@ -228,19 +322,25 @@ class ROCO_SupCon(Dataset):
         caption = self.df[idx, 2].strip()       
         tokens, segment_ids, input_mask, targets = encode_text(caption, self.tokenizer, self.keys, self.args, self.clinicalbert)
 
-        aug_caption = self.get_translation(idx)    #self.translate_caption(caption)
+        aug_col = random.randint(3,5)
+        aug_caption = self.get_translation(idx, aug_col)    #self.translate_caption(caption)
         aug_tokens, _, _, aug_targets = encode_text(aug_caption, self.tokenizer, self.keys, self.args, self.clinicalbert)
         
+        if self.emb_rows is not None:
+            # row indices in the caption embeddings store instead of the texts, column 2 (caption) is the first block
+            caption = self.emb_rows[idx]
+            aug_caption = (aug_col - 2) * self.emb_n_rows + self.emb_rows[idx]
 
         return img, tokens, aug_tokens, segment_ids, input_mask, targets, aug_targets, caption, aug_caption
 
-    def get_translation(self, idx):
+    def get_translation(self, idx, i=None):
         #get translation from table in columns from 3 to 5 inclusive
 
         # table columns
         # 0     1        2    3  4  5
         # id img_name caption fr de es
-        i = random.randint(3,5)
+        if i is None:
+            i = random.randint(3,5)
         return self.df[idx, i].strip()  
         
     def translate_caption(self, caption):
@@ -256,12 +356,46 @@ def process_tensors(img,caption_token,aug_tokens,segment_ids,attention_mask,targ
     return cat_tensors(img[0],img[1]),cat_tensors(caption_token,aug_tokens),cat_tensors(segment_ids,segment_ids),cat_tensors(attention_mask,attention_mask),cat_tensors(target,aug_targets)
 
 
+caption_ids = {}
+def get_caption_ids(captions):
+    # ids of the captions, positives for the memory bank (already row indices with --caption_embeddings)
+    if torch.is_tensor(captions):
+        return captions.long()
+    return torch.tensor([caption_ids.setdefault(c, len(caption_ids)) for c in captions], dtype=torch.long)
+
+def compute_supcon(supcon_loss, feat, mask, caption_text):
+    if isinstance(supcon_loss, SupConMemoryBankLoss):
+        return supcon_loss(feat, ids=get_caption_ids(caption_text))
+    return supcon_loss(feat)#supcon_loss(features, mask=mask)
+
 def split_feat(feat,bsz):
     f1, f2 = torch.split(feat, [bsz, bsz], dim=0) # (bs//2 x feat_dim), (bs//2 x feat_dim)
     return torch.cat([f1.unsqueeze(1), f2.unsqueeze(1)], dim=1) # (bs//2, 2, feat_dim) 
 
+class RandContext:
+    """Snapshot of the cpu/gpu rng states, so that a chunk can be re-run with the same dropout masks"""
+    def __init__(self, *tensors):
+        self.fwd_cpu_state = torch.get_rng_state()
+        self.fwd_gpu_devices, self.fwd_gpu_states = get_device_states(*tensors)
+
+    def __enter__(self):
+        self._fork = torch.random.fork_rng(devices=self.fwd_gpu_devices, enabled=True)
+        self._fork.__enter__()
+        torch.set_rng_state(self.fwd_cpu_state)
+        set_device_states(self.fwd_gpu_devices, self.fwd_gpu_states)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._fork.__exit__(exc_type, exc_val, exc_tb)
+        self._fork = None
+
+def get_chunks(n, chunk_size):
+    return [slice(s, min(s + chunk_size, n)) for s in range(0, n, chunk_size)]
+
 def train_one_epoch(loader, model, criterion, supcon_loss, optimizer, device, args, epoch, sim_calculator):
 
+    if getattr(args, 'grad_cache', False):
+        return train_one_epoch_grad_cache(loader, model, criterion, supcon_loss, optimizer, device, args, epoch, sim_calculator)
+
     model.train()
     train_loss = []
     PREDS = []
@@ -284,7 +418,7 @@ def train_one_epoch(loader, model, criterion, supcon_loss, optimizer, device, ar
         bsz = img.shape[0] //2 #2 = n_views
         feat = split_feat(feat,bsz) 
         mask = buildMask(bsz,caption_text, aug_text, args, sim_calculator) #mask=None if simclr else mask built with [jaccard,cosine,sentence_transformers] similarity for supcon
-        loss_supcon = supcon_loss(feat)#supcon_loss(features, mask=mask)
+        loss_supcon = compute_supcon(supcon_loss, feat, mask, caption_text)
 
         loss = loss + loss_supcon
 
@@ -323,6 +457,93 @@ def train_one_epoch(loader, model, criterion, supcon_loss, optimizer, device, ar
     return np.mean(train_loss), total_acc
 
 
+def train_one_epoch_grad_cache(loader, model, criterion, supcon_loss, optimizer, device, args, epoch, sim_calculator):
+    """Gradient cache (https://arxiv.org/abs/2101.06983) version of train_one_epoch.
+    The loader batch is the logical batch, the model only sees args.gc_chunk_size samples at a time:
+    1. the features of every chunk are computed without graph
+    2. the supcon loss is computed on the full feature matrix and its gradient w.r.t. the features is cached
+    3. each chunk is re-run with grad (same rng state), and the cached feature gradient plus the
+       chunk share of the MLM loss are backpropagated, accumulating the gradients of both terms
+    Note: batchnorm running stats of the cnn see every chunk twice per step."""
+
+    model.train()
+    train_loss = []
+    PREDS = []
+    TARGETS = []
+    bar = tqdm(loader, leave=False)
+    for i, (img, caption_token,aug_tokens,segment_ids,attention_mask,target,aug_targets,caption_text,aug_text) in enumerate(bar):
+        img,caption_token,segment_ids,attention_mask,target = process_tensors(img,caption_token,aug_tokens,segment_ids,attention_mask,target,aug_targets)
+        img, caption_token,segment_ids,attention_mask,target = img.to(device), caption_token.to(device), segment_ids.to(device), attention_mask.to(device), target.to(device)
+
+        caption_token = caption_token.squeeze(1)
+        attention_mask = attention_mask.squeeze(1)
+
+        loss_func = criterion
+        optimizer.zero_grad()
+
+        n = img.shape[0]
+        bsz = n //2 #2 = n_views
+        chunks = get_chunks(n, args.gc_chunk_size)
+
+        # 1. features of the whole logical batch, chunk by chunk and without graph
+        rand_states = []
+        feats = []
+        with torch.no_grad():
+            for c in chunks:
+                rand_states.append(RandContext(img[c], caption_token[c]))
+                _, feat = model(img[c], caption_token[c], segment_ids[c], attention_mask[c])
+                feats.append(feat)
+
+        # 2. supcon loss on the full feature matrix, keep the gradient w.r.t. the features
+        feat = torch.cat(feats, dim=0).detach().requires_grad_()
+        mask = buildMask(bsz,caption_text, aug_text, args, sim_calculator) #mask=None if simclr else mask built with [jaccard,cosine,sentence_transformers] similarity for supcon
+        loss_supcon = compute_supcon(supcon_loss, split_feat(feat,bsz), mask, caption_text)
+        loss_supcon.backward()
+        feat_grads = feat.grad.split([c.stop - c.start for c in chunks], dim=0)
+
+        # 3. re-run each chunk with graph and backpropagate the cached gradients + the MLM loss share
+        loss_mlm = 0.0
+        step_preds, step_targets = [], []
+        for c, rand_state, feat_grad in zip(chunks, rand_states, feat_grads):
+            with rand_state:
+                logits, feat_c = model(img[c], caption_token[c], segment_ids[c], attention_mask[c]) # (chunk x seq_len x vocab_size) , (chunk x feat_dim)
+            logits = logits.log_softmax(-1)  # (chunk x seq_len x vocab_size)
+            # every sample has max_position_embeddings tokens, so weighting by the chunk share gives the batch mean
+            loss_chunk = loss_func(logits.permute(0,2,1), target[c]) * (c.stop - c.start) / n
+            surrogate = loss_chunk + torch.dot(feat_c.flatten(), feat_grad.flatten())
+            surrogate.backward()
+            loss_mlm += loss_chunk.detach()
+
+            bool_label = target[c] > 0
+            if bool_label.any():
+                step_preds.append(logits[bool_label, :].argmax(1).detach())
+                step_targets.append(target[c][bool_label])
+
+        optimizer.step()
+
+        loss = loss_mlm + loss_supcon.detach()
+
+        acc = 0.0
+        if step_preds:
+            pred, valid_labels = torch.cat(step_preds), torch.cat(step_targets)
+            PREDS.append(pred)
+            TARGETS.append(valid_labels)
+            acc = (pred == valid_labels).type(torch.float).mean() * 100.
+
+        loss_np = loss.detach().cpu().numpy()
+        train_loss.append(loss_np)
+
+        bar.set_description('train_loss: %.5f, train_acc: %.2f' % (loss_np, acc))
+
+    PREDS = torch.cat(PREDS).cpu().numpy()
+    TARGETS = torch.cat(TARGETS).cpu().numpy()
+
+    # Calculate total accuracy
+    total_acc = (PREDS == TARGETS).mean() * 100.
+
+    return np.mean(train_loss), total_acc
+
+
 def validate(loader, model,criterion, scaler, device, args, epoch):
 
     model.eval()
@@ -0,0 +1,61 @@
+import torch
+from torch.utils.checkpoint import checkpoint
+
+# activation checkpointing (recompute-on-backward) helpers
+# --checkpoint_activations: which parts of the model are checkpointed ('none', 'backbone', 'encoder', 'all')
+# --checkpoint_every: number of consecutive backbone stages / encoder blocks in each recomputed segment
+# non-reentrant checkpoints: the image input does not require grad, a reentrant segment would return outputs
+# without grad and the weights of the checkpointed backbone stages would silently not be trained
+
+def get_checkpoint_config(args, part):
+    mode = args.checkpoint_activations if hasattr(args, 'checkpoint_activations') else 'none'
+    every = args.checkpoint_every if hasattr(args, 'checkpoint_every') else 1
+    enabled = mode == 'all' or mode == part
+    return enabled, max(1, every)
+
+def use_checkpoint(enabled, module):
+    # recomputation only makes sense when a graph is being built
+    return enabled and module.training and torch.is_grad_enabled()
+
+def run_stages(stages, x, out_idx, every, enabled):
+    '''run `stages` in order and return the outputs of the stages whose index is in `out_idx`.
+    With `enabled`, consecutive groups of `every` stages are run as one checkpointed segment,
+    so only the segment inputs and the requested outputs are kept for the backward pass'''
+    features = []
+    if not enabled:
+        for i, stage in enumerate(stages):
+            x = stage(x)
+            if i in out_idx:
+                features.append(x)
+        return features
+
+    for start in range(0, len(stages), every):
+        end = min(start + every, len(stages))
+
+        def segment(x, start=start, end=end):
+            outs = []
+            for i in range(start, end):
+                x = stages[i](x)
+                if i in out_idx:
+                    outs.append(x)
+            return (*outs, x)
+
+        *outs, x = checkpoint(segment, x, use_reentrant=False)
+        features.extend(outs)
+    return features
+
+def run_blocks(blocks, states, every, enabled):
+    '''run the encoder `blocks` in order, each block is a callable mapping the tuple of
+    tensors `states` (e.g. (h,) or (h, prev)) to the next tuple of states'''
+    if not enabled:
+        for block in blocks:
+            states = block(*states)
+        return states
+
+    for start in range(0, len(blocks), every):
+        def segment(*states, start=start):
+            for block in blocks[start:start + every]:
+                states = block(*states)
+            return states
+        states = checkpoint(segment, *states, use_reentrant=False)
+    return states
@@ -0,0 +1,65 @@
+import copy
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+
+from models.mmbert import FeedBackTransformer
+
+# ensemble of VQA-Med models kept on the device. Members with the same architecture (same parameter and buffer
+# names and shapes) are stacked with torch.func.stack_module_state and evaluated in one vmapped call, the
+# batch (images, tokens, masks) is shared by all members and the logits are averaged on the device.
+# The feedback transformer truncates its input with a data dependent nonzero, its members run one by one
+
+def architecture(model):
+    return tuple((k, tuple(v.shape)) for k, v in list(model.named_parameters()) + list(model.named_buffers()))
+
+class StackedModels(nn.Module):
+    '''members of the same architecture as one vmapped model, returns the (n_members, b, classes) logits'''
+    def __init__(self, models):
+        super().__init__()
+        params, buffers = stack_module_state(models)
+        # the stacked tensors are the only copy of the weights: the members are moved to meta (they can not be
+        # run afterwards, the caller's references only keep their structure), the base model provides the forward
+        for m in models:
+            m.to('meta')
+        self.params = nn.ParameterDict({k.replace('.', '__'): nn.Parameter(v.detach(), requires_grad=False) for k, v in params.items()})
+        for k, v in buffers.items():
+            self.register_buffer(k.replace('.', '__'), v)
+        self.param_names = list(params)
+        self.buffer_names = list(buffers)
+        base = copy.deepcopy(models[0]).to('meta')
+        self.base = [base] # not registered, its (meta) weights are not part of the state dict
+        self.n = len(models)
+
+        def call(params, buffers, img, input_ids, segment_ids, input_mask):
+            return functional_call(base, (params, buffers), (img, input_ids, segment_ids, input_mask))[0]
+        self.call = vmap(call, in_dims=(0, 0, None, None, None, None))
+
+    def forward(self, img, input_ids, segment_ids, input_mask):
+        params = {k: self.params[k.replace('.', '__')] for k in self.param_names}
+        buffers = {k: getattr(self, k.replace('.', '__')) for k in self.buffer_names}
+        return self.call(params, buffers, img, input_ids, segment_ids, input_mask)
+
+class Ensemble(nn.Module):
+    def __init__(self, models, use_vmap=True):
+        super().__init__()
+        groups = OrderedDict()
+        for m in models:
+            m.eval()
+            vmappable = use_vmap and not isinstance(m.transformer, FeedBackTransformer)
+            groups.setdefault(architecture(m) if vmappable else id(m), []).append(m)
+        self.members = nn.ModuleList([StackedModels(g) if len(g) > 1 else g[0] for g in groups.values()])
+        self.n = len(models)
+        print('ensemble of', self.n, 'models in', len(self.members), 'groups')
+
+    def forward(self, img, input_ids, segment_ids, input_mask):
+        # mean logits of the members, (b, classes)
+        total = 0
+        for m in self.members:
+            if isinstance(m, StackedModels):
+                total = total + m(img, input_ids, segment_ids, input_mask).sum(0)
+            else:
+                total = total + m(img, input_ids, segment_ids, input_mask)[0]
+        return total / self.n
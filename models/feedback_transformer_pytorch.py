@@ -30,6 +30,56 @@ def safe_cat(arr, el, dim = 1):
         return el
     return torch.cat((arr, el), dim = dim)
 
+# memory
+
+class CatMemory():
+    # memory key / values as growing tensors, the last mem_len are kept (needed when autograd records the graph)
+    def __init__(self, mem_len):
+        self.mem_len = mem_len
+        self.keys = None
+        self.values = None
+
+    def append(self, k, v):
+        self.keys = safe_cat(self.keys, k, dim = 1)[:, -self.mem_len:]
+        self.values = safe_cat(self.values, v, dim = 1)[:, -self.mem_len:]
+
+    def get(self):
+        if not exists(self.keys):
+            return None
+        return Memory(self.keys, self.values)
+
+class RingMemory():
+    # preallocated FIFO of the last mem_len memory key / values, written in place. Every entry is written
+    # twice (slot and slot + mem_len), so the window of the last entries is always a contiguous, ordered
+    # slice of the buffer. In-place writes are only possible when autograd is not recording
+    def __init__(self, mem_len, b, dim, dtype, device):
+        self.mem_len = mem_len
+        self.keys = torch.empty(b, 2 * mem_len, dim, dtype = dtype, device = device)
+        self.values = torch.empty_like(self.keys)
+        self.count = 0
+
+    def write(self, buf, x):
+        start = self.count % self.mem_len
+        first = min(x.shape[1], self.mem_len - start)
+        for offset in (0, self.mem_len):
+            buf[:, offset + start:offset + start + first] = x[:, :first]
+            buf[:, offset:offset + x.shape[1] - first] = x[:, first:]
+
+    def append(self, k, v):
+        if k.shape[1] > self.mem_len:
+            self.count += k.shape[1] - self.mem_len
+            k, v = k[:, -self.mem_len:], v[:, -self.mem_len:]
+        self.write(self.keys, k)
+        self.write(self.values, v)
+        self.count += k.shape[1]
+
+    def get(self):
+        if self.count == 0:
+            return None
+        n = min(self.count, self.mem_len)
+        start = (self.count - n) % self.mem_len
+        return Memory(self.keys[:, start:start + n], self.values[:, start:start + n])
+
 # positional embedding
 
 class RelativePositionBias(nn.Module):
@@ -45,6 +95,7 @@ class RelativePositionBias(nn.Module):
         self.num_buckets = num_buckets
         self.max_distance = max_distance
         self.relative_attention_bias = nn.Embedding(num_buckets, heads)
+        self.buckets = {} # (i, j, device) -> bucket indices, they only depend on the shape
 
     @staticmethod
     def _relative_position_bucket(relative_position, causal = True, num_buckets = 32, max_distance = 128):
@@ -68,12 +119,18 @@ class RelativePositionBias(nn.Module):
         ret += torch.where(is_small, n, val_if_large)
         return ret
 
+    def get_buckets(self, i, j, device):
+        key = (i, j, device)
+        if key not in self.buckets:
+            q_pos = torch.arange(i, dtype = torch.long, device = device)
+            k_pos = torch.arange(j, dtype = torch.long, device = device)
+            rel_pos = k_pos[None, :] - q_pos[:, None]
+            self.buckets[key] = self._relative_position_bucket(rel_pos, causal = self.causal, num_buckets = self.num_buckets, max_distance = self.max_distance)
+        return self.buckets[key]
+
     def forward(self, qk_dots):
         i, j, device = *qk_dots.shape[-2:], qk_dots.device
-        q_pos = torch.arange(i, dtype = torch.long, device = device)
-        k_pos = torch.arange(j, dtype = torch.long, device = device)
-        rel_pos = k_pos[None, :] - q_pos[:, None]
-        rp_bucket = self._relative_position_bucket(rel_pos, causal = self.causal, num_buckets = self.num_buckets, max_distance = self.max_distance)
+        rp_bucket = self.get_buckets(i, j, device)
         values = self.relative_attention_bias(rp_bucket)
         bias = rearrange(values, 'i j h -> () h i j')
         return bias
@@ -208,11 +265,13 @@ class FeedbackTransformer(nn.Module):
         attn_dropout = 0.,
         ff_dropout = 0.,
         keep_last_hidden = False,
-        to_logits_bool = False
+        to_logits_bool = False,
+        ring_memory = True
     ):
         super().__init__()
         self.seq_len = seq_len
         self.mem_len = mem_len
+        self.ring_memory = ring_memory
 
         self.token_emb = nn.Embedding(num_tokens, dim)
         self.pos_emb = RelativePositionBias(causal = True, heads = heads)
@@ -254,16 +313,27 @@ class FeedbackTransformer(nn.Module):
             nn.Linear(dim, num_tokens)
         )
 
-    def forward(self, x, memory = None, return_memory = False):
+    def forward(self, x, memory = None, return_memory = False, mask = None):
         b, n, d, device = *x.shape, x.device
 
         #x = self.token_emb(x)
 
-        memory_keys = None
-        memory_values = None
+        # the model is causal, so the trailing positions that are padding in every sequence of the batch
+        # do not change the other outputs: stop once all sequences ended and pad the outputs back to n
+        if exists(mask):
+            valid = mask.bool().any(dim = 0).nonzero()
+            n_valid = int(valid.max()) + 1 if len(valid) > 0 else 1
+            x = x[:, :n_valid]
+
+        # the ring buffer is written in place, so it is only used when no graph is recorded
+        if self.ring_memory and not torch.is_grad_enabled():
+            inner_dim = self.shared_kv_proj.out_features // 2
+            mem = RingMemory(self.mem_len, b, inner_dim, x.dtype, device)
+        else:
+            mem = CatMemory(self.mem_len)
 
         if exists(memory):
-            memory_keys, memory_values = memory
+            mem.append(*memory)
 
         outputs = []
 
@@ -277,9 +347,7 @@ class FeedbackTransformer(nn.Module):
 
             # prepare memory for attention, if it exists
 
-            memory = None
-            if exists(memory_keys):
-                memory = (memory_keys, memory_values)
+            memory = mem.get()
 
             for attn, ff in self.layers:
 
@@ -298,18 +366,14 @@ class FeedbackTransformer(nn.Module):
                 hiddens = torch.stack(hiddens)
                 agg_hiddens = (hiddens * layer_weight).sum(dim = 0)
 
-            # pre-calculate memory key / values and store to buffer
+            # pre-calculate memory key / values and store to buffer (max length mem_len)
 
             mem_k, mem_v = self.shared_kv_proj(agg_hiddens).chunk(2, dim = -1)
-            memory_keys = safe_cat(memory_keys, mem_k, dim = 1)
-            memory_values = safe_cat(memory_values, mem_v, dim = 1)
-
-            # enforce max length on memory buffer
-
-            memory_keys = memory_keys[:, -self.mem_len:]
-            memory_values = memory_values[:, -self.mem_len:]
+            mem.append(mem_k, mem_v)
 
         x = torch.cat((outputs), dim = 1)
+        if x.shape[1] < n:
+            x = F.pad(x, (0, 0, 0, n - x.shape[1]))
 
         if self.to_logits_bool:
             out = self.to_logits(x)
@@ -319,4 +383,4 @@ class FeedbackTransformer(nn.Module):
         if not return_memory:
             return out
 
-        return out, Memory(memory_keys, memory_values)
+        return out, mem.get()
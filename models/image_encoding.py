@@ -5,6 +5,7 @@ from transformers import AutoTokenizer, AutoModel
 from torchvision import models
 import timm
 from models.serf import SERF
+from models.checkpointing import get_checkpoint_config, use_checkpoint, run_stages
 
 # dictionary storing the models to use and the channel_size to be used to retrieve the image tokens
 # first key: num_viz 
@@ -18,14 +19,23 @@ models_dict = {5:   {'resnet152':[models.resnet152, [2048,1024,512,256,64]],
                7:   {'tf_efficientnetv2_m':[timm.create_model,[24,48,80,160,176,304,512]]}
               }
 def get_image_encoder(args):
+    # no imagenet download when the whole model comes from a checkpoint
+    pretrained = not (args.init_from_config if hasattr(args, 'init_from_config') else False)
+    if args.cnn_encoder not in models_dict.get(args.num_vis, {}):
+        # other timm backbones (e.g. the small encoder of a distilled student), channels of their 5 feature levels
+        m = timm.create_model(args.cnn_encoder, features_only=True, pretrained=pretrained)
+        return m, m.feature_info.channels()
     m, channel_size = models_dict[args.num_vis][args.cnn_encoder]
     if 'resnet' in args.cnn_encoder:
-        return m(pretrained=True), channel_size
+        return m(pretrained=pretrained), channel_size
     elif 'efficientnetv2' in args.cnn_encoder:
         #return m(args.cnn_encoder, pretrained=True), channel_size
-        return m(args.cnn_encoder, features_only=True,pretrained=True), channel_size
+        return m(args.cnn_encoder, features_only=True,pretrained=pretrained), channel_size
 
 def get_transfer(args):
+    if args.cnn_encoder not in models_dict.get(args.num_vis, {}) and args.num_vis == 5:
+        print('Using timm feature extraction', args.cnn_encoder)
+        return Timm_EFfNetV2(args)
     if 'resnet' in args.cnn_encoder:
         print('Using resnet', args.cnn_encoder)
         return ResNetTransfer(args)
@@ -46,6 +56,7 @@ class Transfer(nn.Module):
 
         self.args = args
         self.model, self.channel_size = get_image_encoder(args)
+        self.checkpoint, self.checkpoint_every = get_checkpoint_config(args, 'backbone')
         #self.model = models.resnet152(pretrained=True)
         # for p in self.parameters():
         #     p.requires_grad=False
@@ -69,6 +80,8 @@ class ResNetTransfer(Transfer):
         print('resnet ' + 'relu' if args.use_relu else 'serf')
 
     def forward(self, img):
+        if use_checkpoint(self.checkpoint, self):
+            return self.forward_checkpoint(img)
         modules2 = list(self.model.children())[:-2]
         fix2 = nn.Sequential(*modules2)
         v_2 = self.gap2(self.activation(self.conv2(fix2(img)))).view(-1,self.args.hidden_size)
@@ -86,6 +99,19 @@ class ResNetTransfer(Transfer):
         v_7 = self.gap7(self.activation(self.conv7(fix7(img)))).view(-1,self.args.hidden_size)
         return v_2, v_3, v_4, v_5, v_7
 
+    def forward_checkpoint(self, img):
+        # the resnet trunk runs once in recomputed segments of stages, the
+        # outputs of every stage are the inputs of the fix7..fix2 tokens above
+        c = list(self.model.children())
+        stages = [nn.Sequential(*c[:3]), nn.Sequential(*c[3:5]), c[5], c[6], c[7]]
+        f_7, f_5, f_4, f_3, f_2 = run_stages(stages, img, set(range(len(stages))), self.checkpoint_every, True)
+        v_2 = self.gap2(self.activation(self.conv2(f_2))).view(-1,self.args.hidden_size)
+        v_3 = self.gap3(self.activation(self.conv3(f_3))).view(-1,self.args.hidden_size)
+        v_4 = self.gap4(self.activation(self.conv4(f_4))).view(-1,self.args.hidden_size)
+        v_5 = self.gap5(self.activation(self.conv5(f_5))).view(-1,self.args.hidden_size)
+        v_7 = self.gap7(self.activation(self.conv7(f_7))).view(-1,self.args.hidden_size)
+        return v_2, v_3, v_4, v_5, v_7
+
 class Timm_EFfNetV2(Transfer):
     def __init__(self, args):
         super().__init__(args)
@@ -98,7 +124,7 @@ class Timm_EFfNetV2(Transfer):
         
 
     def forward(self, img):
-        o = self.model(img)
+        o = self.backbone_features(img)
         #v_0 = self.gap2(self.serf(F.normalize(self.conv2(o[0]),dim=1))).view(-1,self.args.hidden_size)
         v_0 = self.gap2(self.activation(self.conv2(o[0]))).view(-1,self.args.hidden_size)
         v_1 = self.gap3(self.activation(self.conv3(o[1]))).view(-1,self.args.hidden_size)
@@ -110,11 +136,25 @@ class Timm_EFfNetV2(Transfer):
             h = o[4].register_hook(self.activations_hook)
             self.feat = o[4]
 
-        v_4 = self.gap7(self.activation(self.conv7(o[4]))).view(-1,self.args.hidden_size)
+        v_4 = self.last_token(o[4])
         #import IPython; IPython.embed(); import sys; sys.exit(0)
         return v_0, v_1, v_2, v_3, v_4
         #return F.normalize(v_0, dim=1),  F.normalize(v_1, dim=1), F.normalize(v_2, dim=1), F.normalize(v_3, dim=1), F.normalize(v_4, dim=1)
 
+    def last_token(self, feat):
+        # token of the last stage (the Grad-CAM target layer), also used alone by vqamed2019/cam_engine.py
+        return self.gap7(self.activation(self.conv7(feat))).view(-1,self.args.hidden_size)
+
+    def backbone_features(self, img):
+        if not use_checkpoint(self.checkpoint, self):
+            return self.model(img)
+        # same as timm's EfficientNetFeatures.forward: stage 0 is the stem and stage i the
+        # output of blocks[i-1], run in recomputed segments of checkpoint_every stages
+        m = self.model
+        stem = [m.conv_stem, m.bn1] + ([m.act1] if hasattr(m, 'act1') else [])
+        stages = [nn.Sequential(*stem)] + list(m.blocks)
+        return run_stages(stages, img, set(m._stage_out_idx), self.checkpoint_every, True)
+
     ### grad methods ###
     def activations_hook(self, grad):
         self.gradients = grad
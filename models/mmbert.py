@@ -3,9 +3,12 @@ from models.feedback_transformer_pytorch import FeedbackTransformer
 from models.realformer import ResEncoderBlock
 from models.image_encoding import get_transfer
 from models.serf import SERF
+from models.checkpointing import get_checkpoint_config, use_checkpoint, run_blocks
 import torch
 import torch.nn as nn
-from transformers import AutoTokenizer, AutoModel
+from models.safetensors_utils import load_prefix
+from transformers import AutoTokenizer, AutoModel, AutoConfig, BertConfig
+from transformers.models.bert.modeling_bert import BertEmbeddings
 from torchvision import models
 import math
 import numpy as np
@@ -26,6 +29,46 @@ def get_bert_model(args):
         bert_name = 'bert-base-uncased'
     return bert_name
 
+def init_from_config(args):
+    # build the model without downloading pretrained weights (a full checkpoint is loaded afterwards)
+    return args.init_from_config if hasattr(args, 'init_from_config') else False
+
+def load_bert_embedding(args, bert_name):
+    # only the embeddings module of bert. With --bert_embeddings (a local safetensors file, e.g. the
+    # model.safetensors of the hub cache) the config comes from the tensor shapes and the weights are
+    # read by key from the memory-mapped file, otherwise they are left to the checkpoint loaded afterwards
+    path = args.bert_embeddings if hasattr(args, 'bert_embeddings') else None
+    if path is None:
+        return BertEmbeddings(AutoConfig.from_pretrained(bert_name))
+
+    state_dict = load_prefix(path, ['bert.embeddings.', 'embeddings.'])
+    assert 'word_embeddings.weight' in state_dict, f'no bert embeddings in {path}'
+    # checkpoints converted from tensorflow name the LayerNorm parameters gamma/beta
+    state_dict = {k.replace('LayerNorm.gamma', 'LayerNorm.weight').replace('LayerNorm.beta', 'LayerNorm.bias'): v for k, v in state_dict.items()}
+    vocab_size, hidden_size = state_dict['word_embeddings.weight'].shape
+    config = BertConfig(vocab_size=vocab_size, hidden_size=hidden_size,
+                        max_position_embeddings=state_dict['position_embeddings.weight'].shape[0],
+                        type_vocab_size=state_dict['token_type_embeddings.weight'].shape[0])
+    embedding = BertEmbeddings(config)
+    missing, unexpected = embedding.load_state_dict(state_dict, strict=False)
+    print('Loaded bert embeddings from', path, 'missing', missing, 'unexpected', unexpected)
+    return embedding
+
+def narrow_bert_embedding(embedding, hidden_size):
+    # embeddings of a narrower model (e.g. a distilled student): the pretrained word, position and token type
+    # embeddings projected on the top hidden_size principal directions of the word embeddings
+    w = embedding.word_embeddings.weight.detach()
+    _, _, v = torch.pca_lowrank(w, q=hidden_size)
+    config = BertConfig(vocab_size=w.shape[0], hidden_size=hidden_size,
+                        max_position_embeddings=embedding.position_embeddings.num_embeddings,
+                        type_vocab_size=embedding.token_type_embeddings.num_embeddings)
+    narrow = BertEmbeddings(config)
+    with torch.no_grad():
+        for name in ['word_embeddings', 'position_embeddings', 'token_type_embeddings']:
+            getattr(narrow, name).weight.copy_(getattr(embedding, name).weight @ v)
+    print('Projected bert embeddings to', hidden_size)
+    return narrow
+
 def get_transformer_model(args):
     if 'feedback-transformer' in args.transformer_model:
         print('Using Feedback Transformer')
@@ -48,12 +91,19 @@ class TransformerAbstract(nn.Module):
 
         self.bert_embedding = self.get_bert_embedding(args)
         self.trans = get_transfer(args)
+        self.checkpoint, self.checkpoint_every = get_checkpoint_config(args, 'encoder')
 
     def get_bert_embedding(self,args):
         bert_name = get_bert_model(args)
-        base_model = AutoModel.from_pretrained(bert_name)
-        bert_model = nn.Sequential(*list(base_model.children())[0:])
-        return bert_model[0]
+        if init_from_config(args):
+            embedding = load_bert_embedding(args, bert_name)
+        else:
+            base_model = AutoModel.from_pretrained(bert_name)
+            bert_model = nn.Sequential(*list(base_model.children())[0:])
+            embedding = bert_model[0]
+        if args.hidden_size < embedding.word_embeddings.embedding_dim:
+            embedding = narrow_bert_embedding(embedding, args.hidden_size)
+        return embedding
 
     # encode images with cnn and embedd the text tokens and prepare
     # to feed to the transformer
@@ -66,6 +116,18 @@ class TransformerAbstract(nn.Module):
                 h[i][n] = v[i]
         return h
 
+    # the encoders with a layer(i, state, mask) step (Transformer, RealFormer) can be run one layer at a time,
+    # for the early exit heads of Model
+    def hidden_states(self, h, mask):
+        '''output of every encoder layer, checkpointed layer by layer with --checkpoint_activations'''
+        state = self.init_state(h)
+        enabled = use_checkpoint(self.checkpoint, self)
+        out = []
+        for i in range(self.n_layers):
+            state = run_blocks([lambda *state, i=i: self.layer(i, state, mask)], state, 1, enabled)
+            out.append(state[0])
+        return out
+
 
         # v_2, v_3, v_4, v_5, v_7 = self.trans(img)
         # for i in range(len(h)):
@@ -87,12 +149,30 @@ class Transformer(TransformerAbstract):
         self.blocks = BertLayer(args,share='none', norm='pre')
         self.n_layers = args.n_layers
 
-    def forward(self, img, input_ids, token_type_ids, mask):
+    def forward(self, img, input_ids, token_type_ids, mask, output_attentions=False):
         h = self.prepare_input(img, input_ids, token_type_ids, mask)
-        for i in range(self.n_layers):
-            h = self.blocks(h, mask, i)
+        return self.encode(h, mask, output_attentions)
+
+    def encode(self, h, mask, output_attentions=False):
+        # encoder blocks on the prepared input
+        if output_attentions:
+            # (b, heads, t, t) attention probabilities of every layer, kept by MultiHeadedSelfAttention.scores
+            attentions = []
+            for i in range(self.n_layers):
+                h = self.blocks(h, mask, i)
+                att = self.blocks.attention
+                attentions.append((att[i] if isinstance(att, nn.ModuleList) else att).scores)
+            return h, attentions
+        blocks = [lambda *state, i=i: self.layer(i, state, mask) for i in range(self.n_layers)]
+        h, = run_blocks(blocks, self.init_state(h), self.checkpoint_every, use_checkpoint(self.checkpoint, self))
         return h
 
+    def init_state(self, h):
+        return (h,)
+
+    def layer(self, i, state, mask):
+        return (self.blocks(state[0], mask, i),)
+
 class RealFormer(TransformerAbstract):
     def __init__(self, args):
         super().__init__(args)
@@ -100,13 +180,31 @@ class RealFormer(TransformerAbstract):
         head_cnt = 8
         print('RealFormer from abstract, heads', head_cnt)
         self.mains = nn.Sequential(*[ResEncoderBlock(emb_s = args.hidden_size // head_cnt, head_cnt = head_cnt, dp1 = 0.1, dp2 = 0.1) for _ in range(args.n_layers)])
-    def forward(self, img, input_ids, token_type_ids, mask):
+        self.n_layers = args.n_layers
+    def forward(self, img, input_ids, token_type_ids, mask, output_attentions=False):
         h = self.prepare_input(img, input_ids, token_type_ids, mask)
+        return self.encode(h, mask, output_attentions)
+
+    def encode(self, h, mask, output_attentions=False):
         prev = None
-        for resencoder in self.mains:
-            h, prev = resencoder(h, prev = prev, mask = mask)
+        if output_attentions:
+            # the residual scores prev of every layer, as (b, heads, t, t) attention probabilities
+            attentions = []
+            for resencoder in self.mains:
+                h, prev = resencoder(h, prev = prev, mask = mask)
+                attentions.append(F.softmax(prev, dim = 2).permute(0, 3, 1, 2))
+            return h, attentions
+        blocks = [lambda *state, i=i: self.layer(i, state, mask) for i in range(self.n_layers)]
+        h, prev = run_blocks(blocks, self.init_state(h), self.checkpoint_every, use_checkpoint(self.checkpoint, self))
         return h
 
+    def init_state(self, h):
+        return (h, None)
+
+    def layer(self, i, state, mask):
+        h, prev = state
+        return self.mains[i](h, prev = prev, mask = mask)
+
 class FeedBackTransformer(TransformerAbstract):
     def __init__(self, args):
         super().__init__(args)
@@ -122,9 +220,28 @@ class FeedBackTransformer(TransformerAbstract):
             ff_dropout = 0.1              # feedforward dropout
         )
 
-    def forward(self, img, input_ids, token_type_ids, mask):
+    def forward(self, img, input_ids, token_type_ids, mask, output_attentions=False):
         h = self.prepare_input(img, input_ids, token_type_ids, mask)
-        return self.block(h)
+        return self.encode(h, mask, output_attentions)
+
+    def encode(self, h, mask, output_attentions=False):
+        if output_attentions:
+            # the tokens attend to the memory of the previous steps, there is no (t, t) map to return
+            raise ValueError('attention maps are not available for the feedback transformer')
+        return self.block(h, mask = mask)
+
+class ExitHead(nn.Module):
+    '''answer head on the output of an intermediate encoder layer, same layout as the head of Model'''
+    def __init__(self, args):
+        super().__init__()
+        self.fc1 = nn.Linear(args.hidden_size, args.hidden_size)
+        self.activ1 = SERF()
+        self.classifier = nn.Sequential(nn.Linear(args.hidden_size, args.hidden_size),
+                                        nn.LayerNorm(args.hidden_size, eps=1e-12, elementwise_affine=True),
+                                        nn.Linear(args.hidden_size, args.num_classes))
+
+    def forward(self, h, input_mask):
+        return self.classifier(self.activ1(self.fc1(mean_pooling(h, input_mask))))
 
 class Model(nn.Module):
     def __init__(self,args, feat_dim=128):
@@ -140,6 +257,14 @@ class Model(nn.Module):
 
         self.supcon = args.supcon if hasattr(args, 'supcon') else False
         print('supcon task in model', self.supcon)
+
+        # --early_exit: an answer head after every encoder layer but the last one (VQA-Med), trained jointly,
+        # their logits are returned in place of the second output in training
+        self.exits = None
+        if hasattr(args, 'early_exit') and args.early_exit:
+            if not hasattr(self.transformer, 'layer'):
+                raise ValueError('early exits need the transformer or realformer encoder')
+            self.exits = nn.ModuleList([ExitHead(args) for _ in range(args.n_layers - 1)])
         if self.supcon:
             self.head = nn.Sequential(
                 nn.Linear(args.hidden_size, args.hidden_size),
@@ -147,9 +272,21 @@ class Model(nn.Module):
                 nn.Linear(args.hidden_size, feat_dim)
             )
 
-    def forward(self, img, input_ids, segment_ids, input_mask):
+    def forward(self, img, input_ids, segment_ids, input_mask, output_attentions=False):
+        # with output_attentions the per-layer (b, heads, t, t) attention maps are appended to the outputs,
+        # the encoder then runs without activation checkpointing
+        if self.exits is not None and self.training and not output_attentions:
+            hidden = self.transformer.hidden_states(self.transformer.prepare_input(img, input_ids, segment_ids, input_mask), input_mask)
+            return self.answer_logits(hidden[-1], input_mask), [e(h, input_mask) for e, h in zip(self.exits, hidden)], 0
+        h = self.transformer(img, input_ids, segment_ids, input_mask, output_attentions)
+        if output_attentions:
+            h, attentions = h
+            out = self.heads(h, input_mask)
+            return (*out, attentions) if isinstance(out, tuple) else (out, attentions)
+        return self.heads(h, input_mask)
+
+    def heads(self, h, input_mask):
         if self.dataset == 'roco':
-            h = self.transformer(img, input_ids, segment_ids, input_mask)
             if self.task == 'MLM':
                 pooled_h = self.activ1(self.fc1(h))
                 logits = self.classifier(pooled_h)
@@ -161,10 +298,38 @@ class Model(nn.Module):
             return logits
 
         elif self.dataset == 'VQA-Med':
-            h = self.transformer(img, input_ids, segment_ids, input_mask)
-            pooled_h = self.activ1(self.fc1(mean_pooling(h, input_mask)))
-            logits = self.classifier(pooled_h)
-            return logits, 0,0
+            return self.answer_logits(h, input_mask), 0,0
+
+    def answer_logits(self, h, input_mask):
+        # VQA-Med head on the encoder output
+        pooled_h = self.activ1(self.fc1(mean_pooling(h, input_mask)))
+        return self.classifier(pooled_h)
+
+    @torch.no_grad()
+    def early_exit(self, img, input_ids, segment_ids, input_mask, threshold):
+        '''(predictions, exit layer) of every sample: a sample leaves at the first exit head whose softmax
+        confidence reaches threshold, the batch is compacted to the remaining samples before the next layer'''
+        t = self.transformer
+        state = t.init_state(t.prepare_input(img, input_ids, segment_ids, input_mask))
+        preds = torch.zeros(len(img), dtype=torch.long, device=img.device)
+        layers = torch.full((len(img),), t.n_layers, dtype=torch.long, device=img.device)
+        active = torch.arange(len(img), device=img.device)
+        mask = input_mask
+        for i in range(t.n_layers):
+            state = t.layer(i, state, mask)
+            if i == t.n_layers - 1:
+                preds[active] = self.answer_logits(state[0], mask).argmax(1)
+                break
+            conf, pred = self.exits[i](state[0], mask).softmax(1).max(1)
+            done = conf >= threshold
+            preds[active[done]] = pred[done]
+            layers[active[done]] = i + 1
+            if done.all():
+                break
+            keep = ~done
+            active, mask = active[keep], mask[keep]
+            state = tuple(s[keep] if s is not None else None for s in state)
+        return preds, layers
 
 def mean_pooling(token_embeddings, attention_mask):
     # this is for an huggingface model -> token_embeddings = model_output[0] #First element of model_output contains all token embeddings
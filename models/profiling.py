@@ -0,0 +1,270 @@
+import os
+import time
+import json
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+# opt-in per-module profiling of models.mmbert.Model (--profile in the training scripts)
+# forward/backward hooks on the backbone stages, the bert embedding, the token injection (prepare_input),
+# every encoder block call and the heads record wall time (cuda synchronized), a FLOP estimate (Linear and
+# Conv2d layers only, attention matmuls are not counted), output activation bytes and peak memory above
+# the memory allocated at the start of the module. A training step ends at optimizer.step() (a step post hook),
+# so the several forwards of a step (gradient accumulation, the chunks of --grad_cache) are one step and the
+# results match across the training scripts; steps skipped by the GradScaler (inf gradients) are merged into the
+# next one. The train mode forwards of the model are measured on the steps [start, end) and a torch.profiler
+# trace can be captured on another step range. With activation checkpointing the recomputed forwards are counted as well
+
+def conv_flops(module, inputs, output):
+    kh, kw = module.kernel_size
+    return 2 * output.numel() * (module.in_channels // module.groups) * kh * kw
+
+def linear_flops(module, inputs, output):
+    return 2 * output.numel() * module.in_features
+
+def tensors(x):
+    if torch.is_tensor(x):
+        return [x]
+    if isinstance(x, (list, tuple)):
+        return [t for y in x for t in tensors(y)]
+    if isinstance(x, dict):
+        return [t for y in x.values() for t in tensors(y)]
+    return []
+
+def get_profiled_modules(model):
+    '''(name, module, repeated) of the profiled modules, repeated modules are called several times
+    per forward (the shared BertLayer of the transformer) and are reported per call'''
+    t = model.transformer
+    modules = []
+    if hasattr(t.trans, 'model'):
+        for name, child in t.trans.model.named_children():
+            if name == 'blocks': # timm efficientnet stages
+                modules.extend((f'backbone.blocks.{i}', stage, False) for i, stage in enumerate(child))
+            else:
+                modules.append((f'backbone.{name}', child, False))
+    modules.append(('visual_tokens', t.trans, False))
+    modules.append(('bert_embedding', t.bert_embedding, False))
+    if hasattr(t, 'blocks'):
+        modules.append(('encoder.blocks', t.blocks, True))
+    elif hasattr(t, 'mains'):
+        modules.extend((f'encoder.mains.{i}', block, False) for i, block in enumerate(t.mains))
+    elif hasattr(t, 'block'):
+        modules.append(('encoder.feedback', t.block, False))
+    for name in ['fc1', 'activ1', 'classifier', 'head']:
+        if hasattr(model, name):
+            modules.append((name, getattr(model, name), False))
+    return modules
+
+class ModuleProfiler():
+    def __init__(self, model, optimizer, steps=(5, 25), trace_steps=None, trace_dir='.', output=None):
+        self.model = model
+        self.start, self.end = steps
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.output = output
+        self.cuda = torch.cuda.is_available()
+
+        self.step = 0
+        self.in_steps = self.start <= self.step < self.end
+        self.active = False
+        self.stack = []
+        self.calls = {}
+        self.stats = OrderedDict()
+        self.prof = None
+        self.reported = False
+        # the step and forward hooks stay installed after the report (hooks can not be removed while they run)
+        self.step_handle = optimizer.register_step_post_hook(self.step_hook)
+        self.forward_handle = model.register_forward_pre_hook(self.forward_hook)
+        self.handles = []
+        self.trace(0)
+
+        for name, module, repeated in get_profiled_modules(model):
+            self.handles.append(module.register_forward_pre_hook(self.pre_hook(name, repeated)))
+            self.handles.append(module.register_forward_hook(self.post_hook()))
+        self.wrap_prepare_input()
+        for m in model.modules():
+            if isinstance(m, nn.Conv2d):
+                self.handles.append(m.register_forward_hook(self.flops_hook(conv_flops)))
+            elif isinstance(m, nn.Linear):
+                self.handles.append(m.register_forward_hook(self.flops_hook(linear_flops)))
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def forward_hook(self, module, inputs):
+        # measure the train mode forwards of the steps [start, end), the repeated modules are numbered per forward
+        self.active = self.in_steps and module.training and not self.reported
+        self.calls = {}
+
+    def step_hook(self, optimizer, args, kwargs):
+        if self.reported:
+            return
+        self.step += 1
+        self.in_steps = self.start <= self.step < self.end
+        self.active = False
+        self.trace(self.step)
+        if self.step >= self.end and (self.trace_steps is None or self.step >= self.trace_steps[1]):
+            self.report()
+
+    def trace(self, step):
+        if self.trace_steps is None:
+            return
+        if step == self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if self.cuda else [])
+            self.prof = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.prof.start()
+        elif step == self.trace_steps[1]:
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self.prof is None:
+            return
+        self.prof.stop()
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f'trace_steps_{self.trace_steps[0]}_{self.trace_steps[1]}.json')
+        self.prof.export_chrome_trace(path)
+        print('saved profiler trace', path)
+        self.prof = None
+
+    def enter(self, key, inputs):
+        self.sync()
+        entry = {'key': key, 'flops': 0, 'children_ms': 0., 'peak': 0}
+        if self.cuda:
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], torch.cuda.max_memory_allocated())
+            entry['mem0'] = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+        # end of the backward of the module: gradient w.r.t. its input
+        inp = [t for t in tensors(inputs) if t.requires_grad]
+        if inp:
+            inp[0].register_hook(self.backward_hook(key, 'end'))
+        entry['t0'] = time.perf_counter()
+        self.stack.append(entry)
+
+    def exit(self, output):
+        self.sync()
+        entry = self.stack.pop()
+        ms = (time.perf_counter() - entry['t0']) * 1000
+        s = self.get_stats(entry['key'])
+        s['forward_ms'] += ms
+        s['self_ms'] += ms - entry['children_ms']
+        s['flops'] += entry['flops']
+        s['activation_bytes'] += sum(t.numel() * t.element_size() for t in tensors(output))
+        s['calls'] += 1
+        if self.cuda:
+            peak = max(entry['peak'], torch.cuda.max_memory_allocated())
+            s['peak_mem_bytes'] = max(s['peak_mem_bytes'], peak - entry['mem0'])
+        if self.stack:
+            self.stack[-1]['children_ms'] += ms
+            if self.cuda:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+        # start of the backward of the module: gradient w.r.t. its output
+        out = [t for t in tensors(output) if t.requires_grad]
+        if out:
+            out[0].register_hook(self.backward_hook(entry['key'], 'start'))
+
+    def get_stats(self, key):
+        if key not in self.stats:
+            self.stats[key] = {'calls': 0, 'forward_ms': 0., 'self_ms': 0., 'backward_ms': 0., 'flops': 0,
+                               'activation_bytes': 0, 'peak_mem_bytes': 0, 'backward_start': None}
+        return self.stats[key]
+
+    def pre_hook(self, name, repeated):
+        def hook(module, inputs):
+            if not self.active:
+                return
+            key = name
+            if repeated:
+                k = self.calls.get(name, 0)
+                self.calls[name] = k + 1
+                key = f'{name}.{k}'
+            self.enter(key, inputs)
+        return hook
+
+    def post_hook(self):
+        def hook(module, inputs, output):
+            if self.active and self.stack:
+                self.exit(output)
+        return hook
+
+    def flops_hook(self, count):
+        def hook(module, inputs, output):
+            if self.active:
+                flops = count(module, inputs, output)
+                for entry in self.stack:
+                    entry['flops'] += flops
+        return hook
+
+    def backward_hook(self, key, event):
+        def hook(grad):
+            self.sync()
+            s = self.get_stats(key)
+            if event == 'start':
+                s['backward_start'] = time.perf_counter()
+            elif s['backward_start'] is not None:
+                s['backward_ms'] += (time.perf_counter() - s['backward_start']) * 1000
+                s['backward_start'] = None
+        return hook
+
+    def wrap_prepare_input(self):
+        # the visual tokens are written into the text embeddings in prepare_input, its self time is the injection
+        t = self.model.transformer
+        prepare_input = t.prepare_input
+        def wrapped(*args, **kwargs):
+            if not self.active:
+                return prepare_input(*args, **kwargs)
+            self.enter('token_injection', args)
+            h = prepare_input(*args, **kwargs)
+            self.exit(h)
+            return h
+        t.prepare_input = wrapped
+        self.prepare_input = prepare_input
+
+    def remove(self):
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+        self.model.transformer.prepare_input = self.prepare_input
+        self.active = False
+
+    def summary(self):
+        n = max(1, min(self.step, self.end) - self.start)
+        rows = []
+        for key, s in self.stats.items():
+            rows.append({'module': key,
+                         'calls_per_step': s['calls'] / n,
+                         'forward_ms': s['forward_ms'] / n,
+                         'self_ms': s['self_ms'] / n,
+                         'backward_ms': s['backward_ms'] / n,
+                         'gflops': s['flops'] / n / 1e9,
+                         'activation_mb': s['activation_bytes'] / n / 2**20,
+                         'peak_mem_mb': s['peak_mem_bytes'] / 2**20 if self.cuda else float('nan')})
+        return rows
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        self.stop_trace()
+        rows = self.summary()
+        self.remove()
+
+        print(f'Per-module profile, mean over steps {self.start}-{min(self.step, self.end) - 1}')
+        print('| module | calls | forward (ms) | self (ms) | backward (ms) | GFLOPs | activations (MB) | peak memory (MB) |')
+        print('| :--- | ---: | ---: | ---: | ---: | ---: | ---: | ---: |')
+        for r in rows:
+            print(f'| {r["module"]} | {r["calls_per_step"]:.0f} | {r["forward_ms"]:.2f} | {r["self_ms"]:.2f} | {r["backward_ms"]:.2f} | {r["gflops"]:.2f} | {r["activation_mb"]:.1f} | {r["peak_mem_mb"]:.1f} |')
+
+        if self.output:
+            with open(self.output, 'w') as f:
+                json.dump({'steps': [self.start, min(self.step, self.end)], 'modules': rows}, f, indent=2)
+            print('saved profile', self.output)
+
+def attach_profiler(model, optimizer, args):
+    # ModuleProfiler if --profile, else None, steps are counted at optimizer.step()
+    if not (args.profile if hasattr(args, 'profile') else False):
+        return None
+    output = args.profile_output or os.path.join(args.save_dir, f'profile_{args.run_name}.json')
+    return ModuleProfiler(model, optimizer, steps=args.profile_steps, trace_steps=args.profile_trace, trace_dir=os.path.dirname(output) or '.', output=output)
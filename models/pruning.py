@@ -0,0 +1,144 @@
+import json
+
+import torch
+import torch.nn as nn
+
+# structured pruning of the encoder of models.mmbert.Model (Transformer with BertLayer(share='none') or RealFormer):
+# attention heads and FFN neurons are scored by the first order importance |dL/dm| of a mask m multiplied with
+# their output (Michel et al., 2019), accumulated over a dataset, and the pruned ones are physically removed
+# from the Linear weights. The kept indices are saved as a json config, applied to a freshly built Model before
+# loading the pruned state dict (load_pruning_config).
+# In RealFormer the residual attention scores (prev) link head j of every layer, and the kqv projection is
+# shared by the heads, so the same heads are kept in all the layers: they select chunks of the block input
+
+def get_blocks(model):
+    # [(attention output projection, its input is the concatenation of the heads, ffn down projection)] per layer
+    t = model.transformer
+    if hasattr(t, 'blocks'):
+        b = t.blocks
+        if not isinstance(b.attention, nn.ModuleList) or not isinstance(b.feedforward, nn.ModuleList):
+            raise ValueError('pruning needs BertLayer(share=none)')
+        return 'transformer', [(b.proj[i], b.feedforward[i].fc2) for i in range(len(b.attention))]
+    if hasattr(t, 'mains'):
+        return 'realformer', [(block.proj, block.ff[2]) for block in t.mains]
+    raise ValueError('pruning is implemented for the transformer and realformer encoders')
+
+def n_heads(model):
+    encoder, _ = get_blocks(model)
+    t = model.transformer
+    if encoder == 'transformer':
+        return [a.n_heads for a in t.blocks.attention]
+    return [len(block.kept_heads) if block.kept_heads is not None else block.head_cnt for block in t.mains]
+
+def importance(model, loader, criterion, device, max_batches=None):
+    '''(head scores, ffn neuron scores) per layer, from the gradients of masks set to one'''
+    encoder, blocks = get_blocks(model)
+    heads = n_heads(model)
+    head_masks = [torch.ones(h, device=device, requires_grad=True) for h in heads]
+    ffn_masks = [torch.ones(ffn.in_features, device=device, requires_grad=True) for _, ffn in blocks]
+
+    def mask_hook(mask, group):
+        def hook(module, inputs):
+            x = inputs[0]
+            return (x * mask.repeat_interleave(group),) + inputs[1:]
+        return hook
+
+    handles = []
+    for (proj, ffn), hm, fm in zip(blocks, head_masks, ffn_masks):
+        handles.append(proj.register_forward_pre_hook(mask_hook(hm, proj.in_features // len(hm))))
+        handles.append(ffn.register_forward_pre_hook(mask_hook(fm, 1)))
+
+    model.eval()
+    head_scores = [torch.zeros_like(m) for m in head_masks]
+    ffn_scores = [torch.zeros_like(m) for m in ffn_masks]
+    for b, (img, question_token, segment_ids, attention_mask, target, *_) in enumerate(loader):
+        if max_batches is not None and b >= max_batches:
+            break
+        img, question_token, segment_ids, attention_mask, target = img.to(device), question_token.to(device), segment_ids.to(device), attention_mask.to(device), target.to(device)
+        logits, _, _ = model(img, question_token.squeeze(1), segment_ids, attention_mask.squeeze(1))
+        grads = torch.autograd.grad(criterion(logits, target), head_masks + ffn_masks)
+        for s, g in zip(head_scores + ffn_scores, grads):
+            s += g.abs().detach()
+
+    for h in handles:
+        h.remove()
+    # heads: normalized per layer as in Michel et al.
+    head_scores = [s / s.norm().clamp(min=1e-12) for s in head_scores]
+    return head_scores, ffn_scores
+
+def select(head_scores, ffn_scores, encoder, head_ratio, ffn_ratio):
+    # pruning config keeping the top (1 - ratio) heads / neurons of every layer (at least one)
+    def top(scores, ratio):
+        k = max(1, int(round(len(scores) * (1 - ratio))))
+        return sorted(scores.topk(k).indices.tolist())
+    if encoder == 'realformer':
+        shared = top(torch.stack(head_scores).sum(0), head_ratio)
+        heads = [shared for _ in head_scores]
+    else:
+        heads = [top(s, head_ratio) for s in head_scores]
+    return {'encoder': encoder, 'heads': heads, 'ffn': [top(s, ffn_ratio) for s in ffn_scores]}
+
+def prune_linear(linear, index, dim):
+    # new Linear keeping the output features (dim 0) or input features (dim 1) in index
+    index = torch.as_tensor(index, dtype=torch.long, device=linear.weight.device)
+    w = linear.weight.index_select(dim, index).clone()
+    b = None
+    if linear.bias is not None:
+        b = linear.bias[index].clone() if dim == 0 else linear.bias.clone()
+    new = nn.Linear(w.shape[1], w.shape[0], bias=b is not None).to(w.device, w.dtype)
+    with torch.no_grad():
+        new.weight.copy_(w)
+        if b is not None:
+            new.bias.copy_(b)
+    return new
+
+def head_index(heads, dim_head):
+    return [h * dim_head + d for h in heads for d in range(dim_head)]
+
+def prune_model(model, config):
+    '''remove the heads and ffn neurons not listed in config (indices of the current model)'''
+    encoder, _ = get_blocks(model)
+    assert encoder == config['encoder'], f'pruning config for {config["encoder"]}, model is {encoder}'
+    t = model.transformer
+    if encoder == 'transformer':
+        b = t.blocks
+        for i, (heads, ffn) in enumerate(zip(config['heads'], config['ffn'])):
+            att = b.attention[i]
+            idx = head_index(heads, b.proj[i].in_features // att.n_heads)
+            att.proj_q, att.proj_k, att.proj_v = (prune_linear(l, idx, 0) for l in (att.proj_q, att.proj_k, att.proj_v))
+            att.n_heads = len(heads)
+            b.proj[i] = prune_linear(b.proj[i], idx, 1)
+            f = b.feedforward[i]
+            f.fc1, f.fc2 = prune_linear(f.fc1, ffn, 0), prune_linear(f.fc2, ffn, 1)
+    else:
+        for block, heads, ffn in zip(t.mains, config['heads'], config['ffn']):
+            # positions in the current (possibly already pruned) head list -> original chunks of the input
+            current = block.kept_heads if block.kept_heads is not None else list(range(block.head_cnt))
+            block.proj = prune_linear(block.proj, head_index(heads, block.emb_s), 1)
+            block.kept_heads = [current[h] for h in heads]
+            block.ff[0], block.ff[2] = prune_linear(block.ff[0], ffn, 0), prune_linear(block.ff[2], ffn, 1)
+    return model
+
+def compose(previous, config):
+    # config of a pruned model (--pruning_config) followed by config, as indices of the unpruned model
+    if previous is None:
+        return config
+    return {'encoder': config['encoder'],
+            'heads': [[p[i] for i in c] for p, c in zip(previous['heads'], config['heads'])],
+            'ffn': [[p[i] for i in c] for p, c in zip(previous['ffn'], config['ffn'])]}
+
+def read_pruning_config(path):
+    with open(path) as f:
+        return json.load(f)
+
+def save_pruning_config(config, path):
+    with open(path, 'w') as f:
+        json.dump(config, f)
+
+def load_pruning_config(model, args):
+    # shrink a freshly built Model to the shapes of a pruned checkpoint (--pruning_config), before load_state_dict
+    path = args.pruning_config if hasattr(args, 'pruning_config') else None
+    if path is None:
+        return model
+    print('Pruning the encoder with', path)
+    return prune_model(model, read_pruning_config(path))
@@ -15,6 +15,7 @@ class ResEncoderBlock(nn.Module):
         self.proj = nn.Linear(emb, emb,bias = False)
         self.head_cnt = head_cnt
         self.emb_s = emb_s
+        self.kept_heads = None # chunks of the input kept by head pruning (models/pruning.py)
         self.ln1 = nn.LayerNorm(emb)
         self.ln2 = nn.LayerNorm(emb)
         
@@ -30,6 +31,8 @@ class ResEncoderBlock(nn.Module):
     def resmha(self, x, prev = None, mask = None):
         B, T, _ = x.shape
         x = x.reshape(B, T, self.head_cnt, self.emb_s)
+        if self.kept_heads is not None:
+            x = x[:, :, self.kept_heads]
         k, q, v = torch.split(self.kqv(x), self.emb_s, dim = -1) # B, T, h, emb_s
         if prev is not None : 
             att_score = torch.einsum('bihk,bjhk->bijh', q, k)/self.emb_s**0.5 + prev
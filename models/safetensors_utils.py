@@ -0,0 +1,175 @@
+import os
+import json
+import argparse
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# checkpoint I/O with safetensors: the files are memory-mapped and a tensor is only read when its key is
+# selected, so filtered loads (e.g. everything except classifier.2) do not read the skipped weights.
+# Big state dicts are sharded (<name>-00001-of-0000n.safetensors + <name>.safetensors.index.json),
+# weights can be stored in fp16 (load_state_dict casts them back to the parameter dtype)
+# e.g. python models/safetensors_utils.py --convert mmbert/MLM/run.pt --fp16
+
+def load_prefix(path, prefixes, device='cpu'):
+    '''tensors of the file whose key starts with the first of `prefixes` present in it, keyed without the prefix'''
+    state_dict = {}
+    with safe_open(path, framework='pt', device=device) as f:
+        keys = list(f.keys())
+        for prefix in prefixes:
+            selected = [k for k in keys if k.startswith(prefix)]
+            if selected:
+                for k in selected:
+                    state_dict[k[len(prefix):]] = f.get_tensor(k)
+                break
+    return state_dict
+
+def is_safetensors(path):
+    return path.endswith('.safetensors') or os.path.exists(path + '.index.json')
+
+def selected(key, include=None, exclude=None):
+    # include / exclude are lists of key prefixes
+    if include is not None and not any(key.startswith(p) for p in include):
+        return False
+    return exclude is None or not any(key.startswith(p) for p in exclude)
+
+def checkpoint_files(path):
+    # {file: keys of the file (None = all)} of a single file or of a sharded checkpoint
+    index = path + '.index.json'
+    if not os.path.exists(index):
+        return {path: None}
+    with open(index) as f:
+        weight_map = json.load(f)['weight_map']
+    files = {}
+    for k, name in weight_map.items():
+        files.setdefault(os.path.join(os.path.dirname(path), name), []).append(k)
+    return files
+
+def save_checkpoint(state_dict, path, fp16=False, shard_size=2000, metadata=None):
+    '''write a state dict as safetensors, in shards of at most shard_size MB.
+    Tensors sharing storage (e.g. the shared kv projection of the feedback transformer) are copied'''
+    tensors = {}
+    storages = set()
+    for k, v in state_dict.items():
+        v = v.detach().cpu()
+        if fp16 and v.dtype == torch.float32:
+            v = v.half()
+        elif v.untyped_storage().data_ptr() in storages:
+            v = v.clone()
+        storages.add(v.untyped_storage().data_ptr())
+        tensors[k] = v.contiguous()
+    metadata = {**(metadata or {}), 'fp16': str(fp16)}
+
+    shards = [[]]
+    size = 0
+    for k, v in tensors.items():
+        nbytes = v.numel() * v.element_size()
+        if shards[-1] and size + nbytes > shard_size * 2**20:
+            shards.append([])
+            size = 0
+        shards[-1].append(k)
+        size += nbytes
+
+    if len(shards) == 1:
+        save_file(tensors, path, metadata=metadata)
+        return
+
+    base = path[:-len('.safetensors')] if path.endswith('.safetensors') else path
+    weight_map = {}
+    for i, keys in enumerate(shards):
+        name = f'{os.path.basename(base)}-{i + 1:05d}-of-{len(shards):05d}.safetensors'
+        save_file({k: tensors[k] for k in keys}, os.path.join(os.path.dirname(path), name), metadata=metadata)
+        weight_map.update({k: name for k in keys})
+    with open(path + '.index.json', 'w') as f:
+        json.dump({'metadata': metadata, 'weight_map': weight_map}, f, indent=1)
+
+def load_checkpoint(path, include=None, exclude=None, device='cpu'):
+    '''state dict of the selected keys of a (sharded) safetensors checkpoint, the others are not read'''
+    state_dict = {}
+    for file, keys in checkpoint_files(path).items():
+        with safe_open(file, framework='pt', device=device) as f:
+            for k in keys if keys is not None else f.keys():
+                if selected(k, include, exclude):
+                    state_dict[k] = f.get_tensor(k)
+    return state_dict
+
+def load_state_dict(path, include=None, exclude=None, device='cpu'):
+    # safetensors checkpoint or pickled .pt state dict, with the same key filtering
+    if is_safetensors(path):
+        return load_checkpoint(path, include, exclude, device)
+    state_dict = torch.load(path, map_location=device)
+    return {k: v for k, v in state_dict.items() if selected(k, include, exclude)}
+
+def use_safetensors(args):
+    return args.safetensors if hasattr(args, 'safetensors') else False
+
+def save_model(state_dict, path, args):
+    # path of the .pt file, written as .safetensors with --safetensors
+    if use_safetensors(args):
+        save_checkpoint(state_dict, os.path.splitext(path)[0] + '.safetensors', fp16=args.save_fp16 if hasattr(args, 'save_fp16') else False)
+    else:
+        torch.save(state_dict, path)
+
+# recorder checkpoints: model and optimizer tensors as safetensors, the rest (epoch, scheduler, scaler,
+# optimizer param groups) as json, in the directory <path without .pt>
+
+def save_recorder(recorder, path, args):
+    if not use_safetensors(args):
+        torch.save(recorder, path)
+        return
+    out_dir = os.path.splitext(path)[0]
+    os.makedirs(out_dir, exist_ok=True)
+    save_checkpoint(recorder['model'], os.path.join(out_dir, 'model.safetensors'))
+
+    optimizer = recorder['optimizer']
+    tensors = {}
+    state = {}
+    for pid, s in optimizer['state'].items():
+        state[pid] = {}
+        for name, v in s.items():
+            if torch.is_tensor(v):
+                tensors[f'{pid}.{name}'] = v
+            else:
+                state[pid][name] = v
+    save_checkpoint(tensors, os.path.join(out_dir, 'optimizer.safetensors'))
+
+    info = {k: v for k, v in recorder.items() if k not in ['model', 'optimizer']}
+    info['optimizer'] = {'param_groups': optimizer['param_groups'], 'state': state}
+    with open(os.path.join(out_dir, 'recorder.json'), 'w') as f:
+        json.dump(info, f)
+
+def load_recorder(path, device='cpu'):
+    out_dir = os.path.splitext(path)[0]
+    if not os.path.isdir(out_dir):
+        return torch.load(path, map_location=device)
+    with open(os.path.join(out_dir, 'recorder.json')) as f:
+        recorder = json.load(f)
+    state = {int(pid): s for pid, s in recorder['optimizer']['state'].items()}
+    for k, v in load_checkpoint(os.path.join(out_dir, 'optimizer.safetensors'), device=device).items():
+        pid, name = k.split('.', 1)
+        state.setdefault(int(pid), {})[name] = v
+    recorder['optimizer']['state'] = state
+    recorder['model'] = load_checkpoint(os.path.join(out_dir, 'model.safetensors'), device=device)
+    return recorder
+
+def convert(path, fp16=False, shard_size=2000, exclude=None):
+    # .pt state dict -> .safetensors, recorder .pt -> recorder directory
+    ckpt = torch.load(path, map_location='cpu')
+    if 'model' in ckpt and 'optimizer' in ckpt:
+        save_recorder(ckpt, path, argparse.Namespace(safetensors=True))
+        print('converted recorder', path, '->', os.path.splitext(path)[0])
+    else:
+        out = os.path.splitext(path)[0] + '.safetensors'
+        save_checkpoint({k: v for k, v in ckpt.items() if selected(k, exclude=exclude)}, out, fp16=fp16, shard_size=shard_size)
+        print('converted', path, '->', out)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="convert .pt checkpoints to safetensors")
+    parser.add_argument('--convert', nargs='+', required=True, help='.pt files (state dicts or recorders)')
+    parser.add_argument('--fp16', action='store_true', default=False, help='store the float32 weights of state dicts in fp16')
+    parser.add_argument('--shard_size', type=int, default=2000, help='max shard size in MB')
+    parser.add_argument('--exclude', nargs='+', default=None, help='key prefixes to leave out, e.g. classifier.2')
+    args = parser.parse_args()
+
+    for path in args.convert:
+        convert(path, args.fp16, args.shard_size, args.exclude)
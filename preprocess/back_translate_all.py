@@ -0,0 +1,110 @@
+import os
+import argparse
+import queue
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+from preprocess.translate_transformers import TransformerBackTranslation
+
+# back-translation of the ROCO captions in every language in one command
+# one process per (language, worker): each loads its MarianMT models once and translates the shards
+# k with k % procs_per_language == worker (contiguous rows of traindata.csv, so shard k covers the same
+# rows in every language). The main process joins the languages of a shard and appends it as a row group
+# of <roco_dir>/traindata_translated.parquet, in row order: columns id, name, caption, caption_<language>...
+# (the caption columns in --languages order, like traindata.csv for fr de es)
+# e.g. python preprocess/back_translate_all.py --languages fr de es --procs_per_language 2 --devices cuda:0 cuda:1
+
+def get_shards(n_rows, shard_size):
+    return [range(s, min(s + shard_size, n_rows)) for s in range(0, n_rows, shard_size)]
+
+def translate_worker(language, worker, device, captions, args, results):
+    torch.set_num_threads(args.threads_per_proc)
+    translator = TransformerBackTranslation(src='en', trg=language, device=device, num_beams=args.num_beams, max_new_tokens=args.max_new_tokens)
+    translator.to(device)
+
+    shards = get_shards(len(captions), args.shard_size)
+    for k in range(worker, len(shards), args.procs_per_language):
+        out = translator([captions[r] for r in shards[k]], args.max_tokens, args.batch_size)
+        results.put((language, k, out))
+    results.put((language, None, worker))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="back-translation in several languages")
+    parser.add_argument('--roco_dir', type=str, default = '~/roco/train/radiology', help='path to dataset', required = False)
+    parser.add_argument('--languages', nargs='+', default=['fr', 'de', 'es'], help='languages to translate to for back translation')
+    parser.add_argument('--procs_per_language', type=int, default=1, help='translation processes per language.')
+    parser.add_argument('--devices', nargs='+', default=None, help='devices assigned round robin to the processes (default: cuda if available else cpu).')
+    parser.add_argument('--threads_per_proc', type=int, default=1, help='torch cpu threads per process.')
+    parser.add_argument('--shard_size', type=int, default=1000, help='captions per shard.')
+    parser.add_argument('--batch_size', type=int, default=64, help='max number of captions in a batch.')
+    parser.add_argument('--max_tokens', type=int, default=4096, help='max number of padded tokens in a batch.')
+    parser.add_argument('--num_beams', type=int, default=None, help='beams for generation (default: model config).')
+    parser.add_argument('--max_new_tokens', type=int, default=None, help='max generated tokens per caption (default: model config).')
+    parser.add_argument('--output', type=str, default=None, help='output file (default: <roco_dir>/traindata_translated.parquet).')
+    args = parser.parse_args()
+    train_path = os.path.expanduser(args.roco_dir)
+    output = args.output or os.path.join(train_path, 'traindata_translated.parquet')
+    devices = args.devices or ['cuda' if torch.cuda.is_available() else 'cpu']
+
+    train_data = pd.read_csv(os.path.join(train_path, 'traindata.csv'))
+    # table columns
+    # 0     1        2
+    # id img_name caption
+    train_data = train_data.iloc[:, :3]
+    captions = train_data.iloc[:, 2].astype(str).str.strip().tolist()
+    shards = get_shards(len(captions), args.shard_size)
+
+    # spawn, cuda can not be used in forked processes
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    procs = []
+    for l in args.languages:
+        for w in range(args.procs_per_language):
+            device = devices[len(procs) % len(devices)]
+            p = ctx.Process(target=translate_worker, args=(l, w, device, captions, args, results))
+            p.start()
+            procs.append(p)
+    print(f'{len(procs)} processes, {len(shards)} shards per language')
+
+    # shard -> {language: translations}, kept until every language of the shard is done
+    pending = {}
+    next_shard = 0
+    running = len(procs)
+    writer = None
+    bar = tqdm(total=len(shards) * len(args.languages))
+    while running > 0:
+        try:
+            language, k, out = results.get(timeout=60)
+        except queue.Empty:
+            dead = [p for p in procs if p.exitcode not in (None, 0)]
+            assert not dead, f'{len(dead)} translation processes failed'
+            continue
+        if k is None:
+            running -= 1
+            continue
+        pending.setdefault(k, {})[language] = out
+        bar.update(1)
+
+        # append the finished shards in row order
+        while next_shard in pending and len(pending[next_shard]) == len(args.languages):
+            done = pending.pop(next_shard)
+            shard = train_data.iloc[shards[next_shard].start:shards[next_shard].stop].copy()
+            for l in args.languages:
+                shard['caption_' + l] = done[l]
+            table = pa.Table.from_pandas(shard, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output + '.tmp', table.schema)
+            writer.write_table(table)
+            next_shard += 1
+    bar.close()
+
+    for p in procs:
+        p.join()
+    assert next_shard == len(shards), f'only {next_shard} of {len(shards)} shards were translated'
+    writer.close()
+    os.replace(output + '.tmp', output)
+    print('saved', output)
@@ -0,0 +1,80 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer, AutoModel, logging
+from sentence_transformers import SentenceTransformer
+
+# Embed every caption column of traindata.csv (caption + fr/de/es back-translations) once, for the
+# 'sentence_transformers' and 'cosine' similarities of SupCon (--caption_embeddings in roco_supcon_train.py).
+# Output: caption_emb_<similarity>.npy, a (n_columns * n_rows, dim) matrix of L2-normalized fp16 embeddings
+# (row c * n_rows + r is column c of table row r) loaded with mmap, and caption_emb_<similarity>.json
+# with the ROCO ids of the rows and the embedded columns.
+
+def embed_sentence_transformers(model, captions, args):
+    return model.encode(captions, batch_size=args.batch_size, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+
+def embed_clinicalbert(model, tokenizer, captions, args, device):
+    # mean of the last hidden states over the caption tokens (padding excluded, so an
+    # embedding does not depend on the other captions of the batch)
+    encoded_input = tokenizer(captions, return_tensors='pt', truncation=True, padding=True).to(device)
+    with torch.no_grad():
+        output = model(**encoded_input).last_hidden_state
+        mask = encoded_input['attention_mask'].unsqueeze(-1).float()
+        emb = (output * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+        emb = emb / emb.norm(dim=1, keepdim=True).clamp(min=1e-8)
+    return emb.cpu().numpy()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="caption embeddings for supcon")
+    parser.add_argument('--roco_dir', type=str, default = '~/roco/train/radiology', help='path to dataset', required = False)
+    parser.add_argument('--similarity', type=str, default='sentence_transformers', choices=['sentence_transformers', 'cosine'], help='similarity the embeddings are used for')
+    parser.add_argument('--clinicalbert', type=str, default='emilyalsentzer/Bio_ClinicalBERT')
+    parser.add_argument('--max_token_length', type=int, default=512, help='max token length for clinicalbert')
+    parser.add_argument('--batch_size', type=int, default=256, help='batch_size.')
+    args = parser.parse_args()
+
+    train_path = os.path.expanduser(args.roco_dir)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    train_data = pd.read_csv(os.path.join(train_path, 'traindata.csv'))
+    # table columns
+    # 0     1        2    3  4  5
+    # id img_name caption fr de es
+    columns = list(train_data.columns[2:])
+    ids = train_data.iloc[:, 0].astype(str).tolist()
+    n_rows = len(train_data)
+
+    if args.similarity == 'sentence_transformers':
+        model = SentenceTransformer('all-mpnet-base-v2', device=device)
+        dim = model.get_sentence_embedding_dimension()
+    elif args.similarity == 'cosine':
+        logging.set_verbosity_error()
+        tokenizer = AutoTokenizer.from_pretrained(args.clinicalbert, model_max_length=args.max_token_length)
+        model = AutoModel.from_pretrained(args.clinicalbert).to(device)
+        model.eval()
+        dim = model.config.hidden_size
+
+    out_file = os.path.join(train_path, 'caption_emb_' + args.similarity + '.npy')
+    store = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float16, shape=(len(columns) * n_rows, dim))
+
+    for c, col in enumerate(columns):
+        captions = train_data[col].fillna('').astype(str).str.strip().tolist()
+        # sort by length so that each batch pads to similar lengths
+        order = np.argsort([len(x) for x in captions], kind='stable')
+        for s in tqdm(range(0, n_rows, args.batch_size), desc=col):
+            rows = order[s:s + args.batch_size]
+            batch = [captions[r] for r in rows]
+            if args.similarity == 'sentence_transformers':
+                emb = embed_sentence_transformers(model, batch, args)
+            else:
+                emb = embed_clinicalbert(model, tokenizer, batch, args, device)
+            store[c * n_rows + rows] = emb.astype(np.float16)
+    store.flush()
+
+    with open(os.path.join(train_path, 'caption_emb_' + args.similarity + '.json'), 'w') as f:
+        json.dump({'similarity': args.similarity, 'columns': columns, 'ids': ids}, f)
+    print('saved', out_file, store.shape)
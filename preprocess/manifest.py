@@ -0,0 +1,50 @@
+import os
+import pandas as pd
+import pyarrow as pa
+from preprocess.scan_images import scan_dir
+
+# columnar manifest of a dataset split (Arrow IPC file, memory-mapped by the loaders, which materialize only the
+# columns they use)
+# one row per item, with the image path relative to the dataset dir, the text columns,
+# the image dimensions and a validity flag (image decodes, see scan_images.py, and non-empty text)
+
+MANIFEST = 'manifest.arrow'
+# columns added to the dataset columns
+INFO_COLUMNS = ['path', 'keywords', 'width', 'height', 'valid']
+
+def add_image_info(df, data_dir, workers=8):
+    # dimensions and validity from the (cached) integrity scan of each image directory, missing images are invalid
+    dirs = df['path'].map(os.path.dirname)
+    info = {}
+    for d in dirs.unique():
+        scan = scan_dir(os.path.join(data_dir, d), workers)
+        for name, valid, width, height in scan[['name', 'valid', 'width', 'height']].values:
+            info[d + '/' + name] = (width, height, valid)
+    info = [info.get(p, (-1, -1, False)) for p in df['path']]
+    df['width'] = [i[0] for i in info]
+    df['height'] = [i[1] for i in info]
+    df['valid'] = [bool(i[2]) for i in info]
+    return df
+
+def write_manifest(df, path):
+    table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    print('saved', path, len(df), 'rows,', int((~df['valid']).sum()), 'invalid')
+
+def read_manifest(path, columns=None, valid_only=True, exclude=()):
+    '''DataFrame of the (valid) rows, with columns or all the columns but exclude. The file is memory-mapped
+    and only these columns are materialized: the filter and the conversion copy them into process memory'''
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all() # zero-copy views of the mapped file
+        names = columns if columns is not None else [c for c in table.column_names if c not in exclude]
+        valid = table.column('valid')
+        table = table.select(names)
+        if valid_only:
+            table = table.filter(valid)
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def get_manifest_path(split_dir):
+    path = os.path.join(split_dir, MANIFEST)
+    return path if os.path.exists(path) else None
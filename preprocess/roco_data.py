@@ -3,6 +3,7 @@ import os
 from tqdm import tqdm
 import pickle
 import argparse
+from preprocess.manifest import add_image_info, write_manifest, MANIFEST
 
 
 #print(os.listdir(os.path.join(ROCO_PATH,"train")))
@@ -99,8 +100,37 @@ def sort_keywords():
     #import IPython; IPython.embed(); exit(0)
     return df
 
+''' columnar manifest of a split (read by load_mlm_data instead of listing the image directory) '''
+
+def build_manifest(split):
+    split_dir = os.path.join(ROCO_PATH, split, 'radiology')
+    filename = 'traindata.csv' if split == 'train' else 'valdata.csv'
+    data = pd.read_csv(os.path.join(split_dir, filename))
+    # table columns
+    # 0     1        2      3 ...
+    # id img_name caption [back-translations]
+    df = data.iloc[:, :3].copy()
+    df.columns = ['id', 'name', 'caption']
+    translated = os.path.join(split_dir, 'traindata_translated.parquet') # preprocess/back_translate_all.py
+    if os.path.exists(translated):
+        translations = pd.read_parquet(translated)
+        translations = translations[['id'] + [c for c in translations.columns if c.startswith('caption_')]]
+        df = df.merge(translations, on='id', how='left')
+    else:
+        for c in data.columns[3:]:
+            df[c] = data[c].values
+    df['caption'] = df['caption'].fillna('').astype(str).str.strip()
+
+    keywords = count_keywords(split, {}) if os.path.exists(os.path.join(ROCO_PATH,split,"keywords.txt")) else {}
+    df['path'] = 'images/' + df['name']
+    df['keywords'] = [keywords.get(i, []) for i in df['id']]
+    df = add_image_info(df, split_dir)
+    df['valid'] = df['valid'] & (df['caption'] != '')
+    write_manifest(df, os.path.join(split_dir, MANIFEST))
+    return df
+
 parser = argparse.ArgumentParser(description="preprocess roco tasks")
-parser.add_argument('--task', type=str, choices=['dataframe', 'vocab', 'sort_keywords'], help="name for wandb run", required=True)
+parser.add_argument('--task', type=str, choices=['dataframe', 'vocab', 'sort_keywords', 'manifest'], help="name for wandb run", required=True)
 parser.add_argument('--roco_dir', type=str, default = 'D:\ist\Tese\ROCO\\', help='path to dataset', required = False)
 
 args = parser.parse_args()
@@ -123,3 +153,7 @@ if args.task == 'vocab':
 
 if args.task == 'sort_keywords':
     df = sort_keywords()
+
+if args.task == 'manifest':
+    train_df = build_manifest('train')
+    val_df = build_manifest('validation')
@@ -0,0 +1,100 @@
+import os
+import argparse
+import multiprocessing
+import pandas as pd
+import pyarrow.feather as feather
+from PIL import Image
+from tqdm import tqdm
+
+# integrity scan of the images of a directory with a process pool: header/structure check (verify) plus full decode
+# results are cached next to the directory (<image_dir>_scan.arrow) keyed by file name, size and mtime,
+# so a re-scan only checks new or changed files. The loaders scan their directories (require_valid_images,
+# exclude_invalid) and drop the images that are flagged or missing
+# e.g. python preprocess/scan_images.py --image_dirs roco/train/radiology/images roco/validation/radiology/images --workers 16
+
+def check_image(path):
+    try:
+        with Image.open(path) as img:
+            img.verify() # header and structure, without decoding
+        with Image.open(path) as img: # verify leaves the image unusable, reopen to decode
+            img.load()
+            width, height = img.size
+        return True, '', width, height
+    except Exception as e: # PIL raises OSError, SyntaxError, ValueError, DecompressionBombError ... on bad files
+        return False, f'{type(e).__name__}: {e}', -1, -1
+
+def get_scan_path(image_dir):
+    image_dir = os.path.normpath(image_dir)
+    return image_dir + '_scan.arrow'
+
+def read_scan(image_dir):
+    path = get_scan_path(image_dir)
+    return feather.read_feather(path, memory_map=True) if os.path.exists(path) else None
+
+def scan_dir(image_dir, workers=8):
+    files = []
+    for e in os.scandir(image_dir):
+        if e.is_file():
+            st = e.stat()
+            files.append((e.name, st.st_size, st.st_mtime_ns))
+    df = pd.DataFrame(files, columns=['name', 'size', 'mtime'])
+
+    cache = read_scan(image_dir)
+    if cache is not None:
+        df = df.merge(cache, on=['name', 'size', 'mtime'], how='left')
+        todo = df['valid'].isna()
+    else:
+        for c, v in [('valid', None), ('error', ''), ('width', -1), ('height', -1)]:
+            df[c] = v
+        todo = pd.Series(True, index=df.index)
+    print(f'{image_dir}: {len(df)} images, {int(todo.sum())} new or changed')
+
+    if todo.any():
+        paths = [os.path.join(image_dir, n) for n in df.loc[todo, 'name']]
+        with multiprocessing.Pool(workers) as pool:
+            res = list(tqdm(pool.imap(check_image, paths, chunksize=64), total=len(paths), leave=False))
+        df.loc[todo, ['valid', 'error', 'width', 'height']] = pd.DataFrame(res, index=df.index[todo], columns=['valid', 'error', 'width', 'height'])
+
+    df = df.astype({'valid': bool, 'error': str, 'width': int, 'height': int})
+    feather.write_feather(df, get_scan_path(image_dir), compression='uncompressed')
+    print(f'{image_dir}: {int((~df["valid"]).sum())} flagged')
+    return df
+
+def get_valid_images(image_dir):
+    # names of the images of a scanned directory that can be decoded, None if it was not scanned
+    scan = read_scan(image_dir)
+    return None if scan is None else set(scan.loc[scan['valid'], 'name'])
+
+def require_valid_images(image_dir, workers=8):
+    # names of the images that decode, the directory is scanned first (only new or changed files if cached)
+    scan = scan_dir(image_dir, workers)
+    valid = set(scan.loc[scan['valid'], 'name'])
+    if not valid:
+        raise ValueError(f'no image of {image_dir} can be decoded (see python preprocess/scan_images.py --image_dirs {image_dir} --show)')
+    return valid
+
+def exclude_invalid(df, column, workers=8):
+    # drop the rows whose image (full path in `column`) is flagged or missing in the scan of its directory,
+    # the directories are scanned first (only new or changed files if cached), as require_valid_images
+    dirs = df[column].map(os.path.dirname)
+    keep = pd.Series(True, index=df.index)
+    for d in dirs.unique():
+        valid = require_valid_images(d, workers)
+        rows = dirs == d
+        keep[rows] = df.loc[rows, column].map(os.path.basename).isin(valid)
+    if not keep.all():
+        print(f'excluding {int((~keep).sum())} flagged or missing images')
+    return df[keep]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="image integrity scan")
+    parser.add_argument('--image_dirs', nargs='+', required=True, help='directories of images to scan')
+    parser.add_argument('--workers', type=int, default=8, help='processes used to check the images')
+    parser.add_argument('--show', action='store_true', default=False, help='print the flagged images')
+    args = parser.parse_args()
+
+    for d in args.image_dirs:
+        df = scan_dir(d, args.workers)
+        if args.show:
+            for name, error in df.loc[~df['valid'], ['name', 'error']].values:
+                print(name, error)
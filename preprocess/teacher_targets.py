@@ -0,0 +1,73 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import pyarrow.feather as feather
+from tqdm import tqdm
+from transformers import AutoTokenizer, AutoModel
+
+from preprocess.translate_transformers import token_lengths, token_batches
+
+# offline ClinicalBERT pass for --task distillation: the captions are batched by token length and the last
+# fp32 hidden states of their tokens (without [CLS] and [SEP]) are written to a memory-mapped fp16 store,
+# <split_dir>/teacher_<model>/ with targets.npy (tokens, hidden), index.arrow (name, offset, length) and
+# info.json. Only the first max_position_embeddings - num_vis - 3 tokens of a caption are kept, as many as
+# encode_text of pretrain/roco_utils.py can use. The ROCO dataset reads them by image name (--teacher_targets)
+# e.g. python preprocess/teacher_targets.py --data_dir ../roco --max_position_embeddings 75 --num_vis 5
+
+CAPTIONS = {'train': 'traindata.csv', 'validation': 'valdata.csv'}
+
+def get_teacher_dir(split_dir, clinicalbert):
+    return os.path.join(split_dir, 'teacher_' + clinicalbert.replace('/', '_'))
+
+def build_targets(args, split):
+    split_dir = os.path.join(args.data_dir, split, 'radiology')
+    df = pd.read_csv(os.path.join(split_dir, CAPTIONS[split]))
+    df = df[df['caption'].fillna('').str.strip() != ''].reset_index(drop=True)
+    captions = df['caption'].str.strip().tolist()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    tokenizer = AutoTokenizer.from_pretrained(args.clinicalbert, model_max_length=args.max_token_length)
+    model = AutoModel.from_pretrained(args.clinicalbert).to(device)
+    model.eval() # fp32 as the online teacher of distillation(), the targets are only rounded to fp16 in the store
+
+    keep = args.max_position_embeddings - (args.num_vis + 3)
+    lengths = np.array(token_lengths(tokenizer, captions))
+    stored = np.minimum(lengths - 2, keep)
+    offsets = np.concatenate([[0], np.cumsum(stored)[:-1]])
+
+    out_dir = get_teacher_dir(split_dir, args.clinicalbert)
+    os.makedirs(out_dir, exist_ok=True)
+    hidden = model.config.hidden_size
+    targets = np.lib.format.open_memmap(os.path.join(out_dir, 'targets.npy'), mode='w+', dtype=np.float16, shape=(int(stored.sum()), hidden))
+
+    with torch.no_grad():
+        for batch in tqdm(token_batches(lengths, args.max_tokens, args.batch_size), desc=split):
+            item = tokenizer([captions[i] for i in batch], truncation=True, padding=True, return_tensors='pt').to(device)
+            last = model(**item)[0].cpu().numpy()
+            for j, i in enumerate(batch):
+                # [CLS] is position 0, the caption tokens follow
+                targets[offsets[i]:offsets[i] + stored[i]] = last[j, 1:1 + stored[i]]
+    targets.flush()
+
+    feather.write_feather(pd.DataFrame({'name': df['name'], 'offset': offsets, 'length': stored}), os.path.join(out_dir, 'index.arrow'), compression='uncompressed')
+    with open(os.path.join(out_dir, 'info.json'), 'w') as f:
+        json.dump({'clinicalbert': args.clinicalbert, 'max_token_length': args.max_token_length, 'keep': int(keep), 'hidden_size': hidden}, f)
+    print(f'{split}: {len(df)} captions, {int(stored.sum())} target tokens -> {out_dir}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="precompute the ClinicalBERT targets of the distillation pretraining")
+    parser.add_argument('--data_dir', type=str, default='../roco', help='path to the ROCO dataset')
+    parser.add_argument('--splits', nargs='+', default=['train', 'validation'], choices=list(CAPTIONS), help='splits to process')
+    parser.add_argument('--clinicalbert', type=str, default='emilyalsentzer/Bio_ClinicalBERT')
+    parser.add_argument('--max_token_length', type=int, default=512, help='max token length for the transformer in distillation')
+    parser.add_argument('--max_position_embeddings', type=int, default=75, help='max length of the sequence of the student')
+    parser.add_argument('--num_vis', type=int, default=5, help='num of visual embeddings of the student')
+    parser.add_argument('--max_tokens', type=int, default=16384, help='max padded tokens per teacher batch')
+    parser.add_argument('--batch_size', type=int, default=256, help='max captions per teacher batch')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        build_targets(args, split)
@@ -1,20 +1,33 @@
 from transformers import MarianTokenizer, MarianMTModel
 import os
+import json
+import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
 import argparse
-from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 
+# back-translation of the ROCO captions with MarianMT (en -> language -> en)
+# captions are sorted by token length and batched by a padded-token budget; the output is written
+# as independent shards listed in caption_<language>_shards/manifest.json, so a crashed run resumes
+# from the last finished shard. Once every shard is done they are joined into caption_<language>.csv
+# (dataset order, as read by build_from_translation.py)
 
 class TransformerBackTranslation(nn.Module):
-    def __init__(self,src, trg,device):
+    def __init__(self,src, trg,device, num_beams=None, max_new_tokens=None):
         super(TransformerBackTranslation, self).__init__()
         self.src = src
         self.trg = trg
         self.device = device
 
+        # generation controls, None keeps the model defaults
+        self.gen_kwargs = {}
+        if num_beams is not None:
+            self.gen_kwargs['num_beams'] = num_beams
+        if max_new_tokens is not None:
+            self.gen_kwargs['max_new_tokens'] = max_new_tokens
+
         model_name_forward = f'Helsinki-NLP/opus-mt-{src}-{trg}'
         self.model_forward = MarianMTModel.from_pretrained(model_name_forward)
         self.tokenizer_forward = MarianTokenizer.from_pretrained(model_name_forward)
@@ -23,82 +36,131 @@ class TransformerBackTranslation(nn.Module):
         self.model_backwards = MarianMTModel.from_pretrained(model_name_backwards)
         self.tokenizer_backwards = MarianTokenizer.from_pretrained(model_name_backwards)
 
-    def translate(self,text):
+    def generate(self, model, tokenizer, text):
+        batch = tokenizer(text, return_tensors="pt", truncation=True, padding=True).to(self.device)
+        gen = model.generate(**batch, **self.gen_kwargs)
+        return tokenizer.batch_decode(gen, skip_special_tokens=True) #list of string
+
+    def generate_sorted(self, model, tokenizer, text, max_tokens, batch_size):
+        # batches of similar length, each holding at most max_tokens padded tokens
+        res = [None] * len(text)
+        for rows in token_batches(token_lengths(tokenizer, text), max_tokens, batch_size):
+            out = self.generate(model, tokenizer, [text[r] for r in rows])
+            for r, o in zip(rows, out):
+                res[r] = o
+        return res
+
+    def translate(self,text, max_tokens=None, batch_size=None):
         self.model_forward.eval()
         self.model_backwards.eval()
         with torch.no_grad():
-            batch = self.tokenizer_forward(text, return_tensors="pt", truncation=True, padding=True).to(self.device)
-            gen = self.model_forward.generate(**batch)
-            intermediate = self.tokenizer_forward.batch_decode(gen, skip_special_tokens=True) #list of string
-            intermediate = intermediate#[0] #string
-
-            batch = self.tokenizer_backwards(intermediate, return_tensors="pt", truncation=True, padding=True).to(self.device)
-            gen = self.model_backwards.generate(**batch)
-            res = self.tokenizer_backwards.batch_decode(gen, skip_special_tokens=True)
-        return res#[0]
-
-    def forward(self,text):
-        return self.translate(text)
-
-class Captions_Dataset(Dataset):
-    def __init__(self, args, df):
-        self.df = df.values
-        self.args = args
-        
-    def __len__(self):
-        return len(self.df)
-
-    def __getitem__(self, idx):
-        id = self.df[idx,0] 
-    
-        caption = self.df[idx, 2].strip()
-
-        return id,caption
-
-parser = argparse.ArgumentParser(description="translation")
-parser.add_argument('--roco_dir', type=str, default = '~/roco/train/radiology', help='path to dataset', required = False)
-parser.add_argument('--language', type=str, default = 'fr', help='language to translate to for back translation', required = True)
-parser.add_argument('--batch_size', type=int, default=16, help='batch_size.')
-parser.add_argument('--num_workers', type=int, default=16, help='num works to generate data.')
-parser.add_argument('--save_freq', type=int, default=2500, help='saving freq')
-args = parser.parse_args()
-train_path = args.roco_dir
-
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
-train_data = pd.read_csv(os.path.join(train_path, 'traindata.csv'))
-
-
-translator = TransformerBackTranslation(src='en',trg=args.language,device=device)
-translator.to(device)
-print('translator on device', translator.device)
-
-#example
-# txt=train_data.iloc[0]['caption']
-# print('orig :', txt)
-# print('after:',translator.translate(txt))
-
-dataset = Captions_Dataset(args, train_data)
-loader = DataLoader(dataset, batch_size = args.batch_size, shuffle=False, num_workers = args.num_workers)
-print('len(loader), len(dataset)',len(loader), len(dataset))
-res = []
-bar = tqdm(loader, leave=False)
-save_freq = len(loader) * args.save_freq // len(dataset)
-print(f'saving every {save_freq}th batch')
-for i, (id, caption) in enumerate(bar):
-    out = translator(list(caption))
-
+            if max_tokens is None:
+                intermediate = self.generate(self.model_forward, self.tokenizer_forward, text)
+                res = self.generate(self.model_backwards, self.tokenizer_backwards, intermediate)
+            else:
+                # the intermediate translations have other lengths, they are re-sorted for the second pass
+                intermediate = self.generate_sorted(self.model_forward, self.tokenizer_forward, text, max_tokens, batch_size)
+                res = self.generate_sorted(self.model_backwards, self.tokenizer_backwards, intermediate, max_tokens, batch_size)
+        return res
+
+    def forward(self,text, max_tokens=None, batch_size=None):
+        return self.translate(text, max_tokens, batch_size)
+
+def token_lengths(tokenizer, text):
+    return [len(ids) for ids in tokenizer(list(text), truncation=True)['input_ids']]
+
+def token_batches(lengths, max_tokens, batch_size=None):
+    '''group the indices of `lengths` by increasing length, so that each batch has at most
+    max_tokens padded tokens (batch size * longest sequence) and at most batch_size sequences'''
+    order = np.argsort(lengths, kind='stable')
+    batches = []
+    batch = []
+    for r in order:
+        # sorted, so the new one is the longest of the batch
+        if batch and ((len(batch) + 1) * lengths[r] > max_tokens or (batch_size and len(batch) == batch_size)):
+            batches.append(batch)
+            batch = []
+        batch.append(int(r))
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_shards(lengths, shard_size):
+    # rows sorted by caption length (deterministic for a given traindata.csv), cut in shards of shard_size rows
+    order = np.argsort(lengths, kind='stable')
+    return [order[s:s + shard_size] for s in range(0, len(order), shard_size)]
+
+def shard_file(shard_dir, k):
+    return os.path.join(shard_dir, f'shard_{k:05d}.csv')
+
+def load_manifest(manifest_file, settings):
+    if not os.path.exists(manifest_file):
+        return {**settings, 'shards': {}}
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    for key, value in settings.items():
+        assert manifest[key] == value, f'{manifest_file} was written with {key}={manifest[key]}, not {value}: use another --output_dir or remove it'
+    return manifest
+
+def save_manifest(manifest_file, manifest):
+    tmp = manifest_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_file)
+
+def write_shard(shard_dir, k, ids, rows, out, language):
     info = pd.DataFrame()
-    info['id'] = id
-    info['caption_'+args.language] = out
-    res.append(info)
-    #import IPython; IPython.embed(); import sys; sys.exit(0)
-    if i % save_freq == 0:
-        print('saving file')
-        final = pd.concat(res)
-        final.to_csv(os.path.join(train_path,'caption_' + args.language +'.csv'), index=False, header=final.columns)
-    #batch = tokenizer_forward(caption, return_tensors="pt", truncation=True, padding=True).to(self.device)
-
-print('saving file')
-final = pd.concat(res)
-final.to_csv(os.path.join(train_path,'caption_' + args.language +'.csv'), index=False, header=final.columns)
+    info['row'] = rows
+    info['id'] = ids
+    info['caption_' + language] = out
+    tmp = shard_file(shard_dir, k) + '.tmp'
+    info.to_csv(tmp, index=False, header=info.columns)
+    os.replace(tmp, shard_file(shard_dir, k))
+
+def join_shards(shard_dir, manifest):
+    final = pd.concat([pd.read_csv(shard_file(shard_dir, int(k)), keep_default_na=False) for k in manifest['shards']])
+    return final.sort_values('row').drop(columns='row')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="translation")
+    parser.add_argument('--roco_dir', type=str, default = '~/roco/train/radiology', help='path to dataset', required = False)
+    parser.add_argument('--language', type=str, default = 'fr', help='language to translate to for back translation', required = True)
+    parser.add_argument('--batch_size', type=int, default=64, help='max number of captions in a batch.')
+    parser.add_argument('--max_tokens', type=int, default=4096, help='max number of padded tokens in a batch.')
+    parser.add_argument('--shard_size', type=int, default=2500, help='captions per output shard.')
+    parser.add_argument('--num_beams', type=int, default=None, help='beams for generation (default: model config).')
+    parser.add_argument('--max_new_tokens', type=int, default=None, help='max generated tokens per caption (default: model config).')
+    parser.add_argument('--output_dir', type=str, default=None, help='shard directory (default: <roco_dir>/caption_<language>_shards).')
+    args = parser.parse_args()
+    train_path = os.path.expanduser(args.roco_dir)
+    shard_dir = args.output_dir or os.path.join(train_path, 'caption_' + args.language + '_shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest_file = os.path.join(shard_dir, 'manifest.json')
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    train_data = pd.read_csv(os.path.join(train_path, 'traindata.csv'))
+    ids = train_data.iloc[:, 0].values
+    captions = train_data.iloc[:, 2].astype(str).str.strip().tolist()
+
+    translator = TransformerBackTranslation(src='en',trg=args.language,device=device, num_beams=args.num_beams, max_new_tokens=args.max_new_tokens)
+    translator.to(device)
+    print('translator on device', translator.device)
+
+    shards = get_shards(token_lengths(translator.tokenizer_forward, captions), args.shard_size)
+    settings = {'language': args.language, 'n_rows': len(captions), 'shard_size': args.shard_size,
+                'num_beams': args.num_beams, 'max_new_tokens': args.max_new_tokens}
+    manifest = load_manifest(manifest_file, settings)
+    todo = [k for k in range(len(shards)) if str(k) not in manifest['shards']]
+    print(f'{len(shards)} shards, {len(shards) - len(todo)} already done')
+
+    for k in tqdm(todo):
+        rows = shards[k]
+        out = translator([captions[r] for r in rows], args.max_tokens, args.batch_size)
+        write_shard(shard_dir, k, ids[rows], rows, out, args.language)
+        manifest['shards'][str(k)] = {'file': os.path.basename(shard_file(shard_dir, k)), 'rows': len(rows)}
+        save_manifest(manifest_file, manifest)
+
+    print('saving file')
+    final = join_shards(shard_dir, manifest)
+    final.to_csv(os.path.join(train_path,'caption_' + args.language +'.csv'), index=False, header=final.columns)
@@ -1,8 +1,15 @@
 import pandas as pd
 import os
+import argparse
+from preprocess.manifest import add_image_info, write_manifest, MANIFEST
 
 #ImageCLEF 2019 - MED VQA
-data_dir = os.path.join('..', 'ImageClef-2019-VQA-Med')
+parser = argparse.ArgumentParser(description="preprocess vqamed2019")
+parser.add_argument('--task', type=str, choices=['dataframe', 'manifest'], default='dataframe', help="csv dataframes or columnar manifests (read by load_data)")
+parser.add_argument('--data_dir', type=str, default = os.path.join('..', 'ImageClef-2019-VQA-Med'), help='path to dataset')
+args = parser.parse_args()
+
+data_dir = args.data_dir
 train_dir = os.path.join(data_dir, 'Train')
 val_dir = os.path.join(data_dir, 'Val')
 test_dir = os.path.join(data_dir, 'Test')
@@ -23,9 +30,19 @@ def create_df(d_dir, mode):
         df.loc[df.answer == 'yes', 'category'] = 'binary'
 
         res = pd.concat([res,df])
-        
+
     return res
 
+def build_manifest(df, d_dir):
+    # same columns as the csv dataframes, lowercased as in load_data, plus the image info
+    df = df.reset_index(drop=True)
+    df['category'] = df['category'].str.lower()
+    df['answer'] = df['answer'].str.lower()
+    df['path'] = os.path.basename(d_dir) + '/images/' + df['img_id'] + '.jpg'
+    df = add_image_info(df, data_dir)
+    write_manifest(df, os.path.join(d_dir, MANIFEST))
+    return df
+
 train_df = create_df(train_dir, 'train')
 val_df = create_df(val_dir, 'val')
 
@@ -37,6 +54,12 @@ test_df['mode'] = ['test'] * test_df.shape[0]
 cols = train_df.columns.tolist()
 test_df = test_df[cols]
 
-train_df.to_csv(os.path.join(train_dir, 'traindf.csv'), index=False, columns=cols)
-val_df.to_csv(os.path.join(val_dir, 'valdf.csv'), index=False, columns=cols)
-test_df.to_csv(os.path.join(test_dir, 'testdf.csv'), index=False, columns=cols)
\ No newline at end of file
+if args.task == 'dataframe':
+    train_df.to_csv(os.path.join(train_dir, 'traindf.csv'), index=False, columns=cols)
+    val_df.to_csv(os.path.join(val_dir, 'valdf.csv'), index=False, columns=cols)
+    test_df.to_csv(os.path.join(test_dir, 'testdf.csv'), index=False, columns=cols)
+
+if args.task == 'manifest':
+    build_manifest(train_df, train_dir)
+    build_manifest(val_df, val_dir)
+    build_manifest(test_df, test_dir)
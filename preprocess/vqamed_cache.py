@@ -0,0 +1,132 @@
+import os
+import json
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+from PIL import Image
+from torchvision import transforms
+from tqdm import tqdm
+
+# memory-mapped stores of the VQA-Med inputs, decoded once and shared read-only by the data loaders of concurrent
+# trainings (vqamed2019/sweep.py, --data_cache of train.py), in <data_dir>/cache:
+# images_<size>.npy (n, size, size, 3) uint8 images after the Resize(size) + CenterCrop(size) that start the
+# train/val/test transforms of train.py and eval.py, with size = --image_size (the datasets apply the whole transform
+# to the cached image, these two are then identities as long as the store and the transforms use the same
+# --image_size), with images_<size>.arrow (path relative to data_dir, row) and images_<size>.json, one store per
+# --image_size, and questions_<tokenizer>_<max_position_embeddings>.npy (n, 3, length) int32
+# token ids, segment ids and mask of encode_text, with questions_<...>.arrow (question, row)
+# e.g. python preprocess/vqamed_cache.py --data_dir ../ImageClef-2019-VQA-Med --max_position_embeddings 28
+
+def get_cache_dir(data_dir):
+    return os.path.join(data_dir, 'cache')
+
+def get_tokenizer_name(args):
+    return 'bert-base-uncased' if args.task == 'MLM' else args.clinicalbert
+
+def get_image_store(size):
+    return f'images_{size}'
+
+def get_question_store(args):
+    return f"questions_{get_tokenizer_name(args).replace('/', '_')}_{args.max_position_embeddings}"
+
+def read_index(path, key):
+    index = feather.read_table(path).to_pandas()
+    return dict(zip(index[key], index['row']))
+
+def decode_image(item):
+    path, size = item
+    tfm = transforms.Compose([transforms.Resize(size), transforms.CenterCrop(size)])
+    return np.asarray(tfm(Image.open(path).convert('RGB')), dtype=np.uint8)
+
+def build_image_cache(data_dir, paths, size=224, workers=8):
+    cache_dir = get_cache_dir(data_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    rel = sorted({os.path.relpath(p, data_dir) for p in paths})
+    name = os.path.join(cache_dir, get_image_store(size))
+    if os.path.exists(name + '.arrow') and os.path.exists(name + '.json') and set(rel) <= set(read_index(name + '.arrow', 'path')):
+        with open(name + '.json') as f:
+            if json.load(f)['size'] == size:
+                print('image cache up to date:', name)
+                return
+    images = np.lib.format.open_memmap(name + '.npy', mode='w+', dtype=np.uint8, shape=(len(rel), size, size, 3))
+    with Pool(workers) as pool:
+        items = [(os.path.join(data_dir, p), size) for p in rel]
+        for i, img in enumerate(tqdm(pool.imap(decode_image, items, chunksize=16), total=len(items), desc='images')):
+            images[i] = img
+    images.flush()
+    feather.write_feather(pd.DataFrame({'path': rel, 'row': np.arange(len(rel))}), name + '.arrow', compression='uncompressed')
+    with open(name + '.json', 'w') as f:
+        json.dump({'size': size, 'count': len(rel)}, f)
+    print(f'{len(rel)} images -> {name}')
+
+def build_question_cache(data_dir, questions, args, tokenizer, encode_text):
+    cache_dir = get_cache_dir(data_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    name = get_question_store(args)
+    questions = sorted(set(questions))
+    index_path = os.path.join(cache_dir, name + '.arrow')
+    if os.path.exists(index_path) and set(questions) <= set(read_index(index_path, 'question')):
+        print('question cache up to date:', index_path)
+        return
+    encoded = np.lib.format.open_memmap(os.path.join(cache_dir, name + '.npy'), mode='w+', dtype=np.int32, shape=(len(questions), 3, args.max_position_embeddings))
+    for i, q in enumerate(tqdm(questions, desc='questions')):
+        encoded[i] = encode_text(q, tokenizer, args)
+    encoded.flush()
+    feather.write_feather(pd.DataFrame({'question': questions, 'row': np.arange(len(questions))}), index_path, compression='uncompressed')
+    print(f'{len(questions)} questions -> {os.path.join(cache_dir, name)}')
+
+class ImageCache:
+    '''cached images of a size by path, None for the ones that are not in the store'''
+    def __init__(self, data_dir, size):
+        self.data_dir = data_dir
+        self.path = os.path.join(get_cache_dir(data_dir), get_image_store(size))
+        with open(self.path + '.json') as f:
+            assert json.load(f)['size'] == size, f'{self.path} does not hold {size}px images'
+        self.index = read_index(self.path + '.arrow', 'path')
+        self.images = None # opened lazily, in each data loader worker
+
+    def get(self, path):
+        row = self.index.get(os.path.relpath(path, self.data_dir))
+        if row is None:
+            return None
+        if self.images is None:
+            self.images = np.load(self.path + '.npy', mmap_mode='r')
+        return Image.fromarray(np.array(self.images[row]))
+
+class QuestionCache:
+    '''(tokens, segment ids, mask) of a question, None for the ones that are not in the store'''
+    def __init__(self, data_dir, args):
+        self.path = os.path.join(get_cache_dir(data_dir), get_question_store(args))
+        self.index = read_index(self.path + '.arrow', 'question')
+        self.encoded = None
+
+    def get(self, question):
+        row = self.index.get(question)
+        if row is None:
+            return None
+        if self.encoded is None:
+            self.encoded = np.load(self.path + '.npy', mmap_mode='r')
+        tokens, segment_ids, input_mask = np.array(self.encoded[row], dtype=np.int64)
+        return tokens, segment_ids, input_mask
+
+if __name__ == '__main__':
+    from transformers import BertTokenizer, AutoTokenizer
+    from vqamed2019.utils import load_data, encode_text
+
+    parser = argparse.ArgumentParser(description="decode the VQA-Med images and encode the questions once")
+    parser.add_argument('--data_dir', type=str, default='../ImageClef-2019-VQA-Med', help='path for data')
+    parser.add_argument('--image_size', type=int, default=224, help='size of the cached images')
+    parser.add_argument('--max_position_embeddings', type=int, default=28, help='max length of sequence')
+    parser.add_argument('--task', type=str, default='MLM', choices=['MLM', 'distillation'], help='task which the model was pre-trained on (tokenizer)')
+    parser.add_argument('--clinicalbert', type=str, default='emilyalsentzer/Bio_ClinicalBERT')
+    parser.add_argument('--workers', type=int, default=8, help='image decoding processes')
+    args = parser.parse_args()
+    args.train_pct = args.valid_pct = args.test_pct = 1.0
+
+    df = pd.concat(load_data(args))
+    build_image_cache(args.data_dir, df['img_id'], args.image_size, args.workers)
+    name = get_tokenizer_name(args)
+    tokenizer = BertTokenizer.from_pretrained(name) if args.task == 'MLM' else AutoTokenizer.from_pretrained(name)
+    build_question_cache(args.data_dir, df['question'], args, tokenizer, encode_text)
@@ -0,0 +1,101 @@
+import argparse
+import copy
+import time
+import json
+
+import torch
+import torch.nn as nn
+from torch import optim
+
+from models.mmbert import Model
+
+# peak memory vs step time of a ROCO MLM training step for several --checkpoint_activations / --checkpoint_every settings
+# e.g. python pretrain/benchmark_checkpointing.py --cnn_encoder='tf_efficientnetv2_m' --transformer_model='realformer' --batch_size=32
+
+def parse_setting(setting):
+    mode, every = setting.split(':') if ':' in setting else (setting, 1)
+    return mode, int(every)
+
+def random_batch(args, device):
+    img = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    input_ids = torch.randint(1, args.vocab_size, (args.batch_size, args.max_position_embeddings), device=device)
+    segment_ids = torch.zeros_like(input_ids)
+    input_mask = torch.ones_like(input_ids)
+    target = torch.randint(0, args.vocab_size, (args.batch_size, args.max_position_embeddings), device=device)
+    return img, input_ids, segment_ids, input_mask, target
+
+def benchmark(args, setting, device):
+    run_args = copy.copy(args)
+    run_args.checkpoint_activations, run_args.checkpoint_every = parse_setting(setting)
+
+    model = Model(run_args).to(device)
+    model.train()
+    optimizer = optim.Adam(model.parameters(), lr=2e-5)
+    criterion = nn.NLLLoss()
+    img, input_ids, segment_ids, input_mask, target = random_batch(args, device)
+
+    def step():
+        optimizer.zero_grad()
+        logits = model(img, input_ids, segment_ids, input_mask)
+        loss = criterion(logits.log_softmax(-1).permute(0,2,1), target)
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(args.warmup):
+        step()
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start) / args.steps
+    peak_mem = torch.cuda.max_memory_allocated() / 2**20 if device == 'cuda' else float('nan')
+
+    del model, optimizer
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+    return {'setting': setting, 'peak_mem_mb': peak_mem, 'step_time_ms': step_time * 1000}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Activation checkpointing benchmark")
+
+    parser.add_argument('--settings', nargs='+', default=['none', 'encoder:1', 'encoder:2', 'backbone:1', 'backbone:2', 'backbone:4', 'all:1', 'all:2'],
+                        help='list of checkpoint_activations:checkpoint_every settings to compare')
+    parser.add_argument('--steps', type=int, default=10, help='timed steps per setting')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed steps per setting')
+    parser.add_argument('--output', type=str, default=None, help='optional json file for the report')
+
+    parser.add_argument('--batch_size', type=int, default=16, help='batch_size.')
+    parser.add_argument('--image_size', type=int, default=224, help='image size')
+    parser.add_argument('--task', type=str, default='MLM', choices=['MLM'], help='pretrain task for the model to be trained on')
+    parser.add_argument('--dataset', type=str, default='roco', help='roco or vqamed2019')
+    parser.add_argument('--max_position_embeddings', type=int, default=75, help='embedding size')
+    parser.add_argument('--n_layers', type=int, default=4, help='num of heads in multihead attenion')
+    parser.add_argument('--heads', type=int, default=12, help='num of bertlayers')
+    parser.add_argument('--vocab_size', type=int, default=30522, help='vocabulary size')
+    parser.add_argument('--hidden_size', type=int, default=768, help='embedding size')
+    parser.add_argument('--hidden_dropout_prob', type=float, default=0.3, help='dropout')
+    parser.add_argument('--cnn_encoder', type=str, default='tf_efficientnetv2_m', help='name of the cnn encoder')
+    parser.add_argument('--transformer_model', type=str, default='realformer',choices=['transformer', 'realformer'], help='name of the transformer model')
+    parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--num_vis', type = int, default=5, help = "num of visual embeddings")
+
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    report = [benchmark(args, setting, device) for setting in args.settings]
+
+    base = report[0]
+    print(f'| setting | peak memory (MB) | step time (ms) | memory vs {base["setting"]} | time vs {base["setting"]} |')
+    print('| :--- | ---: | ---: | ---: | ---: |')
+    for r in report:
+        print(f'| {r["setting"]} | {r["peak_mem_mb"]:.0f} | {r["step_time_ms"]:.1f} | {r["peak_mem_mb"] / base["peak_mem_mb"]:.2f}x | {r["step_time_ms"] / base["step_time_ms"]:.2f}x |')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,74 @@
+import argparse
+import time
+import json
+
+import torch
+
+from models.feedback_transformer_pytorch import FeedbackTransformer
+
+# forward time of the feedback transformer of get_transformer_model ('feedback-transformer', same settings as
+# models/mmbert.py::FeedBackTransformer) on ROCO-sized sequences, with the ring-buffer memory and with the
+# concatenated memory. The ring buffer is only used without autograd, the train row is the reference
+# e.g. python pretrain/benchmark_feedback.py --batch_size 32 --max_position_embeddings 75
+
+def benchmark(args, ring_memory, train, device):
+    model = FeedbackTransformer(num_tokens = args.vocab_size, dim = args.hidden_size, depth = args.n_layers, seq_len = 2,
+                                mem_len = 256, dim_head = 64, heads = 8, attn_dropout = 0.1, ff_dropout = 0.1, ring_memory = ring_memory).to(device)
+    model.train(train)
+    h = torch.randn(args.batch_size, args.max_position_embeddings, args.hidden_size, device=device)
+
+    def step():
+        if train:
+            model.zero_grad()
+            model(h).sum().backward()
+        else:
+            with torch.no_grad():
+                model(h)
+
+    for _ in range(args.warmup):
+        step()
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start) / args.steps
+    peak_mem = torch.cuda.max_memory_allocated() / 2**20 if device == 'cuda' else float('nan')
+
+    del model
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+    return {'mode': 'train' if train else 'eval', 'memory': 'ring' if ring_memory else 'cat', 'peak_mem_mb': peak_mem, 'step_time_ms': step_time * 1000}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Feedback transformer memory benchmark")
+
+    parser.add_argument('--steps', type=int, default=10, help='timed steps per setting')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed steps per setting')
+    parser.add_argument('--output', type=str, default=None, help='optional json file for the report')
+
+    parser.add_argument('--batch_size', type=int, default=16, help='batch_size.')
+    parser.add_argument('--max_position_embeddings', type=int, default=75, help='sequence length')
+    parser.add_argument('--n_layers', type=int, default=4, help='num of bertlayers')
+    parser.add_argument('--vocab_size', type=int, default=30522, help='vocabulary size')
+    parser.add_argument('--hidden_size', type=int, default=768, help='embedding size')
+
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    # with autograd the model always uses the concatenated memory
+    report = [benchmark(args, False, False, device), benchmark(args, True, False, device), benchmark(args, False, True, device)]
+
+    print('| mode | memory | peak memory (MB) | step time (ms) |')
+    print('| :--- | :--- | ---: | ---: |')
+    for r in report:
+        print(f'| {r["mode"]} | {r["memory"]} | {r["peak_mem_mb"]:.0f} | {r["step_time_ms"]:.1f} |')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
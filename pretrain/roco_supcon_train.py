@@ -14,9 +14,11 @@ from torch.optim import lr_scheduler
 from roco_utils import load_mlm_data,get_keywords, ROCO#, validate
 
 from models.mmbert import Model, get_transformer_model
+from models.profiling import attach_profiler
+from models.safetensors_utils import save_model, save_recorder, load_recorder, load_state_dict
 
 from models.SupConLoss.supcon_utils import ROCO_SupCon, train_one_epoch, get_supcon_model, TwoCropTransform, validate, SimilarityCalculator
-from models.SupConLoss.loss import SupConLoss
+from models.SupConLoss.loss import SupConLoss, SupConMemoryBankLoss
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -41,10 +43,15 @@ if __name__ == '__main__':
     parser.add_argument('--similarity', type=str, default='jaccard_similarity',
     choices=['jaccard', 'cosine','sentence_transformers','bert_score'], help='similarity to build mask for SupCon loss', required=True)
     parser.add_argument('--bert_score', type=str, default='bert',choices=['bert', 'scibert'], help='name of model for BERTscore')
+    parser.add_argument('--memory_bank', type=int, default=0, help='size of the FIFO memory bank of past features for the contrastive loss (0 = batch only)')
+    parser.add_argument('--bank_chunk_size', type=int, default=1024, help='anchors per chunk in the memory bank loss')
+    parser.add_argument('--caption_embeddings', type=str, default=None, help='caption embeddings store from preprocess/caption_embeddings.py, replaces the sentence_transformers/cosine model in training')
 
     parser.add_argument('--max_token_length', type=int, default=512, help='max token length for the transformer in distillation')
 
     parser.add_argument('--batch_size', type=int, default=16, help='batch_size.')
+    parser.add_argument('--grad_cache', action='store_true', required = False, default = False,  help='gradient cache: --batch_size is the logical batch, forwarded in chunks of --gc_chunk_size')
+    parser.add_argument('--gc_chunk_size', type=int, default=16, help='number of samples (both views count) in each forward/backward chunk with --grad_cache')
     parser.add_argument('--lr', type=float, default=2e-5, help='learning rate')
     parser.add_argument('--patience', type=int, default=5, help='rlp patience')
     parser.add_argument('--factor', type=float, default=0.1, help='rlp factor')
@@ -68,6 +75,14 @@ if __name__ == '__main__':
     parser.add_argument('--cnn_encoder', type=str, default='resnet152', help='name of the cnn encoder')
     parser.add_argument('--transformer_model', type=str, default='transformer',choices=['transformer', 'realformer', 'feedback-transformer'], help='name of the transformer model')
     parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--safetensors', action='store_true', default=False, help="save models and recorders as safetensors instead of .pt")
+    parser.add_argument('--save_fp16', action='store_true', default=False, help="store the saved model weights in fp16 (with --safetensors)")
+    parser.add_argument('--profile', action='store_true', default=False, help='record per-module time, FLOPs, activations and memory (models/profiling.py)')
+    parser.add_argument('--profile_steps', type=int, nargs=2, default=[5, 25], help='optimizer steps [start, end) measured by --profile')
+    parser.add_argument('--profile_trace', type=int, nargs=2, default=None, help='optimizer steps [start, end) of a torch.profiler trace (with --profile)')
+    parser.add_argument('--profile_output', type=str, default=None, help='json report of --profile (default: <save_dir>/profile_<run_name>.json)')
+    parser.add_argument('--checkpoint_activations', type=str, default='none', choices=['none', 'backbone', 'encoder', 'all'], help='recompute the activations of these parts in the backward pass to save memory')
+    parser.add_argument('--checkpoint_every', type=int, default=1, help='backbone stages / encoder blocks in each checkpointed segment')
 
     parser.add_argument('--num_vis', type = int, default=5, help = "num of visual embeddings")
 
@@ -76,13 +91,11 @@ if __name__ == '__main__':
     #torch.autograd.set_detect_anomaly(True)
 
     assert args.dataset in args.data_dir
+    assert args.caption_embeddings is None or args.similarity in ['sentence_transformers', 'cosine'], 'caption embeddings are only for sentence_transformers and cosine similarities'
     wandb.init(project='medvqa', name = args.run_name, config = args)
 
-    train_data, val_data  = load_mlm_data(args)
-    # No Image: PMC4240561_MA-68-291-g002.jpg
-    train_data = train_data[train_data['name']!='PMC4345544_yjbm_88_1_93_g04.jpg'].reset_index(drop=True)
-    train_data = train_data[train_data['name']!='PMC4240561_MA-68-291-g002.jpg'].reset_index(drop=True) #no image
-    train_data = train_data[train_data['name']!='PMC4093298_jadp-03-059-g02.jpg'].reset_index(drop=True) #no caption
+    train_data, val_data  = load_mlm_data(args) # without the broken images (preprocess/scan_images.py) and empty captions
+    train_data = train_data.reset_index(drop=True)
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -100,10 +113,15 @@ if __name__ == '__main__':
     wandb.watch(model, log='all')
 
     optimizer = optim.Adam(model.parameters(),lr=args.lr)
+    profiler = attach_profiler(model, optimizer, args)
     scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, patience = args.patience, factor = args.factor, verbose = True)
     
     criterion = nn.NLLLoss()
-    supcon_loss = SupConLoss()
+    if args.memory_bank > 0:
+        print('Using memory bank of size', args.memory_bank)
+        supcon_loss = SupConMemoryBankLoss(bank_size=args.memory_bank, chunk_size=args.bank_chunk_size).to(device)
+    else:
+        supcon_loss = SupConLoss()
 
     train_tfm = TwoCropTransform(transforms.Compose([
                                 
@@ -143,9 +161,9 @@ if __name__ == '__main__':
     if args.resume:
         print('Resuming training')
         if args.no_recorder:
-            model.load_state_dict(torch.load(args.resume_dir))
+            model.load_state_dict(load_state_dict(args.resume_dir))
         else:
-            ckpt = torch.load(os.path.join(args.save_dir, 'recorder_2.pt'))
+            ckpt = load_recorder(os.path.join(args.save_dir, 'recorder_2.pt'))
             model.load_state_dict(ckpt['model'])
             optimizer.load_state_dict(ckpt['optimizer'])
             scheduler.load_state_dict(ckpt['scheduler'])
@@ -163,7 +181,7 @@ if __name__ == '__main__':
     else:
         best_loss = np.inf
 
-    save_recorder = 5
+    recorder_every = 5
 
     for epoch in range(args.epochs):
         
@@ -175,14 +193,14 @@ if __name__ == '__main__':
 
         scheduler.step(val_loss)
 
-        if (epoch + 1) % save_recorder == 0:
+        if (epoch + 1) % recorder_every == 0:
             recorder = {'epoch': epoch,
                     'optimizer': optimizer.state_dict(),
                     'scheduler': scheduler.state_dict(),
                     'scaler': scaler.state_dict(),
                     'model': model.state_dict()}
 
-            torch.save(recorder, os.path.join(args.save_dir, 'recorder_2.pt'))
+            save_recorder(recorder, os.path.join(args.save_dir, 'recorder_2.pt'), args)
             
 
         wandb.log({'epoch_train_loss': train_loss,
@@ -198,5 +216,8 @@ if __name__ == '__main__':
         
         if val_loss<best_loss:
             print('Saving model')
-            torch.save(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '.pt'))
+            save_model(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '.pt'), args)
             best_loss=val_loss
+
+    if profiler is not None:
+        profiler.report()
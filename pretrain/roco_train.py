@@ -15,6 +15,8 @@ from torch.optim import lr_scheduler
 from roco_utils import load_mlm_data, train_one_epoch, validate, get_keywords, ROCO, train_one_epoch_test_parameters,validate_test_parameters#, Model
 
 from models.mmbert import Model, get_transformer_model
+from models.profiling import attach_profiler
+from models.safetensors_utils import save_model, save_recorder, load_recorder, load_state_dict
 
 if __name__ == '__main__':
     __spec__ = None
@@ -31,6 +33,7 @@ if __name__ == '__main__':
                         choices=['MLM', 'distillation'], help='pretrain task for the model to be trained on')
     parser.add_argument('--clinicalbert', type=str, default='emilyalsentzer/Bio_ClinicalBERT')
     parser.add_argument('--max_token_length', type=int, default=512, help='max token length for the transformer in distillation')
+    parser.add_argument('--teacher_targets', action='store_true', default=False, help='read the ClinicalBERT targets of distillation from the store of preprocess/teacher_targets.py instead of running the teacher in the data loader')
 
     parser.add_argument('--batch_size', type=int, default=16, help='batch_size.')
     parser.add_argument('--lr', type=float, default=2e-5, help='learning rate')
@@ -58,6 +61,14 @@ if __name__ == '__main__':
 
     parser.add_argument('--num_vis', type = int, default=5, help = "num of visual embeddings")
     parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--safetensors', action='store_true', default=False, help="save models and recorders as safetensors instead of .pt")
+    parser.add_argument('--save_fp16', action='store_true', default=False, help="store the saved model weights in fp16 (with --safetensors)")
+    parser.add_argument('--profile', action='store_true', default=False, help='record per-module time, FLOPs, activations and memory (models/profiling.py)')
+    parser.add_argument('--profile_steps', type=int, nargs=2, default=[5, 25], help='optimizer steps [start, end) measured by --profile')
+    parser.add_argument('--profile_trace', type=int, nargs=2, default=None, help='optimizer steps [start, end) of a torch.profiler trace (with --profile)')
+    parser.add_argument('--profile_output', type=str, default=None, help='json report of --profile (default: <save_dir>/profile_<run_name>.json)')
+    parser.add_argument('--checkpoint_activations', type=str, default='none', choices=['none', 'backbone', 'encoder', 'all'], help='recompute the activations of these parts in the backward pass to save memory')
+    parser.add_argument('--checkpoint_every', type=int, default=1, help='backbone stages / encoder blocks in each checkpointed segment')
 
     args = parser.parse_args()
     
@@ -65,11 +76,8 @@ if __name__ == '__main__':
     wandb.init(project='medvqa', name = args.run_name, config = args)
 
 
-    train_data, val_data  = load_mlm_data(args)
-    # No Image: PMC4240561_MA-68-291-g002.jpg
-    train_data = train_data[train_data['name']!='PMC4345544_yjbm_88_1_93_g04.jpg'].reset_index(drop=True)
-    train_data = train_data[train_data['name']!='PMC4240561_MA-68-291-g002.jpg'].reset_index(drop=True) #no image
-    train_data = train_data[train_data['name']!='PMC4093298_jadp-03-059-g02.jpg'].reset_index(drop=True) #no caption
+    train_data, val_data  = load_mlm_data(args) # without the broken images (preprocess/scan_images.py) and empty captions
+    train_data = train_data.reset_index(drop=True)
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -88,6 +96,7 @@ if __name__ == '__main__':
     # print('encoder with grad=truee')
 
     optimizer = optim.Adam(model.parameters(),lr=args.lr)
+    profiler = attach_profiler(model, optimizer, args)
     scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, patience = args.patience, factor = args.factor, verbose = True)
     if args.task == 'MLM':
         criterion = nn.NLLLoss()
@@ -129,7 +138,7 @@ if __name__ == '__main__':
     scaler = GradScaler()
 
     if args.resume:
-        ckpt = torch.load(os.path.join(args.save_dir, 'recorder_2.pt'))
+        ckpt = load_recorder(os.path.join(args.save_dir, 'recorder_2.pt'))
         model.load_state_dict(ckpt['model'])
         optimizer.load_state_dict(ckpt['optimizer'])
         scheduler.load_state_dict(ckpt['scheduler'])
@@ -147,7 +156,7 @@ if __name__ == '__main__':
     else:
         best_loss = np.inf
 
-    save_recorder = 5
+    recorder_every = 5
 
     # val_loss, predictions, acc = validate(valloader, model, criterion, scaler, device, args, epoch=0, rec=False)
     # best_loss = val_loss
@@ -161,14 +170,14 @@ if __name__ == '__main__':
 
         scheduler.step(val_loss)
 
-        if (epoch + 1) % save_recorder == 0:
+        if (epoch + 1) % recorder_every == 0:
             recorder = {'epoch': epoch,
                     'optimizer': optimizer.state_dict(),
                     'scheduler': scheduler.state_dict(),
                     'scaler': scaler.state_dict(),
                     'model': model.state_dict()}
 
-            torch.save(recorder, os.path.join(args.save_dir, 'recorder_2.pt'))
+            save_recorder(recorder, os.path.join(args.save_dir, 'recorder_2.pt'), args)
             
 
         if args.task == 'MLM':
@@ -193,6 +202,8 @@ if __name__ == '__main__':
         
         if val_loss<best_loss:
             print('Saving model')
-            torch.save(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '.pt'))
+            save_model(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '.pt'), args)
             best_loss=val_loss
 
+    if profiler is not None:
+        profiler.report()
@@ -23,6 +23,10 @@ from transformers import BertTokenizer, BertModel
 import os
 from PIL import Image
 from transformers import AutoTokenizer, AutoModel
+from preprocess.manifest import get_manifest_path, read_manifest, INFO_COLUMNS
+from preprocess.scan_images import require_valid_images
+from preprocess.teacher_targets import get_teacher_dir
+import pyarrow.feather as feather
 
 def seed_everything(seed):
     random.seed(seed)
@@ -73,17 +77,30 @@ def load_mlm_data(args):
     val_path = os.path.join(args.data_dir,'validation','radiology')
     test_path = os.path.join(args.data_dir,'test','radiology')
 
-    train_image_names = os.listdir(os.path.join(train_path,'images'))
-    val_image_names = os.listdir(os.path.join(val_path,'images'))
-    # train_image_names = load_image_names(train_path,'train')
-    # val_image_names = load_image_names(val_path,'val')
-    # test_image_names = os.listdir(os.path.join(test_path,'images'))
-
-    train_data = pd.read_csv(os.path.join(train_path,'traindata.csv'))
-    train_data = train_data[train_data['name'].isin(train_image_names)]
-
-    val_data = pd.read_csv(os.path.join(val_path, 'valdata.csv'))
-    val_data = val_data[val_data['name'].isin(val_image_names)]
+    train_manifest = get_manifest_path(train_path)
+    val_manifest = get_manifest_path(val_path)
+    if train_manifest and val_manifest:
+        # preprocess/roco_data.py --task manifest: valid items only, dataset columns first (id, name, caption, translations)
+        train_data = read_manifest(train_manifest, exclude=INFO_COLUMNS)
+        val_data = read_manifest(val_manifest, exclude=INFO_COLUMNS)
+    else:
+        # images that decode, the directories are scanned (preprocess/scan_images.py) if they have no cached scan
+        workers = args.num_workers if hasattr(args, 'num_workers') and args.num_workers else 8
+        train_image_names = require_valid_images(os.path.join(train_path,'images'), workers)
+        val_image_names = require_valid_images(os.path.join(val_path,'images'), workers)
+        # train_image_names = load_image_names(train_path,'train')
+        # val_image_names = load_image_names(val_path,'val')
+        # test_image_names = os.listdir(os.path.join(test_path,'images'))
+
+        train_data = pd.read_csv(os.path.join(train_path,'traindata.csv'))
+        train_data = train_data[train_data['name'].isin(train_image_names)]
+
+        val_data = pd.read_csv(os.path.join(val_path, 'valdata.csv'))
+        val_data = val_data[val_data['name'].isin(val_image_names)]
+
+        # no caption
+        train_data = train_data[train_data['caption'].fillna('').str.strip() != '']
+        val_data = val_data[val_data['caption'].fillna('').str.strip() != '']
 
     # test_data = pd.read_csv(os.path.join(test_path, 'testdata.csv'))
     # test_data = test_data[test_data['name'].isin(test_image_names)]
@@ -109,7 +126,7 @@ def shuffle_list(some_list):
 def gelu(x):
     return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
 
-def distillation(caption, tokenizer, clinicalbert, args):
+def distillation(caption, tokenizer, clinicalbert, args, targets=None):
     output_label = []
     new_tokens = []
 
@@ -117,6 +134,12 @@ def distillation(caption, tokenizer, clinicalbert, args):
 
     new_tokens.extend(t)
 
+    if targets is not None:
+        # precomputed by preprocess/teacher_targets.py, only the tokens that fit in the sequence are stored
+        keep = args.max_position_embeddings - (args.num_vis + 3)
+        assert (min(len(new_tokens), keep)==targets.shape[0]), "Token len must be equal to label len"
+        return new_tokens, targets
+
     item = tokenizer(caption, truncation=True) 
     with torch.no_grad():
         input_ids = torch.tensor(item['input_ids'], dtype=torch.long).unsqueeze(dim=0)
@@ -159,7 +182,7 @@ def mask_word(sentence, tokenizer, keywords, args):
     
     return  new_tokens, output_label
 
-def encode_text(caption,tokenizer, keywords, args, clinicalbert):
+def encode_text(caption,tokenizer, keywords, args, clinicalbert, targets=None):
     TOTAL_SPECIAL_TOKENS = args.num_vis + 3 #at least the visual tokens and [CLS] and two [SEP] will be used
     part1 = [0 for _ in range(args.num_vis)]
     
@@ -168,7 +191,7 @@ def encode_text(caption,tokenizer, keywords, args, clinicalbert):
         caption, labels = mask_word(caption, tokenizer, keywords, args)
     elif args.task == 'distillation':
         #part1 = [torch.zeros(768, dtype=torch.float) for _ in range(5)]
-        caption, labels = distillation(caption, tokenizer, clinicalbert, args)
+        caption, labels = distillation(caption, tokenizer, clinicalbert, args, targets)
 
     
     part2 = tokenizer.convert_tokens_to_ids(caption)
@@ -193,8 +216,9 @@ def encode_text(caption,tokenizer, keywords, args, clinicalbert):
         # labels.extend([torch.zeros(768, dtype=torch.float)]*(n_pad))
         # labels = torch.stack(labels,dim=0)
 
-        labels = torch.cat([torch.zeros((2+len(part1)),768, dtype=torch.float), labels, torch.zeros(1,768, dtype=torch.float)], dim=0)
-        labels = torch.cat([labels, torch.zeros(n_pad, 768, dtype=torch.float)], dim=0)
+        # fp16 with precomputed targets, cast to float on the device
+        labels = torch.cat([torch.zeros((2+len(part1)),768, dtype=labels.dtype), labels, torch.zeros(1,768, dtype=labels.dtype)], dim=0)
+        labels = torch.cat([labels, torch.zeros(n_pad, 768, dtype=labels.dtype)], dim=0)
 
     return torch.tensor(tokens,dtype=torch.long), torch.tensor(segment_ids,dtype=torch.long), torch.tensor(input_mask,dtype=torch.long), labels#torch.tensor(labels)
 
@@ -228,14 +252,14 @@ def train_one_epoch(loader, model, criterion, optimizer, scaler, device, args, e
                     logits = logits.log_softmax(-1)  # (bs x seq_len x vocab_size)
                     loss = loss_func(logits.permute(0,2,1), target)
                 elif args.task == 'distillation':
-                    loss = loss_func(logits, target)
+                    loss = loss_func(logits, target.float())
         else:
             logits = model(img, caption_token, segment_ids, attention_mask)
             if args.task == 'MLM':
                     logits = logits.log_softmax(-1)  # (bs x seq_len x vocab_size)
                     loss = loss_func(logits.permute(0,2,1), target)
             elif args.task == 'distillation':
-                loss = loss_func(logits, target)   
+                loss = loss_func(logits, target.float())   
 
 
         if args.mixed_precision:
@@ -314,14 +338,14 @@ def validate(loader, model, criterion, scaler, device, args, epoch, rec=True):
                         logits = logits.log_softmax(-1)  # (bs x seq_len x vocab_size)
                         loss = loss_func(logits.permute(0,2,1), target)
                     elif args.task == 'distillation':
-                        loss = loss_func(logits, target)
+                        loss = loss_func(logits, target.float())
             else:
                 logits = model(img, caption_token, segment_ids, attention_mask)
                 if args.task == 'MLM':
                     logits = logits.log_softmax(-1)  # (bs x seq_len x vocab_size)
                     loss = loss_func(logits.permute(0,2,1), target)
                 elif args.task == 'distillation':
-                    loss = loss_func(logits, target)
+                    loss = loss_func(logits, target.float())
                     #import IPython; IPython.embed(); exit(0)       
 
 
@@ -542,6 +566,23 @@ def validate_test_parameters(loader, model, criterion, scaler, device, args, epo
 
     return np.mean(val_loss), None, total_acc
 
+class TeacherTargets():
+    '''reader of a store of preprocess/teacher_targets.py, opened lazily so that every
+    DataLoader worker memory-maps the file instead of receiving a copy'''
+    def __init__(self, path):
+        if not os.path.exists(os.path.join(path, 'targets.npy')):
+            raise FileNotFoundError(f'{path}: run preprocess/teacher_targets.py first')
+        self.path = path
+        index = feather.read_feather(os.path.join(path, 'index.arrow'))
+        self.rows = dict(zip(index['name'], zip(index['offset'], index['length'])))
+        self.targets = None
+
+    def get(self, name):
+        if self.targets is None:
+            self.targets = np.load(os.path.join(self.path, 'targets.npy'), mmap_mode='r')
+        offset, length = self.rows[name]
+        return torch.from_numpy(np.array(self.targets[offset:offset + length]))
+
 class ROCO(Dataset):
     def __init__(self, args, df, tfm, keys, mode):
         self.df = df.values
@@ -557,9 +598,13 @@ class ROCO(Dataset):
             self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
 
         self.clinicalbert = None
+        self.teacher = None
 
         if args.task == 'distillation':
-            self.clinicalbert = AutoModel.from_pretrained(args.clinicalbert)
+            if args.teacher_targets if hasattr(args, 'teacher_targets') else False:
+                self.teacher = TeacherTargets(get_teacher_dir(os.path.join(self.path, mode, 'radiology'), args.clinicalbert))
+            else:
+                self.clinicalbert = AutoModel.from_pretrained(args.clinicalbert)
         
     def __len__(self):
         return len(self.df)
@@ -582,7 +627,8 @@ class ROCO(Dataset):
         #caption = self.df.iloc[idx]['caption'].strip()
         
         
-        tokens, segment_ids, input_mask, targets = encode_text(caption, self.tokenizer, self.keys, self.args, self.clinicalbert)
+        teacher = self.teacher.get(name) if self.teacher is not None else None
+        tokens, segment_ids, input_mask, targets = encode_text(caption, self.tokenizer, self.keys, self.args, self.clinicalbert, teacher)
 
         return img, tokens, segment_ids, input_mask, targets
 
@@ -0,0 +1,115 @@
+import argparse
+from utils import seed_everything, load_data, VQAMed
+import pandas as pd
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from tqdm import tqdm
+
+from models.mmbert import Model
+from models.safetensors_utils import load_state_dict
+
+# attention rollout (Abnar & Zuidema, 2020) of the VQA model: the attention maps of every encoder layer
+# (Model(..., output_attentions=True)) are averaged over the heads, mixed with the identity for the
+# residual connection and multiplied from the first to the last layer. The answer head mean-pools the
+# question tokens, so the relevance of a token is the mean over the non padded rows of the rollout.
+# No backward pass, the relevance of the visual tokens of a whole split comes from its forward passes
+# e.g. python vqamed2019/attention_rollout.py --mode Val --model_dir mmbert/vqa.pt --output rollout_val.csv
+
+def attention_rollout(attentions):
+    '''(b, t, t) rollout of a list of (b, heads, t, t) attention maps'''
+    rollout = None
+    for att in attentions:
+        a = att.mean(1)
+        a = a + torch.eye(a.size(-1), device=a.device)
+        a = a / a.sum(-1, keepdim=True)
+        rollout = a if rollout is None else a @ rollout
+    return rollout
+
+def token_relevance(rollout, input_mask):
+    # (b, t) relevance of every input token for the mean pooled output
+    m = input_mask.float()
+    return (rollout * m[:, :, None]).sum(1) / m.sum(1, keepdim=True).clamp(min=1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Attention rollout of the visual tokens on VQA-Med")
+    parser.add_argument('--data_dir', type = str, required = False, default = "../ImageClef-2019-VQA-Med", help = "path for data")
+    parser.add_argument('--model_dir', type = str, required = False, default = "../ImageClef-2019-VQA-Med/mmbert/MLM/vqa-sentence_transformers-allmpnet48-2.pt", help = "path to load weights")
+    parser.add_argument('--output', type = str, required = False, default = "attention_rollout.csv", help = "csv with the relevance of the visual tokens of every question")
+
+    parser.add_argument('--cnn_encoder', type=str, default='tf_efficientnetv2_m', help='name of the cnn encoder')
+    parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--init_from_config', action = 'store_true', default = False, help = "build the model without downloading pretrained weights, they come from --model_dir")
+    parser.add_argument('--bert_embeddings', type = str, required = False, default = None, help = "local safetensors file with the bert weights, only the embeddings are read (with --init_from_config)")
+    parser.add_argument('--transformer_model', type=str, default='realformer',choices=['transformer', 'realformer'], help='name of the transformer model')
+    parser.add_argument('--dataset', type=str, default='VQA-Med', help='roco or vqamed2019')
+    parser.add_argument('--num_vis', type = int, default=5, help = "num of visual embeddings")
+    parser.add_argument('--hidden_size', type=int, default=768, help='embedding size')
+    parser.add_argument('--hidden_dropout_prob', type=float, default=0.3, help='dropout')
+    parser.add_argument('--n_layers', type=int, default=4, help='num of heads in multihead attenion')
+    parser.add_argument('--heads', type=int, default=8, help='num of bertlayers')
+    parser.add_argument('--vocab_size', type=int, default=30522, help='vocabulary size')
+
+    parser.add_argument('--task', type=str, default='MLM',
+                        choices=['MLM', 'distillation'], help='pretrain task for the model to be trained on')
+
+    parser.add_argument('--seed', type = int, required = False, default = 42, help = "set seed for reproducibility")
+    parser.add_argument('--batch_size', type = int, required = False, default = 32, help = "batch size")
+    parser.add_argument('--num_workers', type = int, required = False, default = 4, help = "number of data loader workers")
+
+    parser.add_argument('--train_pct', type = float, required = False, default = 1.0, help = "fraction of train samples to select")
+    parser.add_argument('--valid_pct', type = float, required = False, default = 1.0, help = "fraction of validation samples to select")
+    parser.add_argument('--test_pct', type = float, required = False, default = 1.0, help = "fraction of test samples to select")
+    parser.add_argument('--max_position_embeddings', type = int, required = False, default = 28, help = "max length of sequence")
+    parser.add_argument('--mode', type=str, default = 'Val', choices=['Train', 'Val', 'Test'], help="data split", required = False)
+
+    args = parser.parse_args()
+
+    seed_everything(args.seed)
+
+    train_df, val_df, test_df = load_data(args)
+    df = pd.concat([train_df, val_df, test_df]).reset_index(drop=True)
+
+    ans2idx = {ans:idx for idx,ans in enumerate(df['answer'].unique())}
+    idx2ans = {idx:ans for ans,idx in ans2idx.items()}
+    df['answer'] = df['answer'].map(ans2idx).astype(int)
+    split_df = df[df['mode']=={'Train': 'train', 'Val': 'val', 'Test': 'test'}[args.mode]].reset_index(drop=True)
+
+    num_classes = len(ans2idx)
+    args.num_classes = num_classes
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = Model(args)
+    model.classifier[2] = nn.Linear(args.hidden_size, num_classes)
+    model.load_state_dict(load_state_dict(args.model_dir, device='cpu'))
+    model.to(device)
+    model.eval()
+
+    tfm = transforms.Compose([transforms.Resize(224),
+                                transforms.CenterCrop(224),
+                                transforms.ToTensor(),
+                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+    loader = DataLoader(VQAMed(split_df, imgsize=224, tfm=tfm, args=args, mode='eval'), batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+    relevance = []
+    preds = []
+    with torch.no_grad():
+        for img, tokens, segment_ids, input_mask, answer, path in tqdm(loader):
+            img, tokens, segment_ids, input_mask = img.to(device), tokens.to(device), segment_ids.to(device), input_mask.to(device)
+            logits, _, _, attentions = model(img, tokens, segment_ids, input_mask, output_attentions=True)
+            r = token_relevance(attention_rollout(attentions), input_mask)
+            # the visual tokens are written at positions 0..num_vis-1 by prepare_input
+            relevance.append(r[:, :args.num_vis].cpu().numpy())
+            preds.extend(logits.argmax(1).tolist())
+
+    relevance = np.concatenate(relevance)
+    out = split_df[['img_id', 'question', 'category']].copy()
+    out['answer'] = split_df['answer'].map(idx2ans)
+    out['pred'] = [idx2ans[p] for p in preds]
+    for i in range(args.num_vis):
+        out[f'visual_{i}'] = relevance[:, i]
+    out.to_csv(args.output, index=False)
+    print('saved', len(out), 'rows to', args.output)
+    print(out.groupby('category')[[f'visual_{i}' for i in range(args.num_vis)]].mean())
@@ -0,0 +1,82 @@
+import torch
+import torch.nn.functional as F
+
+# Score-CAM / Ablation-CAM on the last visual stage of Timm_EFfNetV2 (the Grad-CAM target layer) with incremental
+# recomputation: only that stage feeds the last visual token (conv7/gap7), so the backbone, the other visual tokens
+# and the question embedding are computed once and every perturbed variant of the stage activations only re-runs
+# the last token and the encoder blocks, batch_size variants at a time.
+# The perturbations are applied to the activations (feature space), not to the input image:
+#   scorecam: activations * normalized channel k, weight = softmax over the channels of the target logit
+#   ablationcam: channel k set to zero, weight = (y - y_k) / y
+
+class IncrementalCAM():
+    def __init__(self, model, method='scorecam', batch_size=64):
+        self.model = model
+        self.method = method
+        self.batch_size = batch_size
+        self.trans = model.transformer.trans
+        if not hasattr(self.trans, 'last_token'):
+            raise ValueError('incremental CAM needs the Timm_EFfNetV2 image encoder')
+
+    @torch.no_grad()
+    def prepare(self, img, input_ids, segment_ids, input_mask):
+        # cached part of the forward of one sample: the input of the encoder and the last stage activations
+        o = self.trans.backbone_features(img)
+        h = self.model.transformer.bert_embedding(input_ids=input_ids, token_type_ids=segment_ids, position_ids=None)
+        act = self.trans.activation
+        vizs = [self.trans.gap2(act(self.trans.conv2(o[0]))), self.trans.gap3(act(self.trans.conv3(o[1]))),
+                self.trans.gap4(act(self.trans.conv4(o[2]))), self.trans.gap5(act(self.trans.conv5(o[3])))]
+        for n, v in enumerate(vizs):
+            h[:, n] = v.view(-1, h.size(-1))
+        self.h, self.mask, self.feat = h, input_mask, o[4]
+        self.token = len(vizs) # position of the last visual token, as in prepare_input
+
+    @torch.no_grad()
+    def scores(self, feats):
+        # target logits of the perturbed last stage activations (n, c, h, w), batch_size at a time
+        out = []
+        for chunk in feats.split(self.batch_size):
+            n = len(chunk)
+            h = self.h.expand(n, -1, -1).clone()
+            h[:, self.token] = self.trans.last_token(chunk)
+            mask = self.mask.expand(n, -1)
+            out.append(self.model.answer_logits(self.model.transformer.encode(h, mask), mask))
+        return torch.cat(out)
+
+    def variants(self, channels):
+        a = self.feat[0]
+        if self.method == 'scorecam':
+            m = a[channels].flatten(1)
+            lo, hi = m.min(1, keepdim=True)[0], m.max(1, keepdim=True)[0]
+            m = ((m - lo) / (hi - lo).clamp(min=1e-12)).view(len(channels), 1, *a.shape[1:])
+            return a[None] * m
+        feats = a[None].repeat(len(channels), 1, 1, 1)
+        feats[torch.arange(len(channels)), channels] = 0
+        return feats
+
+    @torch.no_grad()
+    def __call__(self, img, input_ids, segment_ids, input_mask, target=None, size=None):
+        '''(h, w) map of one sample for the answer `target` (the predicted one if None), resized to `size`'''
+        self.prepare(img, input_ids, segment_ids, input_mask)
+        logits = self.scores(self.feat)
+        if target is None:
+            target = logits.argmax(1).item()
+
+        a = self.feat[0]
+        y = []
+        channels = torch.arange(a.size(0), device=a.device)
+        # the variants are built chunk by chunk so that only batch_size copies of the activations exist at once
+        for chunk in channels.split(self.batch_size):
+            y.append(self.scores(self.variants(chunk))[:, target])
+        y = torch.cat(y)
+
+        if self.method == 'scorecam':
+            weights = y.softmax(0)
+        else:
+            y0 = logits[0, target]
+            weights = (y0 - y) / y0
+        cam = (weights[:, None, None] * a).sum(0).clamp(min=0)
+        cam = cam / cam.max().clamp(min=1e-12)
+        if size is not None:
+            cam = F.interpolate(cam[None, None], size=size, mode='bilinear', align_corners=False)[0, 0]
+        return cam, target
@@ -0,0 +1,234 @@
+import argparse
+import copy
+from utils import seed_everything, VQAMed, validate, test, load_data, LabelSmoothByCategory, DistillationLoss, distill_one_epoch, measure_latency
+import wandb
+import pandas as pd
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+import torch.optim as optim
+import torch.optim.lr_scheduler as lr_scheduler
+from torchvision import transforms
+from torch.cuda.amp import GradScaler
+from models.safetensors_utils import load_state_dict, save_model
+import os
+import warnings
+
+from models.mmbert import Model
+from models.asl_singlelabel import ASLSingleLabel
+
+warnings.simplefilter("ignore", UserWarning)
+
+# distillation of a fine-tuned VQA-Med model (the teacher, e.g. EfficientNetV2-M + 4x768 RealFormer) into a
+# small student for cpu inference: lighter timm backbone (--cnn_encoder, any timm model with 5 feature levels),
+# fewer and narrower encoder layers (--n_layers, --hidden_size, the BERT embeddings are projected to it).
+# The student is trained on the temperature-scaled teacher logits over the answers plus --loss on the labels,
+# and a latency/accuracy table of teacher and student is reported at the end
+# e.g. python vqamed2019/distill.py --run_name student --teacher_dir mmbert/MLM/vqa.pt --num_vis 5 --cnn_encoder tf_efficientnetv2_b0 --hidden_size 256 --n_layers 2 --heads 4
+
+if __name__ == '__main__':
+    __spec__ = None
+    parser = argparse.ArgumentParser(description = "Distill a VQA-Med model into a small student")
+
+    parser.add_argument('--run_name', type = str, required = True, help = "run name for wandb")
+    parser.add_argument('--data_dir', type = str, required = False, default = "ImageClef-2019-VQA-Med", help = "path for data")
+    parser.add_argument('--save_dir', type = str, required = False, default = "ImageClef-2019-VQA-Med/mmbert", help = "path to save weights")
+    parser.add_argument('--category', type = str, required = False, default = None,  help = "choose specific category if you want")
+    parser.add_argument('--mixed_precision', action = 'store_true', default = False, help = "use mixed precision or not")
+    parser.add_argument('--clip', action = 'store_true', default = False, help = "clip the gradients or not")
+
+    parser.add_argument('--seed', type = int, required = False, default = 42, help = "set seed for reproducibility")
+    parser.add_argument('--num_workers', type = int, required = False, default = 4, help = "number of workers")
+    parser.add_argument('--epochs', type = int, required = False, default = 100, help = "num epochs to train")
+    parser.add_argument('--train_pct', type = float, required = False, default = 1.0, help = "fraction of train samples to select")
+    parser.add_argument('--valid_pct', type = float, required = False, default = 1.0, help = "fraction of validation samples to select")
+    parser.add_argument('--test_pct', type = float, required = False, default = 1.0, help = "fraction of test samples to select")
+
+    parser.add_argument('--max_position_embeddings', type = int, required = False, default = 28, help = "max length of sequence")
+    parser.add_argument('--batch_size', type = int, required = False, default = 16, help = "batch size")
+    parser.add_argument('--lr', type = float, required = False, default = 1e-4, help = "learning rate'")
+    parser.add_argument('--factor', type = float, required = False, default = 0.1, help = "factor for rlp")
+    parser.add_argument('--patience', type = int, required = False, default = 10, help = "patience for rlp")
+    parser.add_argument('--counter', type = int, required = False, default = 20, help = "patience for remaining training")
+    parser.add_argument('--hidden_dropout_prob', type = float, required = False, default = 0.3, help = "hidden dropout probability")
+    parser.add_argument('--smoothing', type = float, required = False, default = None, help = "label smoothing")
+    parser.add_argument('--loss', type=str, default='CrossEntropyLoss', choices=['CrossEntropyLoss', 'ASLSingleLabel'], help='loss on the labels')
+
+    parser.add_argument('--image_size', type = int, required = False, default = 224, help = "image size")
+    parser.add_argument('--vocab_size', type = int, required = False, default = 30522, help = "vocab size")
+    parser.add_argument('--type_vocab_size', type = int, required = False, default = 2, help = "type vocab size")
+    parser.add_argument('--num_vis', type = int, required = True, help = "num of visual embeddings")
+    parser.add_argument('--wandb', action = 'store_false', default = True, help = "record in wandb or not")
+    parser.add_argument('--task', type=str, default='MLM',
+                        choices=['MLM', 'distillation'], help='task which the model was pre-trained on')
+    parser.add_argument('--clinicalbert', type=str, default='emilyalsentzer/Bio_ClinicalBERT')
+    parser.add_argument('--dataset', type=str, default='VQA-Med', help='roco or vqamed2019')
+    parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--safetensors', action = 'store_true', default = False, help = "save the models as safetensors instead of .pt")
+    parser.add_argument('--save_fp16', action = 'store_true', default = False, help = "store the saved model weights in fp16 (with --safetensors)")
+
+    # student
+    parser.add_argument('--cnn_encoder', type=str, default='tf_efficientnetv2_b0', help='timm backbone of the student')
+    parser.add_argument('--transformer_model', type=str, default='realformer',choices=['transformer', 'realformer'], help='encoder of the student')
+    parser.add_argument('--hidden_size', type = int, required = False, default = 256, help = "hidden size of the student")
+    parser.add_argument('--heads', type = int, required = False, default = 4, help = "heads of the student (transformer)")
+    parser.add_argument('--n_layers', type = int, required = False, default = 2, help = "num of layers of the student")
+
+    # teacher
+    parser.add_argument('--teacher_dir', type = str, required = True, help = "fine-tuned VQA-Med model to distill")
+    parser.add_argument('--teacher_cnn_encoder', type=str, default='tf_efficientnetv2_m', help='cnn encoder of the teacher')
+    parser.add_argument('--teacher_transformer_model', type=str, default='realformer',choices=['transformer', 'realformer', 'feedback-transformer'], help='encoder of the teacher')
+    parser.add_argument('--teacher_hidden_size', type = int, required = False, default = 768, help = "hidden size of the teacher")
+    parser.add_argument('--teacher_heads', type = int, required = False, default = 8, help = "heads of the teacher")
+    parser.add_argument('--teacher_n_layers', type = int, required = False, default = 4, help = "num of layers of the teacher")
+    parser.add_argument('--temperature', type = float, required = False, default = 4.0, help = "softmax temperature of the distillation")
+    parser.add_argument('--alpha', type = float, required = False, default = 0.9, help = "weight of the distillation term, 1 - alpha for --loss")
+
+    parser.add_argument('--latency_batch_sizes', type = int, nargs = '+', default = [1, 16], help = "batch sizes of the cpu latency table")
+    parser.add_argument('--latency_threads', type = int, required = False, default = None, help = "cpu threads of the latency table (default: torch default)")
+
+    args = parser.parse_args()
+    if args.wandb:
+        wandb.init(project='medvqa', name = args.run_name, config = args)
+
+    seed_everything(args.seed)
+
+    train_df, val_df, test_df = load_data(args)
+
+    if args.category:
+        train_df = train_df[train_df['category']==args.category].reset_index(drop=True)
+        val_df = val_df[val_df['category']==args.category].reset_index(drop=True)
+        test_df = test_df[test_df['category']==args.category].reset_index(drop=True)
+
+        train_df = train_df[~train_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+        val_df = val_df[~val_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+        test_df = test_df[~test_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+
+    # the answer space of the teacher: same data, same order as in train.py
+    df = pd.concat([train_df, val_df, test_df]).reset_index(drop=True)
+
+    ans2idx = {ans:idx for idx,ans in enumerate(df['answer'].unique())}
+    idx2ans = {idx:ans for ans,idx in ans2idx.items()}
+    df['answer'] = df['answer'].map(ans2idx).astype(int)
+    train_df = df[df['mode']=='train'].reset_index(drop=True)
+    val_df = df[df['mode']=='val'].reset_index(drop=True)
+    test_df = df[df['mode']=='test'].reset_index(drop=True)
+
+    num_classes = len(ans2idx)
+    args.num_classes = num_classes
+    print('numclasses',num_classes)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    teacher_args = argparse.Namespace(**vars(args))
+    teacher_args.cnn_encoder = args.teacher_cnn_encoder
+    teacher_args.transformer_model = args.teacher_transformer_model
+    teacher_args.hidden_size = args.teacher_hidden_size
+    teacher_args.heads = args.teacher_heads
+    teacher_args.n_layers = args.teacher_n_layers
+    teacher_args.init_from_config = True # the weights come from --teacher_dir
+    teacher = Model(teacher_args)
+    teacher.classifier[2] = nn.Linear(teacher_args.hidden_size, num_classes)
+    print('Loading teacher at', args.teacher_dir)
+    teacher.load_state_dict(load_state_dict(args.teacher_dir))
+    for p in teacher.parameters():
+        p.requires_grad = False
+    teacher.to(device)
+    teacher.eval()
+
+    model = Model(args)
+    model.classifier[2] = nn.Linear(args.hidden_size, num_classes)
+    model.to(device)
+
+    if args.wandb:
+        wandb.watch(model, log='all')
+
+    optimizer = optim.Adam(model.parameters(),lr=args.lr)
+    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, patience = args.patience, factor = args.factor, verbose = True)
+
+    if args.smoothing:
+        print('Using label smoothing')
+        criterion = LabelSmoothByCategory(train_df=train_df,num_classes=args.num_classes,device=device)
+    elif args.loss == 'CrossEntropyLoss':
+        print('Using CrossEntropyLoss')
+        criterion = nn.CrossEntropyLoss()
+    elif args.loss == 'ASLSingleLabel':
+        print('Using ASLSingleLabel')
+        criterion = ASLSingleLabel()
+    distill_criterion = DistillationLoss(criterion, args.temperature, args.alpha)
+
+    scaler = GradScaler()
+
+    train_tfm = transforms.Compose([transforms.Resize(224),
+                                    transforms.CenterCrop(224),
+                                    transforms.RandomResizedCrop(224,scale=(0.75,1.25),ratio=(0.75,1.25)),
+                                    transforms.RandomRotation(10),
+                                    transforms.ColorJitter(brightness=0.4,contrast=0.4,saturation=0.4,hue=0.4),
+                                    transforms.ToTensor(),
+                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+    test_tfm = transforms.Compose([transforms.Resize(224),
+                                transforms.CenterCrop(224),
+                                transforms.ToTensor(),
+                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+    traindataset = VQAMed(train_df, imgsize = args.image_size, tfm = train_tfm, args = args, mode='train')
+    valdataset = VQAMed(val_df, imgsize = args.image_size, tfm = test_tfm, args = args, mode='eval')
+    testdataset = VQAMed(test_df, imgsize = args.image_size, tfm = test_tfm, args = args, mode='test')
+
+    trainloader = DataLoader(traindataset, batch_size = args.batch_size, shuffle=True, num_workers = args.num_workers)
+    valloader = DataLoader(valdataset, batch_size = args.batch_size, shuffle=False, num_workers = args.num_workers)
+    testloader = DataLoader(testdataset, batch_size = args.batch_size, shuffle=False, num_workers = args.num_workers)
+
+    best_acc = 0
+    best_state = None
+    counter = 0
+
+    for epoch in range(args.epochs):
+
+        print(f'Epoch {epoch+1}/{args.epochs}')
+
+        train_loss, train_acc = distill_one_epoch(trainloader, model, teacher, optimizer, distill_criterion, device, scaler, args, idx2ans)
+        val_loss, predictions, val_acc, val_bleu = validate(valloader, model, criterion, device, scaler, args, val_df,idx2ans)
+
+        scheduler.step(val_loss)
+
+        val_total_acc = val_acc['val_total_acc'] if not args.category else val_acc
+        if args.wandb:
+            wandb.log({'train_loss': train_loss, 'train_acc': train_acc, 'val_loss': val_loss, 'val_acc': val_total_acc,
+                       'learning_rate': optimizer.param_groups[0]["lr"]})
+
+        if val_total_acc > best_acc:
+            print('Saving student')
+            save_model(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '_student.pt'), args)
+            best_state = copy.deepcopy(model.state_dict())
+            best_acc = val_total_acc
+            counter = 0
+        else:
+            counter+=1
+            print(f'Counter {counter}/{args.counter}')
+            if counter > args.counter:
+                print('Counter expired, finishing.')
+                break
+
+    if best_state is not None:
+        model.load_state_dict(best_state)
+
+    # latency / accuracy of teacher and student
+    img, question_token, segment_ids, attention_mask, _, _ = next(iter(testloader))
+    rows = []
+    for name, m in [('teacher', teacher), ('student', model)]:
+        _, _, acc, bleu = test(testloader, m, criterion, device, scaler, args, test_df, idx2ans)
+        total_acc = acc['total_acc'] if isinstance(acc, dict) else acc
+        total_bleu = bleu['total_bleu'] if isinstance(bleu, dict) else bleu
+        row = {'model': name, 'params_m': sum(p.numel() for p in m.parameters()) / 1e6, 'test_acc': total_acc, 'test_bleu': total_bleu}
+        for bs in args.latency_batch_sizes:
+            batch = [t[:bs].repeat(-(-bs // len(t)), *[1] * (t.dim() - 1))[:bs] for t in (img, question_token.squeeze(1), segment_ids, attention_mask.squeeze(1))]
+            row[f'cpu_ms_bs{bs}'] = measure_latency(m, batch, args.latency_threads)
+        rows.append(row)
+    table = pd.DataFrame(rows)
+    print(table.to_string(index=False))
+    table.to_csv(os.path.join(args.save_dir, args.run_name + '_distill.csv'), index = False)
+    if args.wandb:
+        wandb.log({'distillation': wandb.Table(dataframe=table)})
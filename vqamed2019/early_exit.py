@@ -0,0 +1,134 @@
+import argparse
+import time
+from utils import seed_everything, load_data, VQAMed
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from tqdm import tqdm
+
+from models.mmbert import Model
+from models.safetensors_utils import load_state_dict
+
+# confidence based early exit of a model trained with train.py --early_exit: a question leaves the encoder at the
+# first intermediate answer head whose softmax confidence reaches the threshold (Model.early_exit), the others
+# continue in a compacted batch. For every threshold the accuracy (total and per category), the mean exit layer and
+# the time over the split are compared to the full model, the images and tokens are moved to the device once
+# e.g. python vqamed2019/early_exit.py --mode Test --model_dir mmbert/MLM/vqa-exit.pt --thresholds 0.5 0.7 0.9 0.99
+
+def run(model, batches, threshold, device):
+    # (predictions, exit layers, seconds), threshold None is the full model
+    preds, layers = [], []
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.no_grad():
+        for img, tokens, segment_ids, input_mask in batches:
+            if threshold is None:
+                p = model(img, tokens, segment_ids, input_mask)[0].argmax(1)
+                l = torch.full_like(p, model.transformer.n_layers)
+            else:
+                p, l = model.early_exit(img, tokens, segment_ids, input_mask, threshold)
+            preds.append(p)
+            layers.append(l)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    return torch.cat(preds).cpu().numpy(), torch.cat(layers).cpu().numpy(), seconds
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accuracy and speedup of the early exits on VQA-Med")
+    parser.add_argument('--data_dir', type = str, required = False, default = "../ImageClef-2019-VQA-Med", help = "path for data")
+    parser.add_argument('--model_dir', type = str, required = True, help = "model trained with --early_exit")
+    parser.add_argument('--output', type = str, required = False, default = "early_exit.csv", help = "csv with a row per threshold")
+    parser.add_argument('--thresholds', type = float, nargs = '+', default = [0.5, 0.7, 0.8, 0.9, 0.95, 0.99], help = "softmax confidence needed to exit")
+
+    parser.add_argument('--cnn_encoder', type=str, default='tf_efficientnetv2_m', help='name of the cnn encoder')
+    parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--bert_embeddings', type = str, required = False, default = None, help = "local safetensors file with the bert weights, only the embeddings are read")
+    parser.add_argument('--transformer_model', type=str, default='realformer',choices=['transformer', 'realformer'], help='name of the transformer model')
+    parser.add_argument('--dataset', type=str, default='VQA-Med', help='roco or vqamed2019')
+    parser.add_argument('--category', type = str, required = False, default = None,  help = "choose specific category if you want")
+    parser.add_argument('--num_vis', type = int, default=5, help = "num of visual embeddings")
+    parser.add_argument('--hidden_size', type=int, default=768, help='embedding size')
+    parser.add_argument('--hidden_dropout_prob', type=float, default=0.3, help='dropout')
+    parser.add_argument('--n_layers', type=int, default=4, help='num of layers')
+    parser.add_argument('--heads', type=int, default=8, help='num of heads in multihead attention')
+    parser.add_argument('--vocab_size', type=int, default=30522, help='vocabulary size')
+
+    parser.add_argument('--task', type=str, default='MLM',
+                        choices=['MLM', 'distillation'], help='pretrain task for the model to be trained on')
+
+    parser.add_argument('--seed', type = int, required = False, default = 42, help = "set seed for reproducibility")
+    parser.add_argument('--batch_size', type = int, required = False, default = 32, help = "batch size")
+    parser.add_argument('--num_workers', type = int, required = False, default = 4, help = "number of data loader workers")
+
+    parser.add_argument('--train_pct', type = float, required = False, default = 1.0, help = "fraction of train samples to select")
+    parser.add_argument('--valid_pct', type = float, required = False, default = 1.0, help = "fraction of validation samples to select")
+    parser.add_argument('--test_pct', type = float, required = False, default = 1.0, help = "fraction of test samples to select")
+    parser.add_argument('--max_position_embeddings', type = int, required = False, default = 28, help = "max length of sequence")
+    parser.add_argument('--mode', type=str, default = 'Test', choices=['Train', 'Val', 'Test'], help="data split", required = False)
+
+    args = parser.parse_args()
+    args.early_exit = True
+    args.init_from_config = True # the weights come from --model_dir
+
+    seed_everything(args.seed)
+
+    train_df, val_df, test_df = load_data(args)
+
+    if args.category:
+        train_df = train_df[train_df['category']==args.category].reset_index(drop=True)
+        val_df = val_df[val_df['category']==args.category].reset_index(drop=True)
+        test_df = test_df[test_df['category']==args.category].reset_index(drop=True)
+
+        train_df = train_df[~train_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+        val_df = val_df[~val_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+        test_df = test_df[~test_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+
+    # the answer space of the model: same data, same order as in train.py
+    df = pd.concat([train_df, val_df, test_df]).reset_index(drop=True)
+
+    ans2idx = {ans:idx for idx,ans in enumerate(df['answer'].unique())}
+    df['answer'] = df['answer'].map(ans2idx).astype(int)
+    split_df = df[df['mode']=={'Train': 'train', 'Val': 'val', 'Test': 'test'}[args.mode]].reset_index(drop=True)
+
+    args.num_classes = len(ans2idx)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = Model(args)
+    model.classifier[2] = nn.Linear(args.hidden_size, args.num_classes)
+    print('Loading model at', args.model_dir)
+    model.load_state_dict(load_state_dict(args.model_dir, device='cpu'))
+    model.to(device)
+    model.eval()
+
+    tfm = transforms.Compose([transforms.Resize(224),
+                                transforms.CenterCrop(224),
+                                transforms.ToTensor(),
+                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+    loader = DataLoader(VQAMed(split_df, imgsize=224, tfm=tfm, args=args, mode='eval'), batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    # decoded once, the timings only cover the model
+    batches = [(img.to(device), tokens.to(device), segment_ids.to(device), input_mask.to(device)) for img, tokens, segment_ids, input_mask, _, _ in tqdm(loader)]
+    targets = split_df['answer'].values
+
+    run(model, batches[:1], None, device) # warmup
+    rows = []
+    full_seconds = None
+    for threshold in [None] + args.thresholds:
+        preds, layers, seconds = run(model, batches, threshold, device)
+        full_seconds = seconds if threshold is None else full_seconds
+        row = {'threshold': 'full' if threshold is None else threshold, 'acc': (preds == targets).mean() * 100.,
+               'mean_exit_layer': layers.mean(), 'seconds': seconds, 'speedup': full_seconds / seconds}
+        for cat in split_df['category'].unique():
+            idx = (split_df['category'] == cat).values
+            row[f'{cat}_acc'] = (preds[idx] == targets[idx]).mean() * 100.
+            row[f'{cat}_exit_layer'] = layers[idx].mean()
+        rows.append(row)
+        print(row)
+
+    table = pd.DataFrame(rows)
+    print(table[['threshold', 'acc', 'mean_exit_layer', 'seconds', 'speedup']].to_string(index=False))
+    table.to_csv(args.output, index=False)
+    print('saved', args.output)
@@ -1,5 +1,5 @@
 import argparse
-from utils import seed_everything, VQAMed, train_one_epoch, validate, test, load_data, LabelSmoothing
+from utils import seed_everything, VQAMed, train_one_epoch, validate, test, load_data, LabelSmoothing, test_checkpoints
 import wandb
 import pandas as pd
 import numpy as np
@@ -15,6 +15,8 @@ import os
 #import pytorch_lightning as pl
 import warnings
 from models.mmbert import Model
+from models.safetensors_utils import load_state_dict
+from models.pruning import load_pruning_config
 
 warnings.simplefilter("ignore", UserWarning)
 
@@ -63,11 +65,17 @@ if __name__ == '__main__':
     parser.add_argument('--dataset', type=str, default='VQA-Med', help='roco or vqamed2019')
     parser.add_argument('--cnn_encoder', type=str, default='resnet152', help='name of the cnn encoder')
     parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--init_from_config', action = 'store_true', default = False, help = "build the model without downloading pretrained weights, they come from --model_dir")
+    parser.add_argument('--bert_embeddings', type = str, required = False, default = None, help = "local safetensors file with the bert weights, only the embeddings are read (with --init_from_config)")
     parser.add_argument('--transformer_model', type=str, default='transformer',choices=['transformer', 'realformer', 'feedback-transformer'], help='name of the transformer model')
+    parser.add_argument('--early_exit', action = 'store_true', default = False, help = "answer heads after every encoder layer, trained jointly (see vqamed2019/early_exit.py)")
+    parser.add_argument('--model_dirs', nargs='+', required = False, default = None, help = "several checkpoints of the same architecture evaluated in one pass over the test set (instead of --model_dir)")
+    parser.add_argument('--pruning_config', type = str, required = False, default = None, help = "json written by prune.py next to the pruned weights")
+    parser.add_argument('--memory_budget', type = int, required = False, default = None, help = "MB of model weights per device at once with --model_dirs, the other checkpoints run in later rounds on the cached batches")
 
     args = parser.parse_args()
     
-    model_name = args.model_dir.split('/')[-1]
+    model_name = args.model_dir.split('/')[-1] if not args.model_dirs else f'{len(args.model_dirs)}-checkpoints'
     wandb.init(project='medvqa', name = 'testing-'+model_name, config = args) #args.run_name
 
     seed_everything(args.seed)
@@ -102,81 +110,102 @@ if __name__ == '__main__':
 
     train_df = pd.concat([train_df, val_df]).reset_index(drop=True)
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    test_tfm = transforms.Compose([transforms.Resize(args.image_size), #added with profs
+                                   transforms.CenterCrop(args.image_size), #added with profstransforms.ToTensor(),
+                                   transforms.ToTensor(), 
+                                   transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+
+
+    testdataset = VQAMed(test_df, imgsize = args.image_size, tfm = test_tfm, args = args, mode='test')
+
+    testloader = DataLoader(testdataset, batch_size = args.batch_size, shuffle=False, num_workers = args.num_workers)
 
-    model = Model(args)
+    if args.model_dirs:
+        def build_model(path):
+            model = Model(args)
+            model.classifier[2] = nn.Linear(args.hidden_size, num_classes)
+            load_pruning_config(model, args)
+            print('Loading model at ', path)
+            model.load_state_dict(load_state_dict(path))
+            return model
+
+        table, predictions = test_checkpoints(testloader, build_model, args.model_dirs, args, test_df, idx2ans)
+        print(table.to_string(index=False))
+        os.makedirs(args.save_dir, exist_ok=True)
+        table.to_csv(os.path.join(args.save_dir, 'eval_checkpoints.csv'), index = False)
+        wandb.log({'checkpoints': wandb.Table(dataframe=table)})
+        for path, preds in predictions.items():
+            preds_df = test_df.copy()
+            preds_df['preds'] = preds
+            preds_df['decode_preds'] = preds_df['preds'].map(idx2ans)
+            preds_df['decode_ans'] = preds_df['answer'].map(idx2ans)
+            preds_df.to_csv(os.path.join(args.save_dir, f"{path.split('/')[-1]}_preds.csv"), index = False)
+    else:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+        model = Model(args)
 
-    model.classifier[2] = nn.Linear(args.hidden_size, num_classes)
+        model.classifier[2] = nn.Linear(args.hidden_size, num_classes)
+        load_pruning_config(model, args)
 
-    print('Loading model at ', args.model_dir)
-    model.load_state_dict(torch.load(args.model_dir))
+        print('Loading model at ', args.model_dir)
+        model.load_state_dict(load_state_dict(args.model_dir))
 
         
-    model.to(device)
+        model.to(device)
 
-    wandb.watch(model, log='all')
+        wandb.watch(model, log='all')
 
 
-    optimizer = optim.Adam(model.parameters(),lr=args.lr)
-    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, patience = args.patience, factor = args.factor, verbose = True)
+        optimizer = optim.Adam(model.parameters(),lr=args.lr)
+        scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, patience = args.patience, factor = args.factor, verbose = True)
 
 
-    if args.smoothing:
-        criterion = LabelSmoothing(smoothing=args.smoothing)
-    else:
-        criterion = nn.CrossEntropyLoss()
+        if args.smoothing:
+            criterion = LabelSmoothing(smoothing=args.smoothing)
+        else:
+            criterion = nn.CrossEntropyLoss()
 
-    scaler = GradScaler()
+        scaler = GradScaler()
 
 
-    test_tfm = transforms.Compose([transforms.Resize(224), #added with profs
-                                   transforms.CenterCrop(224), #added with profstransforms.ToTensor(),
-                                   transforms.ToTensor(), 
-                                   transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
 
+        best_acc1 = 0
+        best_acc2 = 0
+        best_loss = np.inf
+        counter = 0
 
+        test_loss, predictions, acc, bleu = test(testloader, model, criterion, device, scaler, args, test_df,idx2ans)
 
-    testdataset = VQAMed(test_df, imgsize = args.image_size, tfm = test_tfm, args = args, mode='test')
+        wandb.log({
+                    'test_loss': test_loss,
+                    'learning_rate': optimizer.param_groups[0]["lr"],
 
-    testloader = DataLoader(testdataset, batch_size = args.batch_size, shuffle=False, num_workers = args.num_workers)
+                    'total_bleu':    bleu['total_bleu'],
+                    'binary_bleu':   bleu['binary_bleu'],
+                    'plane_bleu':    bleu['plane_bleu'],
+                    'organ_bleu':    bleu['organ_bleu'],
+                    'modality_bleu': bleu['modality_bleu'],
+                    'abnorm_bleu':   bleu['abnorm_bleu'],
 
-    best_acc1 = 0
-    best_acc2 = 0
-    best_loss = np.inf
-    counter = 0
-
-    test_loss, predictions, acc, bleu = test(testloader, model, criterion, device, scaler, args, test_df,idx2ans)
-
-    wandb.log({
-                'test_loss': test_loss,
-                'learning_rate': optimizer.param_groups[0]["lr"],
-
-                'total_bleu':    bleu['total_bleu'],
-                'binary_bleu':   bleu['binary_bleu'],
-                'plane_bleu':    bleu['plane_bleu'],
-                'organ_bleu':    bleu['organ_bleu'],
-                'modality_bleu': bleu['modality_bleu'],
-                'abnorm_bleu':   bleu['abnorm_bleu'],
-
-                'total_acc':    acc['total_acc'],
-                'binary_acc':   acc['binary_acc'],
-                'plane_acc':    acc['plane_acc'],
-                'organ_acc':    acc['organ_acc'],
-                'modality_acc': acc['modality_acc'],
-                'abnorm_acc':   acc['abnorm_acc']
+                    'total_acc':    acc['total_acc'],
+                    'binary_acc':   acc['binary_acc'],
+                    'plane_acc':    acc['plane_acc'],
+                    'organ_acc':    acc['organ_acc'],
+                    'modality_acc': acc['modality_acc'],
+                    'abnorm_acc':   acc['abnorm_acc']
                 
-            })
+                })
 
     
-    test_df['preds'] = predictions
-    test_df['decode_preds'] = test_df['preds'].map(idx2ans)
-    test_df['decode_ans'] = test_df['answer'].map(idx2ans)
-    test_df.to_csv(f'../ImageClef-2019-VQA-Med/mmbert/{model_name}_preds.csv', index = False)
+        test_df['preds'] = predictions
+        test_df['decode_preds'] = test_df['preds'].map(idx2ans)
+        test_df['decode_ans'] = test_df['answer'].map(idx2ans)
+        test_df.to_csv(f'../ImageClef-2019-VQA-Med/mmbert/{model_name}_preds.csv', index = False)
     
-    result = test_df[['img_id', 'decode_preds']]
-    result['img_id'] = result['img_id'].apply(lambda x: x.split('/')[-1].split('.')[0])
-    result.to_csv(f'../ImageClef-2019-VQA-Med/mmbert/{model_name}_res.txt', index = False, header=False, sep='|')
-    print('acc', acc)
-    print('bleu', bleu)
-
-            
\ No newline at end of file
+        result = test_df[['img_id', 'decode_preds']]
+        result['img_id'] = result['img_id'].apply(lambda x: x.split('/')[-1].split('.')[0])
+        result.to_csv(f'../ImageClef-2019-VQA-Med/mmbert/{model_name}_res.txt', index = False, header=False, sep='|')
+        print('acc', acc)
+        print('bleu', bleu)
@@ -11,6 +11,8 @@ import torch.optim.lr_scheduler as lr_scheduler
 from torchvision import transforms
 
 from models.mmbert import Model, get_transformer_model
+from models.safetensors_utils import load_state_dict
+from cam_engine import IncrementalCAM
 
 
 from pytorch_grad_cam import GradCAM, ScoreCAM, GradCAMPlusPlus, AblationCAM, XGradCAM, EigenCAM
@@ -32,6 +34,8 @@ if __name__ == '__main__':
     
     parser.add_argument('--cnn_encoder', type=str, default='tf_efficientnetv2_m', help='name of the cnn encoder')
     parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--init_from_config', action = 'store_true', default = False, help = "build the model without downloading pretrained weights, they come from --model_dir")
+    parser.add_argument('--bert_embeddings', type = str, required = False, default = None, help = "local safetensors file with the bert weights, only the embeddings are read (with --init_from_config)")
     parser.add_argument('--transformer_model', type=str, default='realformer',choices=['transformer', 'realformer', 'feedback-transformer'], help='name of the transformer model')
     parser.add_argument('--dataset', type=str, default='VQA-Med', help='roco or vqamed2019')
     parser.add_argument('--num_vis', type = int, default=5, help = "num of visual embeddings")
@@ -57,6 +61,8 @@ if __name__ == '__main__':
     parser.add_argument('--category', type=str, default = 'organ', choices=['organ','modality','plane','abnormality'], help="question category", required = False)
     parser.add_argument('--mode', type=str, default = 'Train', choices=['Train', 'Val', 'Test'], help="data split", required = False)
     parser.add_argument('--grad_cam', action='store_false', required = False, default = True,  help='flag to save model input_tensor')
+    parser.add_argument('--cam_batch_size', type = int, required = False, default = 64, help = "perturbed variants per encoder pass of the incremental scorecam / ablationcam")
+    parser.add_argument('--full_cam', action='store_true', required = False, default = False,  help='scorecam / ablationcam with pytorch_grad_cam (full passes on the input image) instead of the incremental engine')
     
 
     args = parser.parse_args()
@@ -107,24 +113,7 @@ if __name__ == '__main__':
     #target_layers = model.blocks[6][4]
     model = Model(args)
     model.classifier[2] = nn.Linear(args.hidden_size, num_classes)
-    model.load_state_dict(torch.load(args.model_dir))
-
-    effv2 = timm.create_model('tf_efficientnetv2_m', pretrained=True) #model.transformer.trans.model
-    effv2.classifier = torch.nn.Sequential()
-
-    print('Loading weights from', args.model_dir)
-    effv2_dict = effv2.state_dict()
-    pretrained_dict = model.transformer.trans.model.state_dict()
-    # 1. filter out unnecessary keys
-    pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in effv2_dict}
-    # 2. overwrite entries in the existing state dict
-    effv2_dict.update(pretrained_dict) 
-    # 3. load the new state dict
-    effv2.load_state_dict(effv2_dict)
-    
-    target_layers = effv2.blocks[-1][-1]
-    print( target_layers)
-    
+    model.load_state_dict(load_state_dict(args.model_dir))
 
     def preprocess_image(img: np.ndarray, mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]) -> torch.Tensor:
         preprocessing = transforms.Compose([
@@ -148,24 +137,50 @@ if __name__ == '__main__':
     
     print('out.shape', model(img_tensor, tokens, segment_ids, input_mask)[0].shape)
 
-    # Construct the CAM object once, and then re-use it on many images:
-    print('Using ' + args.method)
-    cam = methods[args.method](model=effv2, target_layer=target_layers, use_cuda=False)
+    if args.method in ['scorecam', 'ablationcam'] and not args.full_cam:
+        # last visual stage of the VQA model, recomputing only the last visual token and the encoder
+        print('Using incremental ' + args.method)
+        model.eval()
+        cam = IncrementalCAM(model, args.method, args.cam_batch_size)
+        grayscale_cam, target = cam(img_tensor, tokens, segment_ids, input_mask, size=rgb_img.shape[:2])
+        print('explained answer:', idx2ans[target])
+        grayscale_cam = grayscale_cam.numpy()
+    else:
+        effv2 = timm.create_model('tf_efficientnetv2_m', pretrained=True) #model.transformer.trans.model
+        effv2.classifier = torch.nn.Sequential()
+
+        print('Loading weights from', args.model_dir)
+        effv2_dict = effv2.state_dict()
+        pretrained_dict = model.transformer.trans.model.state_dict()
+        # 1. filter out unnecessary keys
+        pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in effv2_dict}
+        # 2. overwrite entries in the existing state dict
+        effv2_dict.update(pretrained_dict) 
+        # 3. load the new state dict
+        effv2.load_state_dict(effv2_dict)
+    
+        target_layers = effv2.blocks[-1][-1]
+        print( target_layers)
+
+        # Construct the CAM object once, and then re-use it on many images:
+        print('Using ' + args.method)
+        cam = methods[args.method](model=effv2, target_layer=target_layers, use_cuda=False)
 
 
-    # If target_category is None, the highest scoring category
-    # will be used for every image in the batch.
-    # target_category can also be an integer, or a list of different integers
-    # for every image in the batch.
-    target_category = None#answer#None#281
+        # If target_category is None, the highest scoring category
+        # will be used for every image in the batch.
+        # target_category can also be an integer, or a list of different integers
+        # for every image in the batch.
+        target_category = None#answer#None#281
 
-    #import IPython; IPython.embed(); import sys; sys.exit(0)
-    # You can also pass aug_smooth=True and eigen_smooth=True, to apply smoothing.
-    grayscale_cam = cam(input_tensor=img_tensor, target_category=target_category)
+        #import IPython; IPython.embed(); import sys; sys.exit(0)
+        # You can also pass aug_smooth=True and eigen_smooth=True, to apply smoothing.
+        grayscale_cam = cam(input_tensor=img_tensor, target_category=target_category)
+
+        # In this example grayscale_cam has only one image in the batch:
+        grayscale_cam = grayscale_cam[0, :]
 
-    # In this example grayscale_cam has only one image in the batch:
-    grayscale_cam = grayscale_cam[0, :]
     visualization = show_cam_on_image(rgb_img, grayscale_cam, use_rgb=False)
 
     print('Writing output file to ',args.output)
-    cv2.imwrite(args.output + '_' + args.vqa_img + '_' + args.model_dir.split('/')[-1] + ".jpg", visualization)
\ No newline at end of file
+    cv2.imwrite(args.output + '_' + args.vqa_img + '_' + args.model_dir.split('/')[-1] + ".jpg", visualization)
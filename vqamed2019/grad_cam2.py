@@ -2,7 +2,7 @@
 # https://medium.com/@stepanulyanin/implementing-grad-cam-in-pytorch-ea0937c31e82
 
 import argparse
-from utils import seed_everything, load_data,encode_text #,Model
+from utils import seed_everything, load_data,encode_text, VQAMed #,Model
 import wandb
 import pandas as pd
 import numpy as np
@@ -14,6 +14,7 @@ import torch.optim.lr_scheduler as lr_scheduler
 from torchvision import transforms
 
 from models.mmbert import Model, get_transformer_model
+from models.safetensors_utils import load_state_dict
 
 from transformers import BertTokenizer
 from PIL import Image
@@ -22,6 +23,8 @@ import cv2
 import timm
 import os
 import matplotlib.pyplot as plt
+import multiprocessing
+from tqdm import tqdm
 
 #image resize function from https://stackoverflow.com/a/44659589
 def image_resize(image, width = None, height = None, inter = cv2.INTER_AREA):
@@ -55,6 +58,84 @@ def image_resize(image, width = None, height = None, inter = cv2.INTER_AREA):
     # return the resized image
     return resized
 
+def center_crop(img_path, w=224, h=224):
+    # the image as seen by the model: resize of the short side and center crop
+    img = cv2.imread(img_path)
+    (h_orig, w_orig) = img.shape[:2]
+    if h_orig < w_orig:
+        img=image_resize(img, height = h)
+    else:
+        img=image_resize(img, width= w)
+    center = (img.shape[0]/2,img.shape[1]/2)
+    x = center[1] - w/2
+    y = center[0] - h/2
+    return img[int(y):int(y+h), int(x):int(x+w)]
+
+def render_overlay(item):
+    img_path, heatmap, out_path = item
+    img = center_crop(img_path)
+    heatmap = cv2.resize(np.float32(heatmap), (img.shape[1], img.shape[0]))
+    heatmap = np.uint8(255 * heatmap)
+    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
+    superimposed_img = heatmap * 0.4 + img
+    cv2.imwrite(out_path, superimposed_img)
+    return out_path
+
+def grad_cam_heatmaps(activations, gradients):
+    # (b, c, h, w) activations weighted by the spatially pooled gradients of each sample, averaged over the channels
+    weights = gradients.mean(dim=(2, 3), keepdim=True)
+    heatmap = (activations * weights).mean(dim=1).clamp(min=0)
+    # normalize each heatmap
+    return heatmap / heatmap.flatten(1).max(dim=1)[0].clamp(min=1e-12)[:, None, None]
+
+def grad_cam_split(model, df, idx2ans, args, device):
+    '''Grad-CAM of every question of a split: batched forward/backward passes (the samples are independent,
+    so the gradient of the sum of the target logits gives the gradient of each sample), heatmaps written to
+    <save_dir>/<mode>_heatmaps.npy with the question info in <mode>_heatmaps.csv, overlays drawn by a process pool'''
+    tfm = transforms.Compose([transforms.Resize(224),
+                                transforms.CenterCrop(224),
+                                transforms.ToTensor(),
+                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+    loader = DataLoader(VQAMed(df, imgsize=224, tfm=tfm, args=args, mode='eval'), batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+    os.makedirs(args.save_dir, exist_ok=True)
+    heatmaps = None
+    preds = []
+    pool = multiprocessing.Pool(args.overlay_workers) if args.overlay_workers > 0 else None
+    pending = []
+    n = 0
+    for img, tokens, segment_ids, input_mask, answer, path in tqdm(loader):
+        img, tokens, segment_ids, input_mask = img.to(device), tokens.to(device), segment_ids.to(device), input_mask.to(device)
+        model.zero_grad()
+        logits, _, _ = model(img, tokens, segment_ids, input_mask)
+        pred = logits.argmax(1)
+        target = answer.to(device) if args.target == 'answer' else pred
+        logits.gather(1, target[:, None]).sum().backward()
+
+        trans = model.transformer.trans
+        heatmap = grad_cam_heatmaps(trans.get_activations().detach(), trans.get_activations_gradient()).cpu().numpy()
+        if heatmaps is None:
+            heatmaps = np.lib.format.open_memmap(os.path.join(args.save_dir, args.mode + '_heatmaps.npy'), mode='w+', dtype=np.float16, shape=(len(df), *heatmap.shape[1:]))
+        heatmaps[n:n + len(heatmap)] = heatmap
+        preds.extend(pred.tolist())
+
+        if pool is not None:
+            items = [(p, h, os.path.join(args.save_dir, f'{df.loc[n + i, "category"]}_{n + i}_{os.path.basename(p)}')) for i, (p, h) in enumerate(zip(path, heatmap))]
+            pending.append(pool.map_async(render_overlay, items))
+        n += len(heatmap)
+
+    heatmaps.flush()
+    info = df[['img_id', 'question', 'category', 'answer']].copy()
+    info['answer'] = info['answer'].map(idx2ans)
+    info['pred'] = [idx2ans[p] for p in preds]
+    info.to_csv(os.path.join(args.save_dir, args.mode + '_heatmaps.csv'), index_label='heatmap')
+    if pool is not None:
+        for r in pending:
+            r.get()
+        pool.close()
+        pool.join()
+    print('saved', n, 'heatmaps to', args.save_dir)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Pretrain on ROCO with MLM")
     parser.add_argument('--data_dir', type = str, required = False, default = "../ImageClef-2019-VQA-Med", help = "path for data")
@@ -62,6 +143,8 @@ if __name__ == '__main__':
     
     parser.add_argument('--cnn_encoder', type=str, default='tf_efficientnetv2_m', help='name of the cnn encoder')
     parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--init_from_config', action = 'store_true', default = False, help = "build the model without downloading pretrained weights, they come from --model_dir")
+    parser.add_argument('--bert_embeddings', type = str, required = False, default = None, help = "local safetensors file with the bert weights, only the embeddings are read (with --init_from_config)")
     parser.add_argument('--transformer_model', type=str, default='realformer',choices=['transformer', 'realformer', 'feedback-transformer'], help='name of the transformer model')
     parser.add_argument('--dataset', type=str, default='VQA-Med', help='roco or vqamed2019')
     parser.add_argument('--num_vis', type = int, default=5, help = "num of visual embeddings")
@@ -88,6 +171,11 @@ if __name__ == '__main__':
     parser.add_argument('--mode', type=str, default = 'Train', choices=['Train', 'Val', 'Test'], help="data split", required = False)
     parser.add_argument('--grad_cam', action='store_false', required = False, default = True,  help='flag to save model input_tensor')
     parser.add_argument('--save_dir', type = str, required = False, default = "./gradcam-images", help = "path to save gradcam images")
+    parser.add_argument('--split', action='store_true', required = False, default = False,  help='Grad-CAM of every question of the --mode split instead of one image')
+    parser.add_argument('--target', type=str, default = 'answer', choices=['answer', 'pred'], help="class whose logit is explained in --split mode", required = False)
+    parser.add_argument('--batch_size', type = int, required = False, default = 32, help = "batch size in --split mode")
+    parser.add_argument('--num_workers', type = int, required = False, default = 4, help = "number of data loader workers in --split mode")
+    parser.add_argument('--overlay_workers', type = int, required = False, default = 4, help = "processes drawing the overlays in --split mode (0 = heatmap arrays only)")
     
 
     args = parser.parse_args()
@@ -111,83 +199,53 @@ if __name__ == '__main__':
     print('numclasses',num_classes)
 
 
-    img_path = os.path.join(args.data_dir,args.mode,'images',args.vqa_img)
-    info_df=df.loc[df['img_id'] == img_path]
-
-    category_df=info_df.loc[info_df['category'] == args.category]
-    if category_df['question'].empty:
-        raise ValueError('Image does not exist in data split.')
-    question = category_df['question'].item()
-    answer = category_df['answer'].item()
-
+    # the model is loaded once, for one image or for the whole split
+    device = 'cuda' if args.split and torch.cuda.is_available() else 'cpu'
     model = Model(args)
     model.classifier[2] = nn.Linear(args.hidden_size, num_classes)
-    model.load_state_dict(torch.load(args.model_dir,map_location=torch.device('cpu')))
+    model.load_state_dict(load_state_dict(args.model_dir, device='cpu'))
+    model.to(device)
     model.eval()
 
-    img = Image.open(img_path).convert('RGB')
-    tfm = transforms.Compose([transforms.Resize(224),
-                                transforms.CenterCrop(224),
-                                transforms.ToTensor(), 
-                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
-    img = tfm(img)
-    img = img.unsqueeze(0)
-
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-    tokens, segment_ids, input_mask= encode_text(question, tokenizer, args)
-    tokens, segment_ids, input_mask = torch.tensor(tokens, dtype = torch.long).unsqueeze(dim=0), torch.tensor(segment_ids, dtype = torch.long).unsqueeze(dim=0), torch.tensor(input_mask, dtype = torch.long).unsqueeze(dim=0)
-    logits, _, _ = model(img, tokens, segment_ids, input_mask)
-
-    logits[:, answer].backward()
-    gradients = model.transformer.trans.get_activations_gradient()
-
-    pooled_gradients = torch.mean(gradients, dim=[0, 2, 3])
-    activations = model.transformer.trans.get_activations().detach()
-
-    # weight the channels by corresponding gradients
-    for i in range(512):
-        activations[:, i, :, :] *= pooled_gradients[i]
-        
-    # average the channels of the activations
-    heatmap = torch.mean(activations, dim=1).squeeze()
-
-    # relu on top of the heatmap
-    heatmap = np.maximum(heatmap, 0)
-
-    # normalize the heatmap
-    heatmap /= torch.max(heatmap)
-
-    # draw the heatmap
-    plt.imsave('test.png', heatmap.squeeze())
-
-
-    # img = img.squeeze()
-    # img = img.numpy()
-    # img = img.reshape(img.shape[1],img.shape[2],img.shape[0])
-    # img = np.uint8(255 * img)
-
-    img = cv2.imread(img_path)
-    print('imgread', img.shape)
-    w=224;h=224
-    (h_orig, w_orig) = img.shape[:2]
-    if h_orig < w_orig:
-        img=image_resize(img, height = h)
+    if args.split:
+        split_df = {'Train': train_df, 'Val': val_df, 'Test': test_df}[args.mode]
+        grad_cam_split(model, split_df, idx2ans, args, device)
     else:
-        img=image_resize(img, width= w)
-    center = (img.shape[0]/2,img.shape[1]/2)
-    x = center[1] - w/2
-    y = center[0] - h/2
-    img = img[int(y):int(y+h), int(x):int(x+w)]
-    print('final img shape',img.shape)
-
-    heatmap = heatmap.numpy()
-    heatmap = cv2.resize(heatmap, (img.shape[1], img.shape[0]))
-    heatmap = np.uint8(255 * heatmap)
-    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-    superimposed_img = heatmap * 0.4 + img
-    cv2.imwrite(os.path.join(args.save_dir,args.category+"_"+args.vqa_img), superimposed_img)
-
-    res = logits.softmax(1).argmax(1).detach()
-    print('question: ', question)
-    print('answer: ', answer, idx2ans[answer])
-    print('preds:', res, idx2ans[res.item()])
\ No newline at end of file
+        img_path = os.path.join(args.data_dir,args.mode,'images',args.vqa_img)
+        info_df=df.loc[df['img_id'] == img_path]
+
+        category_df=info_df.loc[info_df['category'] == args.category]
+        if category_df['question'].empty:
+            raise ValueError('Image does not exist in data split.')
+        question = category_df['question'].item()
+        answer = category_df['answer'].item()
+
+        img = Image.open(img_path).convert('RGB')
+        tfm = transforms.Compose([transforms.Resize(224),
+                                    transforms.CenterCrop(224),
+                                    transforms.ToTensor(), 
+                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+        img = tfm(img)
+        img = img.unsqueeze(0)
+
+        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        tokens, segment_ids, input_mask= encode_text(question, tokenizer, args)
+        tokens, segment_ids, input_mask = torch.tensor(tokens, dtype = torch.long).unsqueeze(dim=0), torch.tensor(segment_ids, dtype = torch.long).unsqueeze(dim=0), torch.tensor(input_mask, dtype = torch.long).unsqueeze(dim=0)
+        logits, _, _ = model(img, tokens, segment_ids, input_mask)
+
+        logits[:, answer].backward()
+        gradients = model.transformer.trans.get_activations_gradient()
+        activations = model.transformer.trans.get_activations().detach()
+
+        # channels weighted by the pooled gradients, averaged, relu and normalized
+        heatmap = grad_cam_heatmaps(activations, gradients)[0]
+
+        # draw the heatmap
+        plt.imsave('test.png', heatmap.numpy())
+
+        render_overlay((img_path, heatmap.numpy(), os.path.join(args.save_dir,args.category+"_"+args.vqa_img)))
+
+        res = logits.softmax(1).argmax(1).detach()
+        print('question: ', question)
+        print('answer: ', answer, idx2ans[answer])
+        print('preds:', res, idx2ans[res.item()])
@@ -0,0 +1,189 @@
+import argparse
+import copy
+from utils import seed_everything, VQAMed, train_one_epoch, validate, load_data, measure_latency
+import wandb
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+import torch.optim as optim
+from torchvision import transforms
+from torch.cuda.amp import GradScaler
+from models.safetensors_utils import load_state_dict, save_model
+import os
+import warnings
+
+from models.mmbert import Model
+from models.pruning import importance, select, prune_model, compose, n_heads, load_pruning_config, read_pruning_config, save_pruning_config
+
+warnings.simplefilter("ignore", UserWarning)
+
+# structured pruning of the encoder of a fine-tuned VQA-Med model: the attention heads and FFN neurons of every
+# layer are scored on the validation set (models/pruning.py), the lowest --head_ratio / --ffn_ratio are removed
+# from the weights, and an optional short recovery fine-tune (--recovery_epochs) follows. The pruned weights and
+# <run_name>_pruned.json are saved, eval.py loads them with --pruning_config <run_name>_pruned.json
+# e.g. python vqamed2019/prune.py --run_name pruned --model_dir mmbert/MLM/vqa.pt --num_vis 5 --head_ratio 0.5 --ffn_ratio 0.3 --recovery_epochs 3
+
+if __name__ == '__main__':
+    __spec__ = None
+    parser = argparse.ArgumentParser(description = "Prune the heads and FFN neurons of a VQA-Med model")
+
+    parser.add_argument('--run_name', type = str, required = True, help = "run name for wandb")
+    parser.add_argument('--data_dir', type = str, required = False, default = "ImageClef-2019-VQA-Med", help = "path for data")
+    parser.add_argument('--model_dir', type = str, required = True, help = "fine-tuned VQA-Med model to prune")
+    parser.add_argument('--save_dir', type = str, required = False, default = "ImageClef-2019-VQA-Med/mmbert", help = "path to save weights")
+    parser.add_argument('--category', type = str, required = False, default = None,  help = "choose specific category if you want")
+    parser.add_argument('--mixed_precision', action = 'store_true', default = False, help = "use mixed precision or not")
+    parser.add_argument('--clip', action = 'store_true', default = False, help = "clip the gradients or not")
+
+    parser.add_argument('--seed', type = int, required = False, default = 42, help = "set seed for reproducibility")
+    parser.add_argument('--num_workers', type = int, required = False, default = 4, help = "number of workers")
+    parser.add_argument('--train_pct', type = float, required = False, default = 1.0, help = "fraction of train samples to select")
+    parser.add_argument('--valid_pct', type = float, required = False, default = 1.0, help = "fraction of validation samples to select")
+    parser.add_argument('--test_pct', type = float, required = False, default = 1.0, help = "fraction of test samples to select")
+
+    parser.add_argument('--max_position_embeddings', type = int, required = False, default = 28, help = "max length of sequence")
+    parser.add_argument('--batch_size', type = int, required = False, default = 16, help = "batch size")
+    parser.add_argument('--lr', type = float, required = False, default = 1e-5, help = "learning rate of the recovery fine-tune")
+    parser.add_argument('--hidden_dropout_prob', type = float, required = False, default = 0.3, help = "hidden dropout probability")
+
+    parser.add_argument('--image_size', type = int, required = False, default = 224, help = "image size")
+    parser.add_argument('--hidden_size', type = int, required = False, default = 768, help = "hidden size")
+    parser.add_argument('--vocab_size', type = int, required = False, default = 30522, help = "vocab size")
+    parser.add_argument('--type_vocab_size', type = int, required = False, default = 2, help = "type vocab size")
+    parser.add_argument('--heads', type = int, required = False, default = 8, help = "heads")
+    parser.add_argument('--n_layers', type = int, required = False, default = 4, help = "num of layers")
+    parser.add_argument('--num_vis', type = int, required = True, help = "num of visual embeddings")
+    parser.add_argument('--wandb', action = 'store_false', default = True, help = "record in wandb or not")
+    parser.add_argument('--task', type=str, default='MLM',
+                        choices=['MLM', 'distillation'], help='task which the model was pre-trained on')
+    parser.add_argument('--clinicalbert', type=str, default='emilyalsentzer/Bio_ClinicalBERT')
+    parser.add_argument('--dataset', type=str, default='VQA-Med', help='roco or vqamed2019')
+    parser.add_argument('--cnn_encoder', type=str, default='tf_efficientnetv2_m', help='name of the cnn encoder')
+    parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--bert_embeddings', type = str, required = False, default = None, help = "local safetensors file with the bert weights, only the embeddings are read")
+    parser.add_argument('--transformer_model', type=str, default='realformer',choices=['transformer', 'realformer'], help='name of the transformer model')
+    parser.add_argument('--safetensors', action = 'store_true', default = False, help = "save the models as safetensors instead of .pt")
+    parser.add_argument('--save_fp16', action = 'store_true', default = False, help = "store the saved model weights in fp16 (with --safetensors)")
+
+    parser.add_argument('--pruning_config', type = str, required = False, default = None, help = "pruning config of --model_dir if it is already pruned")
+    parser.add_argument('--head_ratio', type = float, required = False, default = 0.5, help = "fraction of the heads of every layer to remove (the same heads in every layer for realformer)")
+    parser.add_argument('--ffn_ratio', type = float, required = False, default = 0.3, help = "fraction of the FFN neurons of every layer to remove")
+    parser.add_argument('--prune_batches', type = int, required = False, default = None, help = "validation batches used to score the heads and neurons (default: all)")
+    parser.add_argument('--recovery_epochs', type = int, required = False, default = 0, help = "epochs of fine-tuning after pruning, the best on validation is kept")
+    parser.add_argument('--latency_threads', type = int, required = False, default = None, help = "cpu threads of the latency table (default: torch default)")
+
+    args = parser.parse_args()
+    args.init_from_config = True # the weights come from --model_dir
+    args.smoothing = None # scoring and recovery use CrossEntropyLoss
+    if args.wandb:
+        wandb.init(project='medvqa', name = args.run_name, config = args)
+
+    seed_everything(args.seed)
+
+    train_df, val_df, test_df = load_data(args)
+
+    if args.category:
+        train_df = train_df[train_df['category']==args.category].reset_index(drop=True)
+        val_df = val_df[val_df['category']==args.category].reset_index(drop=True)
+        test_df = test_df[test_df['category']==args.category].reset_index(drop=True)
+
+        train_df = train_df[~train_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+        val_df = val_df[~val_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+        test_df = test_df[~test_df['answer'].isin(['yes', 'no'])].reset_index(drop = True)
+
+    # the answer space of the model: same data, same order as in train.py
+    df = pd.concat([train_df, val_df, test_df]).reset_index(drop=True)
+
+    ans2idx = {ans:idx for idx,ans in enumerate(df['answer'].unique())}
+    idx2ans = {idx:ans for ans,idx in ans2idx.items()}
+    df['answer'] = df['answer'].map(ans2idx).astype(int)
+    train_df = df[df['mode']=='train'].reset_index(drop=True)
+    val_df = df[df['mode']=='val'].reset_index(drop=True)
+    test_df = df[df['mode']=='test'].reset_index(drop=True)
+
+    num_classes = len(ans2idx)
+    args.num_classes = num_classes
+    print('numclasses',num_classes)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    model = Model(args)
+    model.classifier[2] = nn.Linear(args.hidden_size, num_classes)
+    load_pruning_config(model, args)
+    print('Loading model at', args.model_dir)
+    model.load_state_dict(load_state_dict(args.model_dir))
+    model.to(device)
+
+    criterion = nn.CrossEntropyLoss()
+    scaler = GradScaler()
+
+    train_tfm = transforms.Compose([transforms.Resize(224),
+                                    transforms.CenterCrop(224),
+                                    transforms.RandomResizedCrop(224,scale=(0.75,1.25),ratio=(0.75,1.25)),
+                                    transforms.RandomRotation(10),
+                                    transforms.ColorJitter(brightness=0.4,contrast=0.4,saturation=0.4,hue=0.4),
+                                    transforms.ToTensor(),
+                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+    test_tfm = transforms.Compose([transforms.Resize(224),
+                                transforms.CenterCrop(224),
+                                transforms.ToTensor(),
+                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+    valdataset = VQAMed(val_df, imgsize = args.image_size, tfm = test_tfm, args = args, mode='eval')
+    valloader = DataLoader(valdataset, batch_size = args.batch_size, shuffle=False, num_workers = args.num_workers)
+    img, question_token, segment_ids, attention_mask, _, _ = next(iter(valloader))
+    batch = (img, question_token.squeeze(1), segment_ids, attention_mask.squeeze(1))
+
+    def evaluate(name):
+        _, _, acc, _ = validate(valloader, model, criterion, device, scaler, args, val_df, idx2ans)
+        val_acc = acc['val_total_acc'] if not args.category else acc
+        row = {'model': name, 'heads': sum(n_heads(model)), 'encoder_params_m': sum(p.numel() for p in model.transformer.parameters()) / 1e6,
+               'val_acc': val_acc, f'cpu_ms_bs{args.batch_size}': measure_latency(model, batch, args.latency_threads)}
+        print(row)
+        return row
+
+    rows = [evaluate('original')]
+
+    head_scores, ffn_scores = importance(model, valloader, criterion, device, args.prune_batches)
+    config = select(head_scores, ffn_scores, 'transformer' if args.transformer_model == 'transformer' else 'realformer', args.head_ratio, args.ffn_ratio)
+    prune_model(model, config)
+    config = compose(read_pruning_config(args.pruning_config) if args.pruning_config else None, config)
+    print('Heads per layer:', n_heads(model))
+    rows.append(evaluate('pruned'))
+
+    os.makedirs(os.path.join(args.save_dir, args.task), exist_ok=True)
+    config_path = os.path.join(args.save_dir, args.task, args.run_name + '_pruned.json')
+    save_pruning_config(config, config_path)
+    model_path = os.path.join(args.save_dir, args.task, args.run_name + '_pruned.pt')
+    save_model(model.state_dict(), model_path, args)
+
+    if args.recovery_epochs:
+        traindataset = VQAMed(train_df, imgsize = args.image_size, tfm = train_tfm, args = args, mode='train')
+        trainloader = DataLoader(traindataset, batch_size = args.batch_size, shuffle=True, num_workers = args.num_workers)
+        optimizer = optim.Adam(model.parameters(),lr=args.lr)
+
+        best_acc = rows[-1]['val_acc']
+        best_state = copy.deepcopy(model.state_dict())
+        for epoch in range(args.recovery_epochs):
+            print(f'Recovery epoch {epoch+1}/{args.recovery_epochs}')
+            train_loss, _, _, _, _ = train_one_epoch(trainloader, model, optimizer, criterion, device, scaler, args, idx2ans)
+            val_loss, _, val_acc, _ = validate(valloader, model, criterion, device, scaler, args, val_df, idx2ans)
+            val_total_acc = val_acc['val_total_acc'] if not args.category else val_acc
+            if args.wandb:
+                wandb.log({'train_loss': train_loss, 'val_loss': val_loss, 'val_acc': val_total_acc})
+            if val_total_acc > best_acc:
+                print('Saving pruned model')
+                save_model(model.state_dict(), model_path, args)
+                best_state = copy.deepcopy(model.state_dict())
+                best_acc = val_total_acc
+        model.load_state_dict(best_state)
+        rows.append(evaluate('recovered'))
+
+    print('Saved', model_path, 'and', config_path)
+    table = pd.DataFrame(rows)
+    print(table.to_string(index=False))
+    table.to_csv(os.path.join(args.save_dir, args.run_name + '_pruning.csv'), index = False)
+    if args.wandb:
+        wandb.log({'pruning': wandb.Table(dataframe=table)})
@@ -0,0 +1,208 @@
+import argparse
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from transformers import BertTokenizer, AutoTokenizer
+
+from utils import load_data, encode_text
+from preprocess.vqamed_cache import build_image_cache, build_question_cache, get_tokenizer_name
+
+# hyperparameter sweep of vqamed2019/train.py: the configurations of --grid run concurrently as separate processes,
+# each one pinned to its own --cores_per_trial cores (sched_setaffinity) with --threads_per_trial torch/OpenMP threads,
+# --loader_workers data loader workers and one of --gpus. The images are decoded and the questions encoded once into
+# the memory-mapped stores of preprocess/vqamed_cache.py, read by every trial (train.py --data_cache).
+# Losing trials are stopped by asynchronous successive halving (ASHA): at the rungs --min_epochs * eta^k a trial
+# continues only if its validation accuracy is in the top 1/eta of the trials that reached the rung before it,
+# from the json lines train.py --report_file writes after every epoch
+# e.g. python vqamed2019/sweep.py --grid grid.json --base_args "--num_vis 5 --cnn_encoder tf_efficientnetv2_m --use_pretrained --model_dir roco.pt" --epochs 60
+
+# train.py options that select the image and question stores, with the train.py defaults
+STORE_OPTIONS = argparse.ArgumentParser(add_help=False)
+STORE_OPTIONS.add_argument('--image_size', type=int, default=224)
+STORE_OPTIONS.add_argument('--task', type=str, default='MLM')
+STORE_OPTIONS.add_argument('--clinicalbert', type=str, default='emilyalsentzer/Bio_ClinicalBERT')
+STORE_OPTIONS.add_argument('--max_position_embeddings', type=int, default=28)
+
+def get_trials(grid):
+    '''list of {option: value}, a json list is taken as is, a json dict is expanded to its cartesian product'''
+    if isinstance(grid, list):
+        return grid
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+def trial_args(trial):
+    argv = []
+    for k, v in trial.items():
+        if isinstance(v, bool):
+            argv += [f'--{k}'] if v else []
+        elif isinstance(v, list):
+            argv += [f'--{k}'] + [str(x) for x in v]
+        else:
+            argv += [f'--{k}', str(v)]
+    return argv
+
+def get_rungs(min_epochs, eta, epochs):
+    rungs = []
+    r = min_epochs
+    while r < epochs:
+        rungs.append(r)
+        r *= eta
+    return rungs
+
+def build_cache(args, commands):
+    # one image store per image size, one question store per tokenizer / sequence length used by the trials
+    data_args = argparse.Namespace(data_dir=args.data_dir, train_pct=1.0, valid_pct=1.0, test_pct=1.0)
+    df = pd.concat(load_data(data_args))
+    sizes = set()
+    token_args = {}
+    for argv in commands:
+        t, _ = STORE_OPTIONS.parse_known_args(argv)
+        sizes.add(t.image_size)
+        token_args[(t.task, t.clinicalbert, t.max_position_embeddings)] = t
+    for size in sorted(sizes):
+        build_image_cache(args.data_dir, df['img_id'], size, args.cache_workers)
+    for t in token_args.values():
+        name = get_tokenizer_name(t)
+        tokenizer = BertTokenizer.from_pretrained(name) if t.task == 'MLM' else AutoTokenizer.from_pretrained(name)
+        build_question_cache(args.data_dir, df['question'], t, tokenizer, encode_text)
+
+class Trial:
+    def __init__(self, i, trial, argv, args):
+        self.i = i
+        self.trial = trial
+        self.name = f'{args.name}-{i}'
+        self.report = os.path.join(args.sweep_dir, self.name + '.jsonl')
+        self.log = os.path.join(args.sweep_dir, self.name + '.log')
+        self.argv = argv + ['--run_name', self.name, '--report_file', self.report]
+        self.process = None
+        self.slot = None
+        self.results = [] # json lines of the report
+        self.status = 'pending'
+
+    def start(self, slot, cores, gpu, args):
+        if os.path.exists(self.report):
+            os.remove(self.report)
+        env = dict(os.environ)
+        threads = str(args.threads_per_trial or len(cores))
+        env.update({'OMP_NUM_THREADS': threads, 'MKL_NUM_THREADS': threads})
+        if gpu is not None:
+            env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')] + self.argv
+        print(f'[{self.name}] slot {slot}, cores {cores[0]}-{cores[-1]}, gpu {gpu}:', ' '.join(self.argv))
+        self.log_file = open(self.log, 'w')
+        self.process = subprocess.Popen(cmd, env=env, stdout=self.log_file, stderr=subprocess.STDOUT,
+                                        preexec_fn=lambda: os.sched_setaffinity(0, cores))
+        self.slot = slot
+        self.status = 'running'
+
+    def poll(self):
+        # new report lines, the last line may still be being written
+        if os.path.exists(self.report):
+            with open(self.report) as f:
+                lines = f.read().split('\n')[:-1]
+            new = [json.loads(l) for l in lines[len(self.results):]]
+            self.results.extend(new)
+            return new
+        return []
+
+    def stop(self, status):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.log_file.close()
+        self.status = status
+
+    def row(self):
+        acc = [r['val_acc'] for r in self.results]
+        return {'trial': self.name, **self.trial, 'status': self.status, 'epochs': len(self.results),
+                'best_val_acc': max(acc) if acc else np.nan, 'last_val_acc': acc[-1] if acc else np.nan}
+
+def run_sweep(trials, args):
+    cores = sorted(os.sched_getaffinity(0))
+    n_slots = args.max_parallel or max(1, len(cores) // args.cores_per_trial)
+    slots = {s: cores[s * args.cores_per_trial:(s + 1) * args.cores_per_trial] or cores for s in range(n_slots)}
+    rungs = get_rungs(args.min_epochs, args.eta, args.epochs)
+    print(f'{len(trials)} trials, {n_slots} in parallel, rungs at epochs {rungs}')
+    rung_results = {r: [] for r in rungs}
+
+    pending = list(trials)
+    running = {}
+    while pending or running:
+        for s in slots:
+            if s not in running and pending:
+                trial = pending.pop(0)
+                gpu = args.gpus[s % len(args.gpus)] if args.gpus else None
+                trial.start(s, slots[s], gpu, args)
+                running[s] = trial
+        time.sleep(args.poll_seconds)
+
+        for s, trial in list(running.items()):
+            for result in trial.poll():
+                if result['epoch'] not in rung_results:
+                    continue
+                recorded = rung_results[result['epoch']]
+                recorded.append(result['val_acc'])
+                cutoff = np.percentile(recorded, (1 - 1 / args.eta) * 100)
+                if result['val_acc'] < cutoff:
+                    print(f"[{trial.name}] stopped at epoch {result['epoch']}: val acc {result['val_acc']:.2f} < {cutoff:.2f}")
+                    trial.stop('stopped')
+                    break
+            if trial.status == 'running' and trial.process.poll() is not None:
+                trial.poll()
+                trial.stop('completed' if trial.process.returncode == 0 else f'failed ({trial.process.returncode})')
+                print(f'[{trial.name}] {trial.status} after {len(trial.results)} epochs, log {trial.log}')
+            if trial.status != 'running':
+                del running[s]
+
+    table = pd.DataFrame([t.row() for t in trials]).sort_values('best_val_acc', ascending=False)
+    return table
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Parallel hyperparameter sweep of vqamed2019/train.py")
+    parser.add_argument('--grid', type = str, required = True, help = "json: {option: [values]} expanded to all the combinations, or a list of {option: value} trials")
+    parser.add_argument('--base_args', type = str, required = False, default = '', help = "train.py options shared by all the trials")
+    parser.add_argument('--name', type = str, required = False, default = 'sweep', help = "prefix of the run names")
+    parser.add_argument('--data_dir', type = str, required = False, default = "ImageClef-2019-VQA-Med", help = "path for data")
+    parser.add_argument('--sweep_dir', type = str, required = False, default = "ImageClef-2019-VQA-Med/mmbert/sweep", help = "reports, logs and results of the trials")
+    parser.add_argument('--epochs', type = int, required = False, default = 100, help = "max epochs of a trial")
+
+    parser.add_argument('--max_parallel', type = int, required = False, default = None, help = "trials at once (default: cores / --cores_per_trial)")
+    parser.add_argument('--cores_per_trial', type = int, required = False, default = 8, help = "cpu cores a trial is pinned to")
+    parser.add_argument('--threads_per_trial', type = int, required = False, default = None, help = "torch/OpenMP threads of a trial (default: --cores_per_trial)")
+    parser.add_argument('--loader_workers', type = int, required = False, default = 4, help = "data loader workers of a trial")
+    parser.add_argument('--gpus', type = int, nargs = '+', default = None, help = "gpu ids assigned to the trials round robin")
+
+    parser.add_argument('--min_epochs', type = int, required = False, default = 5, help = "first rung of successive halving")
+    parser.add_argument('--eta', type = int, required = False, default = 3, help = "a trial continues past a rung if it is in the top 1/eta")
+    parser.add_argument('--poll_seconds', type = float, required = False, default = 10, help = "interval between two reads of the reports")
+
+    parser.add_argument('--no_cache', action = 'store_true', default = False, help = "do not build / use the shared image and question stores")
+    parser.add_argument('--cache_workers', type = int, required = False, default = 8, help = "image decoding processes of the cache")
+    args = parser.parse_args()
+
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    with open(args.grid) as f:
+        grid = json.load(f)
+
+    base = shlex.split(args.base_args) + ['--data_dir', args.data_dir, '--epochs', str(args.epochs), '--num_workers', str(args.loader_workers)]
+    if not args.no_cache:
+        base += ['--data_cache']
+    trials = [Trial(i, t, base + trial_args(t), args) for i, t in enumerate(get_trials(grid))]
+    if not args.no_cache:
+        build_cache(args, [t.argv for t in trials])
+
+    try:
+        table = run_sweep(trials, args)
+    except KeyboardInterrupt:
+        for t in trials:
+            if t.status == 'running':
+                t.stop('interrupted')
+        table = pd.DataFrame([t.row() for t in trials])
+    print(table.to_string(index=False))
+    table.to_csv(os.path.join(args.sweep_dir, args.name + '_results.csv'), index=False)
@@ -11,7 +11,9 @@ import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
 from torchvision import transforms, models
 from torch.cuda.amp import GradScaler
+from models.safetensors_utils import load_state_dict, save_model
 import os
+import json
 import warnings
 #import albumentations as A
 #import pretrainedmodels
@@ -19,6 +21,7 @@ import warnings
 #from albumentations.pytorch.transforms import ToTensorV2
 
 from models.mmbert import Model
+from models.profiling import attach_profiler
 from models.asl_singlelabel import ASLSingleLabel
 
 warnings.simplefilter("ignore", UserWarning)
@@ -75,7 +78,19 @@ if __name__ == '__main__':
     parser.add_argument('--dataset', type=str, default='VQA-Med', help='roco or vqamed2019')
     parser.add_argument('--cnn_encoder', type=str, default='resnet152', help='name of the cnn encoder')
     parser.add_argument('--use_relu', action = 'store_true', default = False, help = "use ReLu")
+    parser.add_argument('--safetensors', action = 'store_true', default = False, help = "save the models as safetensors instead of .pt")
+    parser.add_argument('--save_fp16', action = 'store_true', default = False, help = "store the saved model weights in fp16 (with --safetensors)")
+    parser.add_argument('--exclude_keys', nargs = '+', default = ['classifier.2'], help = "key prefixes of the pretrained model that are not loaded (replaced for the current problem)")
+    parser.add_argument('--profile', action = 'store_true', default = False, help = 'record per-module time, FLOPs, activations and memory (models/profiling.py)')
+    parser.add_argument('--profile_steps', type=int, nargs=2, default=[5, 25], help='optimizer steps [start, end) measured by --profile')
+    parser.add_argument('--profile_trace', type=int, nargs=2, default=None, help='optimizer steps [start, end) of a torch.profiler trace (with --profile)')
+    parser.add_argument('--profile_output', type=str, default=None, help='json report of --profile (default: <save_dir>/profile_<run_name>.json)')
+    parser.add_argument('--checkpoint_activations', type=str, default='none', choices=['none', 'backbone', 'encoder', 'all'], help='recompute the activations of these parts in the backward pass to save memory')
+    parser.add_argument('--checkpoint_every', type = int, required = False, default = 1, help = "backbone stages / encoder blocks in each checkpointed segment")
     parser.add_argument('--transformer_model', type=str, default='transformer',choices=['transformer', 'realformer', 'feedback-transformer'], help='name of the transformer model')
+    parser.add_argument('--data_cache', action = 'store_true', default = False, help = "read the images and questions from the memory-mapped stores of preprocess/vqamed_cache.py")
+    parser.add_argument('--report_file', type = str, required = False, default = None, help = "append a json line with the validation accuracy and loss after every epoch (read by vqamed2019/sweep.py)")
+    parser.add_argument('--early_exit', action = 'store_true', default = False, help = "answer heads after every encoder layer, trained jointly (see vqamed2019/early_exit.py)")
     parser.add_argument('--loss', type=str, default='CrossEntropyLoss', choices=['CrossEntropyLoss', 'ASLSingleLabel'], help='loss to evaluate model on')
 
     args = parser.parse_args()
@@ -126,7 +141,8 @@ if __name__ == '__main__':
         print('loading model from roco')
         print(args.model_dir)
         model_dict = model.state_dict()
-        pretrained_dict = torch.load(args.model_dir)
+        # .pt or safetensors, the excluded keys are not read
+        pretrained_dict = load_state_dict(args.model_dir, exclude=args.exclude_keys)
         # 1. filter out unnecessary keys
         pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
         # 2. overwrite entries in the existing state dict
@@ -142,7 +158,7 @@ if __name__ == '__main__':
         # before = args.run_name.split('-')[-1]
         # before = args.run_name.split(('-'))[0] + '-' + str(int(before)-1) +"_acc.pt"
         # path = os.path.join(args.save_dir, before)
-        model.load_state_dict(torch.load(args.resume_dir))
+        model.load_state_dict(load_state_dict(args.resume_dir))
 
     if not args.use_pretrained and not args.resume_training:
         print('from scratch')
@@ -158,6 +174,7 @@ if __name__ == '__main__':
 
 
     optimizer = optim.Adam(model.parameters(),lr=args.lr)
+    profiler = attach_profiler(model, optimizer, args)
     scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, patience = args.patience, factor = args.factor, verbose = True)
 
 
@@ -180,9 +197,9 @@ if __name__ == '__main__':
                                     
                                     #transforms.ToPILImage(),
                                     #transforms.Resize([224,224]),
-                                    transforms.Resize(224), 
-                                    transforms.CenterCrop(224), 
-                                    transforms.RandomResizedCrop(224,scale=(0.75,1.25),ratio=(0.75,1.25)),
+                                    transforms.Resize(args.image_size), 
+                                    transforms.CenterCrop(args.image_size), 
+                                    transforms.RandomResizedCrop(args.image_size,scale=(0.75,1.25),ratio=(0.75,1.25)),
                                     transforms.RandomRotation(10),
                                     # Cutout(),
                                     transforms.ColorJitter(brightness=0.4,contrast=0.4,saturation=0.4,hue=0.4),
@@ -192,15 +209,15 @@ if __name__ == '__main__':
 
     val_tfm = transforms.Compose([#transforms.ToPILImage(),
                                 #transforms.Resize([224,224]),
-                                transforms.Resize(224),
-                                transforms.CenterCrop(224),
+                                transforms.Resize(args.image_size),
+                                transforms.CenterCrop(args.image_size),
                                 transforms.ToTensor(), 
                                 transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
 
     test_tfm = transforms.Compose([#transforms.ToPILImage(),
                                 #transforms.Resize([224,224]),
-                                transforms.Resize(224),
-                                transforms.CenterCrop(224),
+                                transforms.Resize(args.image_size),
+                                transforms.CenterCrop(args.image_size),
                                 transforms.ToTensor(), 
                                  transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
 
@@ -231,6 +248,10 @@ if __name__ == '__main__':
         test_loss, predictions, acc, bleu = test(testloader, model, criterion, device, scaler, args, test_df,idx2ans)
 
         scheduler.step(val_loss)
+
+        if args.report_file:
+            with open(args.report_file, 'a') as f:
+                f.write(json.dumps({'epoch': epoch + 1, 'val_acc': float(val_acc if args.category else val_acc['val_total_acc']), 'val_loss': float(val_loss)}) + '\n')
      
 
         if not args.category:
@@ -264,7 +285,7 @@ if __name__ == '__main__':
         #save by val loss
         if val_loss < best_loss:
             print('Saving model by loss')
-            torch.save(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + "_loss" + '.pt'))
+            save_model(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + "_loss" + '.pt'), args)
             best_loss = val_loss
 
         #save by accuracy in val
@@ -272,14 +293,14 @@ if __name__ == '__main__':
 
             if val_acc['val_total_acc'] > best_acc1:
                 print('Saving model')
-                torch.save(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '.pt'))
+                save_model(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '.pt'), args)
                 best_acc1=val_acc['val_total_acc']
 
         else:
 
             if val_acc['val_' + args.category + '_acc'] > best_acc1:
                 print('Saving model')
-                torch.save(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '.pt'))
+                save_model(model.state_dict(), os.path.join(args.save_dir, args.task , args.run_name + '.pt'), args)
                 best_acc1 = val_acc['val_' + args.category + '_acc'] 
 
         # if (epoch + 1) % args.save_model_epoch == 0:
@@ -293,4 +314,7 @@ if __name__ == '__main__':
             print(f'Counter {counter}/{args.counter}')
             if counter > args.counter:
                 print('Counter expired, finishing.')
-                break      
\ No newline at end of file
+                break      
+
+    if profiler is not None:
+        profiler.report()
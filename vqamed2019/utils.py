@@ -22,6 +22,10 @@ import matplotlib.pyplot as plt
 
 #import pretrainedmodels
 from transformers import AutoTokenizer, AutoModel
+from preprocess.manifest import get_manifest_path, read_manifest, INFO_COLUMNS
+from preprocess.scan_images import exclude_invalid
+from preprocess.vqamed_cache import ImageCache, QuestionCache
+from models.ensemble import Ensemble
 
 def seed_everything(seed):
     random.seed(seed)
@@ -48,8 +52,32 @@ def make_df(file_path):
 
     return pd.concat(df_list)
 
+def load_manifest_data(args, manifests, remove = None):
+    # preprocess/vqamed2019_data.py --task manifest: valid items only, already lowercased
+    # the dataset columns and the image path
+    traindf, valdf, testdf = [read_manifest(m, exclude=[c for c in INFO_COLUMNS if c != 'path']) for m in manifests]
+
+    if remove is not None:
+        traindf = traindf[~traindf['img_id'].isin(remove)].reset_index(drop=True)
+
+    dfs = []
+    for df in [traindf, valdf, testdf]:
+        df['img_id'] = args.data_dir + os.sep + df['path']
+        dfs.append(df.drop(columns=['path']))
+    traindf, valdf, testdf = dfs
+
+    traindf = traindf.sample(frac = args.train_pct)
+    valdf = valdf.sample(frac = args.valid_pct)
+    testdf = testdf.sample(frac = args.test_pct)
+
+    return traindf, valdf, testdf
+
 def load_data(args, remove = None):
 
+    manifests = [get_manifest_path(os.path.join(args.data_dir, split)) for split in ['Train', 'Val', 'Test']]
+    if all(manifests):
+        return load_manifest_data(args, manifests, remove)
+
     traindf = pd.read_csv(os.path.join(args.data_dir, 'traindf.csv'))
     valdf = pd.read_csv(os.path.join(args.data_dir, 'valdf.csv'))
     testdf = pd.read_csv(os.path.join(args.data_dir, 'testdf.csv'))
@@ -62,6 +90,12 @@ def load_data(args, remove = None):
     testdf['img_id'] = testdf['img_id'].apply(lambda x: os.path.join(args.data_dir, 'Test','images', x + '.jpg'))
     # testdf['img_id'] = testdf['img_id'].apply(lambda x: os.path.join(args.data_dir, x + '.jpg'))
 
+    # images flagged by preprocess/scan_images.py, the folders are scanned if needed
+    workers = args.num_workers if hasattr(args, 'num_workers') and args.num_workers else 8
+    traindf = exclude_invalid(traindf, 'img_id', workers).reset_index(drop=True)
+    valdf = exclude_invalid(valdf, 'img_id', workers).reset_index(drop=True)
+    testdf = exclude_invalid(testdf, 'img_id', workers).reset_index(drop=True)
+
     traindf['category'] = traindf['category'].str.lower()
     valdf['category'] = valdf['category'].str.lower()
     testdf['category'] = testdf['category'].str.lower()
@@ -105,6 +139,11 @@ def load_2020_data(args):
     valdf['imgid'] = valdf['imgid'].apply(lambda x: args.datapath2020 + '/VQAMed2020-VQAnswering-ValidationSet/VQAnswering_2020_Val_images/' + x + '_224.jpg')
     testdf['imgid'] = testdf['imgid'].apply(lambda x: args.testpath + '/Task1-2020-VQAnswering-Test-Images/' + x + '_224.jpg')
 
+    # images flagged by preprocess/scan_images.py, the folders are scanned if needed
+    workers = args.num_workers if hasattr(args, 'num_workers') and args.num_workers else 8
+    traindf = exclude_invalid(traindf, 'imgid', workers).reset_index(drop=True)
+    valdf = exclude_invalid(valdf, 'imgid', workers).reset_index(drop=True)
+
 
 
     classes2020 = list(set(list(traindf['answer'].unique()) + list(valdf['answer'].unique())))
@@ -218,16 +257,38 @@ class VQAMed(Dataset):
         self.tfm = tfm
         self.size = imgsize
         self.args = args
-        if args.task == 'MLM':
-            self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        elif args.task == 'distillation':
-            self.tokenizer = AutoTokenizer.from_pretrained(args.clinicalbert)
+        # --data_cache: decoded images and encoded questions from the stores of preprocess/vqamed_cache.py,
+        # the tokenizer is only built for the questions that are not in the store
+        self.images, self.questions, self.tokenizer = None, None, None
+        if hasattr(args, 'data_cache') and args.data_cache:
+            self.images = ImageCache(args.data_dir, imgsize)
+            self.questions = QuestionCache(args.data_dir, args)
+        else:
+            self.tokenizer = self.get_tokenizer()
         self.mode = mode
 
         if self.mode == 'train':
             cats = self.df.category.unique()
             self.cats2ans = {c:i for i,c in enumerate(cats)}
 
+    def get_tokenizer(self):
+        if self.args.task == 'MLM':
+            return BertTokenizer.from_pretrained('bert-base-uncased')
+        elif self.args.task == 'distillation':
+            return AutoTokenizer.from_pretrained(self.args.clinicalbert)
+
+    def load_image(self, path):
+        img = self.images.get(path) if self.images is not None else None
+        return img if img is not None else Image.open(path).convert('RGB')
+
+    def encode_question(self, question):
+        encoded = self.questions.get(question) if self.questions is not None else None
+        if encoded is not None:
+            return encoded
+        if self.tokenizer is None:
+            self.tokenizer = self.get_tokenizer()
+        return encode_text(question, self.tokenizer, self.args)
+
     def __len__(self):
         return len(self.df)
 
@@ -243,12 +304,12 @@ class VQAMed(Dataset):
         # if self.args.smoothing:
         #     answer = onehot(self.args.num_classes, answer)
 
-        img = Image.open(path).convert('RGB')#cv2.imread(path)
+        img = self.load_image(path)#cv2.imread(path)
 
         if self.tfm:
             img = self.tfm(img)
 
-        tokens, segment_ids, input_mask= encode_text(question, self.tokenizer, self.args)
+        tokens, segment_ids, input_mask= self.encode_question(question)
 
         if self.mode == 'train':
             cat = self.cats2ans[self.df.loc[idx, 'category']]
@@ -622,6 +683,12 @@ class Model(nn.Module):
 
 
 
+def add_exit_loss(loss, exit_logits, loss_fn):
+    # --early_exit: the model returns the logits of its intermediate answer heads, their mean loss is added
+    if not isinstance(exit_logits, list) or not exit_logits:
+        return loss
+    return loss + sum(loss_fn(l) for l in exit_logits) / len(exit_logits)
+
 def train_one_epoch(loader, model, optimizer, criterion, device, scaler, args, idx2ans):
 
     model.train()
@@ -640,14 +707,17 @@ def train_one_epoch(loader, model, optimizer, criterion, device, scaler, args, i
 
         if args.mixed_precision:
             with torch.cuda.amp.autocast():
-                logits, _, _ = model(img, question_token, segment_ids, attention_mask)
+                logits, exit_logits, _ = model(img, question_token, segment_ids, attention_mask)
                 loss = loss_func(logits, target)
+                loss = add_exit_loss(loss, exit_logits, lambda l: loss_func(l, target))
         else:
-            logits, _, _ = model(img, question_token, segment_ids, attention_mask)
+            logits, exit_logits, _ = model(img, question_token, segment_ids, attention_mask)
             if args.smoothing:
                 loss = loss_func(logits, target, category)
+                loss = add_exit_loss(loss, exit_logits, lambda l: loss_func(l, target, category))
             else:
                 loss = loss_func(logits, target)
+                loss = add_exit_loss(loss, exit_logits, lambda l: loss_func(l, target))
         if args.mixed_precision:
             scaler.scale(loss)
             loss.backward()
@@ -687,6 +757,84 @@ def train_one_epoch(loader, model, optimizer, criterion, device, scaler, args, i
 
     return np.mean(train_loss), PREDS, acc, bleu, IMGIDS
 
+class DistillationLoss(nn.Module):
+    # temperature-scaled KL divergence to the teacher logits, mixed with the usual loss on the answers
+    def __init__(self, criterion, temperature=4.0, alpha=0.9):
+        super().__init__()
+        self.criterion = criterion
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def forward(self, logits, teacher_logits, target, category=None):
+        t = self.temperature
+        kd = F.kl_div(F.log_softmax(logits / t, dim=1), F.softmax(teacher_logits / t, dim=1), reduction='batchmean') * t * t
+        hard = self.criterion(logits, target) if category is None else self.criterion(logits, target, category)
+        return self.alpha * kd + (1 - self.alpha) * hard
+
+def distill_one_epoch(loader, model, teacher, optimizer, criterion, device, scaler, args, idx2ans):
+    # train_one_epoch of a student on the soft logits of a frozen teacher (criterion: DistillationLoss)
+    model.train()
+    teacher.eval()
+    train_loss = []
+    PREDS = []
+    TARGETS = []
+    bar = tqdm(loader, leave = False)
+    for (img, question_token,segment_ids,attention_mask,target, imgid, category) in bar:
+
+        img, question_token,segment_ids,attention_mask,target,category = img.to(device), question_token.to(device), segment_ids.to(device), attention_mask.to(device), target.to(device), category.to(device)
+        question_token = question_token.squeeze(1)
+        attention_mask = attention_mask.squeeze(1)
+        optimizer.zero_grad()
+
+        with torch.cuda.amp.autocast(enabled=args.mixed_precision):
+            with torch.no_grad():
+                teacher_logits, _, _ = teacher(img, question_token, segment_ids, attention_mask)
+            logits, _, _ = model(img, question_token, segment_ids, attention_mask)
+            loss = criterion(logits.float(), teacher_logits.float(), target, category if args.smoothing else None)
+
+        if args.mixed_precision:
+            scaler.scale(loss).backward()
+            if args.clip:
+                scaler.unscale_(optimizer)
+                nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            if args.clip:
+                nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+
+        TARGETS.append(target)
+        PREDS.append(logits.argmax(1).detach())
+
+        loss_np = loss.detach().cpu().numpy()
+        train_loss.append(loss_np)
+        bar.set_description('distill_loss: %.5f' % (loss_np))
+
+    PREDS = torch.cat(PREDS).cpu().numpy()
+    TARGETS = torch.cat(TARGETS).cpu().numpy()
+
+    acc = (PREDS == TARGETS).mean() * 100.
+
+    return np.mean(train_loss), acc
+
+def measure_latency(model, batch, threads=None, iters=20, warmup=3):
+    # mean ms per forward of `batch` (img, tokens, segment_ids, mask) on cpu
+    import time
+    import copy
+    if threads:
+        torch.set_num_threads(threads)
+    model = copy.deepcopy(model).cpu().eval()
+    batch = [t.cpu() for t in batch]
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(*batch)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(*batch)
+    return (time.perf_counter() - start) / iters * 1000
+
 def validate(loader, model, criterion, device, scaler, args, val_df, idx2ans):
 
     model.eval()
@@ -766,6 +914,36 @@ def validate(loader, model, criterion, device, scaler, args, val_df, idx2ans):
        
     return val_loss, PREDS, acc, bleu
 
+def test_metrics(PREDS, TARGETS, args, val_df, idx2ans):
+    # accuracy and bleu, in total and per category (unless --category)
+    if args.category:
+        acc = (PREDS == TARGETS).mean() * 100.
+        bleu = calculate_bleu_score(PREDS,TARGETS,idx2ans)
+    else:
+        total_acc = (PREDS == TARGETS).mean() * 100.
+        binary_acc = (PREDS[val_df['category']=='binary'] == TARGETS[val_df['category']=='binary']).mean() * 100.
+        plane_acc = (PREDS[val_df['category']=='plane'] == TARGETS[val_df['category']=='plane']).mean() * 100.
+        organ_acc = (PREDS[val_df['category']=='organ'] == TARGETS[val_df['category']=='organ']).mean() * 100.
+        modality_acc = (PREDS[val_df['category']=='modality'] == TARGETS[val_df['category']=='modality']).mean() * 100.
+        abnorm_acc = (PREDS[val_df['category']=='abnormality'] == TARGETS[val_df['category']=='abnormality']).mean() * 100.
+
+        acc = {'total_acc': np.round(total_acc, 4), 'binary_acc': np.round(binary_acc, 4), 'plane_acc': np.round(plane_acc, 4), 'organ_acc': np.round(organ_acc, 4),
+               'modality_acc': np.round(modality_acc, 4), 'abnorm_acc': np.round(abnorm_acc, 4)}
+
+        # add bleu score code
+        total_bleu = calculate_bleu_score(PREDS,TARGETS,idx2ans)
+        binary_bleu = calculate_bleu_score(PREDS[val_df['category']=='binary'],TARGETS[val_df['category']=='binary'],idx2ans)
+        plane_bleu = calculate_bleu_score(PREDS[val_df['category']=='plane'],TARGETS[val_df['category']=='plane'],idx2ans)
+        organ_bleu = calculate_bleu_score(PREDS[val_df['category']=='organ'],TARGETS[val_df['category']=='organ'],idx2ans)
+        modality_bleu = calculate_bleu_score(PREDS[val_df['category']=='modality'],TARGETS[val_df['category']=='modality'],idx2ans)
+        abnorm_bleu = calculate_bleu_score(PREDS[val_df['category']=='abnormality'],TARGETS[val_df['category']=='abnormality'],idx2ans)
+
+
+        bleu = {'total_bleu': np.round(total_bleu, 4),  'binary_bleu': np.round(binary_bleu, 4), 'plane_bleu': np.round(plane_bleu, 4), 'organ_bleu': np.round(organ_bleu, 4),
+            'modality_bleu': np.round(modality_bleu, 4), 'abnorm_bleu': np.round(abnorm_bleu, 4)}
+
+    return acc, bleu
+
 def test(loader, model, criterion, device, scaler, args, val_df,idx2ans):
 
     model.eval()
@@ -813,36 +991,14 @@ def test(loader, model, criterion, device, scaler, args, val_df,idx2ans):
     PREDS = torch.cat(PREDS).cpu().numpy()
     TARGETS = torch.cat(TARGETS).cpu().numpy()
 
-    if args.category:
-        acc = (PREDS == TARGETS).mean() * 100.
-        bleu = calculate_bleu_score(PREDS,TARGETS,idx2ans)
-    else:
-        total_acc = (PREDS == TARGETS).mean() * 100.
-        binary_acc = (PREDS[val_df['category']=='binary'] == TARGETS[val_df['category']=='binary']).mean() * 100.
-        plane_acc = (PREDS[val_df['category']=='plane'] == TARGETS[val_df['category']=='plane']).mean() * 100.
-        organ_acc = (PREDS[val_df['category']=='organ'] == TARGETS[val_df['category']=='organ']).mean() * 100.
-        modality_acc = (PREDS[val_df['category']=='modality'] == TARGETS[val_df['category']=='modality']).mean() * 100.
-        abnorm_acc = (PREDS[val_df['category']=='abnormality'] == TARGETS[val_df['category']=='abnormality']).mean() * 100.
-
-        acc = {'total_acc': np.round(total_acc, 4), 'binary_acc': np.round(binary_acc, 4), 'plane_acc': np.round(plane_acc, 4), 'organ_acc': np.round(organ_acc, 4),
-               'modality_acc': np.round(modality_acc, 4), 'abnorm_acc': np.round(abnorm_acc, 4)}
-
-        # add bleu score code
-        total_bleu = calculate_bleu_score(PREDS,TARGETS,idx2ans)
-        binary_bleu = calculate_bleu_score(PREDS[val_df['category']=='binary'],TARGETS[val_df['category']=='binary'],idx2ans)
-        plane_bleu = calculate_bleu_score(PREDS[val_df['category']=='plane'],TARGETS[val_df['category']=='plane'],idx2ans)
-        organ_bleu = calculate_bleu_score(PREDS[val_df['category']=='organ'],TARGETS[val_df['category']=='organ'],idx2ans)
-        modality_bleu = calculate_bleu_score(PREDS[val_df['category']=='modality'],TARGETS[val_df['category']=='modality'],idx2ans)
-        abnorm_bleu = calculate_bleu_score(PREDS[val_df['category']=='abnormality'],TARGETS[val_df['category']=='abnormality'],idx2ans)
-
-
-        bleu = {'total_bleu': np.round(total_bleu, 4),  'binary_bleu': np.round(binary_bleu, 4), 'plane_bleu': np.round(plane_bleu, 4), 'organ_bleu': np.round(organ_bleu, 4),
-            'modality_bleu': np.round(modality_bleu, 4), 'abnorm_bleu': np.round(abnorm_bleu, 4)}
-
+    acc, bleu = test_metrics(PREDS, TARGETS, args, val_df, idx2ans)
 
     return test_loss, PREDS, acc, bleu
 
 def final_test(loader, all_models, device, args, val_df, idx2ans):
+    # mean logits of an ensemble (list of models or models.ensemble.Ensemble), accumulated on the device,
+    # the members stacked by Ensemble are moved to meta, the list can not be used afterwards
+    ensemble = all_models if isinstance(all_models, Ensemble) else Ensemble(all_models)
 
     PREDS = []
 
@@ -853,24 +1009,100 @@ def final_test(loader, all_models, device, args, val_df, idx2ans):
             question_token = question_token.squeeze(1)
             attention_mask = attention_mask.squeeze(1)
 
-            for i, model in enumerate(all_models):
-                if args.mixed_precision:
-                    with torch.cuda.amp.autocast():
-                        logits, _, _ = model(img, question_token, segment_ids, attention_mask)
-                else:
-                    logits, _, _ = model(img, question_token, segment_ids, attention_mask)
-
-                if i == 0:
-                    pred = logits.detach().cpu().numpy()/len(all_models)
-                else:
-                    pred += logits.detach().cpu().numpy()/len(all_models)
+            if args.mixed_precision:
+                with torch.cuda.amp.autocast():
+                    pred = ensemble(img, question_token, segment_ids, attention_mask)
+            else:
+                pred = ensemble(img, question_token, segment_ids, attention_mask)
 
-            PREDS.append(pred)
+            PREDS.append(pred.float())
 
-    PREDS = np.concatenate(PREDS)
+    PREDS = torch.cat(PREDS).cpu().numpy()
 
     return PREDS
 
+def model_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+def plan_rounds(n_models, size, devices, budget):
+    # rounds of {device: model indices}, at most `budget` bytes of weights per device and round (None = no limit)
+    per_device = math.ceil(n_models / len(devices)) if budget is None else max(1, int(budget // size))
+    rounds = []
+    for i in range(n_models):
+        slot = i % (per_device * len(devices))
+        if slot == 0:
+            rounds.append({d: [] for d in devices})
+        rounds[-1][devices[slot // per_device]].append(i)
+    return rounds
+
+def predict_batch(models, batch, device, args):
+    img, question_token, segment_ids, attention_mask = (t.to(device, non_blocking=True) for t in batch)
+    preds = []
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=args.mixed_precision):
+        for model in models:
+            logits, _, _ = model(img, question_token, segment_ids, attention_mask)
+            preds.append(logits.argmax(1).cpu())
+    return preds
+
+def test_checkpoints(loader, build_model, model_dirs, args, test_df, idx2ans):
+    '''predictions and metrics of several checkpoints with one decoding of the test set: every batch is fed to
+    all the models of a round, the models of a round are spread over the gpus (one thread per device) within
+    --memory_budget MB of weights per device. With more than one round the decoded batches are kept in memory'''
+    from concurrent.futures import ThreadPoolExecutor
+
+    devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())] or ['cpu']
+    first = build_model(model_dirs[0])
+    size = model_bytes(first)
+    budget = args.memory_budget * 2**20 if args.memory_budget else None
+    rounds = plan_rounds(len(model_dirs), size, devices, budget)
+    print(f'{len(model_dirs)} checkpoints of {size / 2**20:.0f} MB in {len(rounds)} round(s) on {devices}')
+
+    batches = None
+    TARGETS = []
+    PREDS = [[] for _ in model_dirs]
+    pool = ThreadPoolExecutor(len(devices))
+    for r, assignment in enumerate(rounds):
+        models = {}
+        for d, idx in assignment.items():
+            models[d] = []
+            for i in idx:
+                model = first if i == 0 else build_model(model_dirs[i])
+                model.to(d)
+                model.eval()
+                models[d].append(model)
+        first = None
+
+        source = loader if batches is None else batches
+        keep = batches is None and len(rounds) > 1
+        if keep:
+            batches = []
+        for (img, question_token, segment_ids, attention_mask, target, *_) in tqdm(source, leave=False):
+            batch = (img, question_token.squeeze(1), segment_ids, attention_mask.squeeze(1))
+            if keep:
+                batches.append((img, question_token, segment_ids, attention_mask, target))
+            if r == 0:
+                TARGETS.append(target)
+            futures = {d: pool.submit(predict_batch, models[d], batch, d, args) for d in models if models[d]}
+            for d, f in futures.items():
+                for i, pred in zip(assignment[d], f.result()):
+                    PREDS[i].append(pred)
+        del models
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    pool.shutdown()
+
+    TARGETS = torch.cat(TARGETS).numpy()
+    rows = []
+    predictions = {}
+    for path, preds in zip(model_dirs, PREDS):
+        preds = torch.cat(preds).numpy()
+        acc, bleu = test_metrics(preds, TARGETS, args, test_df, idx2ans)
+        if not isinstance(acc, dict):
+            acc, bleu = {'acc': np.round(acc, 4)}, {'bleu': np.round(bleu, 4)}
+        rows.append({'checkpoint': path, **acc, **bleu})
+        predictions[path] = preds
+    return pd.DataFrame(rows), predictions
+
 def test2020(loader, model, device, args):
 
     model.eval()